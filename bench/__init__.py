@@ -0,0 +1,4 @@
+"""
+NeoChat 性能基准测试
+在仓库根目录下运行，例如: python -m bench.fanout
+"""
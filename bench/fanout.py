@@ -0,0 +1,137 @@
+"""
+TCP 广播扇出微基准
+比较「每个接收者各自编码」与「编码一次、共享帧」两种广播方式，
+统计每条送达消息消耗的 CPU 时间。
+
+用法: python -m bench.fanout [--recipients 100 1000 10000] [--messages 50] [--burst 1] [--coalesce-ms 0]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_tcp import ClientOutbox, Session, TCPChatServer
+
+
+class NullTransport:
+    """丢弃所有数据的传输层"""
+
+    def abort(self):
+        pass
+
+
+class CountingWriter:
+    """模拟 StreamWriter，只统计写入的字节数和系统调用次数"""
+
+    def __init__(self):
+        self.transport = NullTransport()
+        self.bytes_written = 0
+        self.write_calls = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.write_calls += 1
+
+    def writelines(self, data):
+        for chunk in data:
+            self.bytes_written += len(chunk)
+        self.write_calls += 1
+
+    async def drain(self):
+        pass
+
+
+async def legacy_broadcast(server, message, exclude=None):
+    """旧的广播方式：每个接收者都重新 json.dumps + encode"""
+    for session in server.sessions:
+        if session is not exclude:
+            outbox = session.outbox
+            if outbox:
+                outbox.put_nowait((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+
+
+async def run_case(recipients, messages, mode, burst=1, coalesce_ms=0):
+    """对指定接收者数量运行一轮广播，返回统计结果"""
+    server = TCPChatServer(port=0, queue_size=max(1024, messages), coalesce_ms=coalesce_ms)
+    server.log = lambda message, level='INFO': None
+
+    writers = []
+    for i in range(recipients):
+        writer = CountingWriter()
+        session = Session(writer, f"bench:{i}", f"bench-{i}")
+        session.username = f"user_{i}"
+        session.outbox = ClientOutbox(server, writer, maxsize=server.queue_size, name=session.username)
+        server.sessions.add(session)
+        writers.append(writer)
+
+    payload = {
+        'type': 'message',
+        'time': server.get_time(),
+        'username': 'bench',
+        'message': '你好，NeoChat！这是一条用于扇出基准测试的中文消息。' * 2
+    }
+    broadcast = server.broadcast if mode == 'encode-once' else (
+        lambda message: legacy_broadcast(server, message))
+
+    start_cpu = time.process_time()
+    start_wall = time.perf_counter()
+    for i in range(messages):
+        await broadcast(payload)
+        if (i + 1) % burst == 0:
+            await asyncio.sleep(0)  # 让写任务运行；burst > 1 时积压的帧会合并为一次写入
+    outboxes = [session.outbox for session in server.sessions]
+    await asyncio.gather(*(outbox.flush(timeout=60) for outbox in outboxes))
+    cpu = time.process_time() - start_cpu
+    wall = time.perf_counter() - start_wall
+
+    for outbox in outboxes:
+        outbox.stop()
+    server.is_running = False
+
+    delivered = recipients * messages
+    return {
+        'mode': mode,
+        'recipients': recipients,
+        'delivered': delivered,
+        'cpu_us_per_delivery': cpu / delivered * 1e6,
+        'wall_s': wall,
+        'writes_per_delivery': sum(w.write_calls for w in writers) / delivered,
+        'avg_batch': server.flushed_frames / server.flush_count if server.flush_count else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NeoChat TCP 广播扇出微基准')
+    parser.add_argument('--recipients', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--messages', type=int, default=50, help='每轮广播的消息数')
+    parser.add_argument('--burst', type=int, default=1, help='每次让出事件循环前连续广播的消息数')
+    parser.add_argument('--coalesce-ms', type=float, default=0, help='消息合并窗口上限（毫秒）')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+
+    # TCPChatServer 会在当前目录创建 chat_logs，基准测试在临时目录中进行
+    os.chdir(tempfile.mkdtemp(prefix='neochat_bench_'))
+
+    results = []
+    for recipients in args.recipients:
+        for mode in ('per-recipient', 'encode-once'):
+            results.append(asyncio.run(run_case(recipients, args.messages, mode, args.burst, args.coalesce_ms)))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'接收者':>8} {'方式':<14} {'CPU/送达(µs)':>14} {'写调用/送达':>12} {'耗时(s)':>9}")
+    for r in results:
+        print(f"{r['recipients']:>8} {r['mode']:<14} {r['cpu_us_per_delivery']:>14.3f} "
+              f"{r['writes_per_delivery']:>12.3f} {r['wall_s']:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+分帧方式对比基准
+启动 server_tcp.py，分别用换行 JSON 和二进制长度前缀分帧连接若干 ChatClient，
+由一个客户端发送消息，统计接收端每条消息的字节数和客户端解码的 CPU 时间。
+
+用法: python -m bench.framing [--clients 20] [--messages 2000]
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.loops import free_port
+from client_gui import ChatClient
+
+
+def wait_for_server(port, timeout=10.0):
+    """等待服务器开始监听"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1,
+                                          source_address=('127.0.0.254', 0)):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('服务器启动超时')
+
+
+def connect_client(port, index, binary):
+    """以第 index 个回环地址连接（服务器按 IP 去重连接）"""
+    client = ChatClient(binary=binary)
+    address = f"127.0.{(index + 2) // 250}.{(index + 2) % 250 + 1}"
+    client.socket = socket.create_connection(('127.0.0.1', port), timeout=5, source_address=(address, 0))
+    client.username = f"bench_{index}"
+    if binary:
+        client._handshake(client.username)
+    else:
+        client._send_raw(f"{client.username}\n".encode('utf-8'))
+    client.connected = True
+    client.socket.settimeout(None)
+    return client
+
+
+def run_mode(port, binary, args, offset):
+    """运行一轮：一个发送者，其余客户端接收"""
+    clients = [connect_client(port, offset + i, binary) for i in range(args.clients)]
+    time.sleep(0.5)  # 等待加入消息广播完毕
+
+    receivers = clients[1:]
+    received = [0] * len(receivers)
+    done = threading.Event()
+    lock = threading.Lock()
+    finished = [0]
+
+    def make_callback(i):
+        def callback(message):
+            if not isinstance(message, dict):
+                message = json.loads(message)
+            if str(message.get('message', '')).startswith('bench '):
+                received[i] += 1
+                if received[i] == args.messages:
+                    with lock:
+                        finished[0] += 1
+                        if finished[0] == len(receivers):
+                            done.set()
+        return callback
+
+    threads = []
+    for i, client in enumerate(receivers):
+        client.bytes_received = 0
+        thread = threading.Thread(target=client.receive_messages, args=(make_callback(i),), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    sender = clients[0]
+    payload = '你好，NeoChat！这是一条用于分帧对比的消息。' * 2
+    start_cpu = time.process_time()
+    start_wall = time.perf_counter()
+    for seq in range(args.messages):
+        sender.send_message(f"bench {seq} {payload}")
+    done.wait(timeout=60)
+    cpu = time.process_time() - start_cpu
+    wall = time.perf_counter() - start_wall
+
+    delivered = sum(received)
+    bytes_received = sum(client.bytes_received for client in receivers)
+    codec = receivers[0].codec.name if receivers[0].codec else 'json-line'
+    for client in clients:
+        client.disconnect()
+
+    return {
+        'mode': 'binary' if binary else 'line',
+        'codec': codec,
+        'delivered': delivered,
+        'bytes_per_message': bytes_received / delivered if delivered else 0.0,
+        'client_cpu_us_per_message': cpu / delivered * 1e6 if delivered else 0.0,
+        'wall_s': wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NeoChat 分帧方式对比基准')
+    parser.add_argument('--clients', type=int, default=20, help='每种模式的客户端数量')
+    parser.add_argument('--messages', type=int, default=2000, help='发送的消息数')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix='neochat_bench_')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server_tcp.py'), str(port), '--queue-size', str(args.messages * 2)],
+        cwd=workdir,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_server(port)
+        results = [
+            run_mode(port, False, args, 0),
+            run_mode(port, True, args, args.clients),
+        ]
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'分帧':<8} {'编码':<10} {'送达数':>8} {'字节/条':>10} {'客户端CPU/条(µs)':>18} {'耗时(s)':>9}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['codec']:<10} {r['delivered']:>8} {r['bytes_per_message']:>10.1f} "
+              f"{r['client_cpu_us_per_message']:>18.2f} {r['wall_s']:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+HTTP 引擎对比基准
+分别以 asyncio 引擎和线程引擎（--engine threaded）启动 server_https.py，用多个进程模拟并发客户端：
+每个客户端收到响应后立即发出下一个请求（闭环），大部分为 GET /messages，按 --post-ratio 的比例发送
+POST /message，统计每秒请求数、延迟分位数以及服务器进程的 CPU、内存和线程数。
+--long-pollers 另外保持 N 个长轮询客户端（wait=25），模拟大量在线的轮询用户；每条新消息都会唤醒它们。
+--keep-alive 让每个客户端复用一个 HTTP/1.1 持久连接（服务器要求关闭时重新连接），默认每个请求新建连接。
+--conditional 让轮询带上次响应的 ETag（If-None-Match），没有新消息时服务器回 304。
+
+用法: python -m bench.http_engines [--concurrency 50 200 1000] [--duration 10] [--long-pollers 2000] [--keep-alive]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.loadgen import ServerProcesses, process_stats, raise_fd_limit, wait_for_port
+from bench.loops import loopback_address, percentile
+
+ENGINES = ('threaded', 'asyncio')
+
+
+class HTTPConnection:
+    """一个客户端的 HTTP 连接：keep_alive 时复用持久连接，否则每个请求新建连接（Connection: close）"""
+
+    def __init__(self, port, local_ip, keep_alive=False):
+        self.port = port
+        self.local_ip = local_ip
+        self.keep_alive = keep_alive
+        self.reader = None
+        self.writer = None
+        self.opened = 0  # 建立的连接数
+        self.etag = None  # 最近一个响应的 ETag
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method, path, data=None, if_none_match=None):
+        """发送一个 HTTP/1.1 请求，返回 (状态码, JSON 响应体)；复用的连接已被服务器关闭时重试一次"""
+        reused = self.writer is not None
+        try:
+            return await self._request(method, path, data, if_none_match)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            if not reused:
+                raise ConnectionError('连接被服务器关闭')
+        return await self._request(method, path, data, if_none_match)
+
+    async def _request(self, method, path, data, if_none_match):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                '127.0.0.1', self.port, local_addr=(self.local_ip, 0))
+            self.opened += 1
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        connection = '' if self.keep_alive else 'Connection: close\r\n'
+        if if_none_match:
+            connection += f"If-None-Match: {if_none_match}\r\n"
+        self.writer.write((
+            f"{method} {path} HTTP/1.1\r\n"
+            "Host: 127.0.0.1\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"{connection}"
+            "\r\n"
+        ).encode('ascii') + body)
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = dict(line.lower().split(': ', 1) for line in lines[1:] if ': ' in line)
+        raw = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        self.etag = headers.get('etag')
+        if not self.keep_alive or headers.get('connection') == 'close':
+            self.close()
+        try:
+            payload = json.loads(raw) if raw else {}
+        except ValueError:
+            payload = {}
+        return status, payload
+
+
+async def join(port, index):
+    status, payload = await HTTPConnection(port, loopback_address(index)).request(
+        'POST', f"/join?username=he_{index}")
+    if status != 200:
+        raise ConnectionError(f"加入失败: HTTP {status}")
+    return payload['session_id']
+
+
+async def active_client(port, index, session_id, start_at, end_at, post_ratio, keep_alive, conditional, result):
+    """闭环客户端：测量阶段内每个请求的延迟"""
+    conn = HTTPConnection(port, loopback_address(index), keep_alive)
+    since, etag = 0, None
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    while time.time() < end_at:
+        started = time.perf_counter()
+        try:
+            if random.random() < post_ratio:
+                status, _ = await conn.request('POST', '/message',
+                                               {'session_id': session_id, 'message': f"bench {index}"})
+            else:
+                status, payload = await conn.request(
+                    'GET', f"/messages?since={since}&session_id={session_id}",
+                    if_none_match=etag if conditional else None)
+                if status == 304:
+                    status = 200  # 没有新消息
+                else:
+                    since, etag = payload.get('total', since), conn.etag
+        except (OSError, asyncio.IncompleteReadError):
+            conn.close()
+            status = 0
+        if status == 200:
+            result['latencies'].append(time.perf_counter() - started)
+        else:
+            result['errors'] += 1
+            await asyncio.sleep(0.01)
+    conn.close()
+    result['connections'] += conn.opened
+
+
+async def long_poller(port, index, session_id, end_at, keep_alive, result):
+    """长轮询客户端：持续挂起 GET /messages?wait=25，直到测量结束"""
+    conn = HTTPConnection(port, loopback_address(index), keep_alive)
+    since = 0
+    while time.time() < end_at:
+        try:
+            status, payload = await asyncio.wait_for(conn.request(
+                'GET', f"/messages?since={since}&session_id={session_id}&wait=25"),
+                timeout=max(0.1, end_at - time.time()))
+        except asyncio.TimeoutError:
+            conn.close()
+            return
+        except (OSError, asyncio.IncompleteReadError):
+            conn.close()
+            status, payload = 0, {}
+        if status == 200:
+            since = payload.get('total', since)
+            result['long_polls'] += 1
+        else:
+            result['errors'] += 1
+            await asyncio.sleep(0.1)
+
+
+async def run_worker(port, first_index, active, pollers, start_at, end_at, post_ratio, keep_alive, conditional):
+    result = {'latencies': [], 'errors': 0, 'long_polls': 0, 'join_errors': 0, 'connections': 0}
+    semaphore = asyncio.Semaphore(50)  # 限制同时进行的加入请求
+
+    async def join_one(index):
+        async with semaphore:
+            try:
+                return await join(port, index)
+            except OSError:
+                result['join_errors'] += 1
+                return None
+
+    indexes = list(range(first_index, first_index + active + pollers))
+    sessions = await asyncio.gather(*(join_one(index) for index in indexes))
+    tasks = []
+    for i, (index, session_id) in enumerate(zip(indexes, sessions)):
+        if session_id is None:
+            continue
+        if i < active:
+            tasks.append(active_client(port, index, session_id, start_at, end_at, post_ratio, keep_alive, conditional,
+                                       result))
+        else:
+            tasks.append(long_poller(port, index, session_id, end_at, keep_alive, result))
+    await asyncio.gather(*tasks)
+    return result
+
+
+def worker(args):
+    return asyncio.run(run_worker(*args))
+
+
+def thread_count(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def run_engine(engine, args):
+    """对一个引擎依次运行各个并发级别"""
+    processes = ServerProcesses('https', ['--engine', engine])
+    port = processes.start()
+    pid = processes.pids()['server']
+    rows = []
+    try:
+        asyncio.run(wait_for_port('127.0.0.1', port, processes))
+        first_index = 0
+        for concurrency in args.concurrency:
+            procs = min(args.client_procs, concurrency)
+            # 所有客户端加入后同时开始测量
+            start_at = time.time() + args.ramp
+            end_at = start_at + args.duration
+            jobs = []
+            for p in range(procs):
+                active = concurrency // procs + (1 if p < concurrency % procs else 0)
+                pollers = args.long_pollers // procs + (1 if p < args.long_pollers % procs else 0)
+                jobs.append((port, first_index, active, pollers, start_at, end_at, args.post_ratio, args.keep_alive,
+                             args.conditional))
+                first_index += active + pollers
+            with multiprocessing.Pool(procs) as pool:
+                pending = pool.map_async(worker, jobs)
+                time.sleep(max(0.0, start_at - time.time()))
+                before = process_stats(pid)
+                time.sleep(args.duration / 2)
+                threads = thread_count(pid)
+                time.sleep(max(0.0, end_at - time.time()))
+                after = process_stats(pid)
+                results = pending.get()
+
+            latencies = [x for r in results for x in r['latencies']]
+            row = {
+                'engine': engine,
+                'concurrency': concurrency,
+                'long_pollers': args.long_pollers,
+                'requests': len(latencies),
+                'rps': len(latencies) / args.duration,
+                'errors': sum(r['errors'] + r['join_errors'] for r in results),
+                'long_polls': sum(r['long_polls'] for r in results),
+                'keep_alive': args.keep_alive,
+                'conditional': args.conditional,
+                'connections': sum(r['connections'] for r in results),
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': max(latencies, default=0) * 1000,
+                'threads': threads,
+            }
+            if before and after:
+                row['cpu_percent'] = (after['cpu_seconds'] - before['cpu_seconds']) / args.duration * 100
+                row['rss_mb'] = after['rss_kb'] / 1024
+            rows.append(row)
+            print(f"  {engine:<9} 并发 {concurrency:>5}: {row['rps']:>8.0f} 请求/秒  p99 {row['p99_ms']:>8.2f} ms  "
+                  f"错误 {row['errors']}", file=sys.stderr)
+    finally:
+        processes.stop()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NeoChat HTTP 引擎对比基准')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 1000], help='闭环客户端数')
+    parser.add_argument('--long-pollers', type=int, default=0, help='另外保持的长轮询客户端数 (默认 0)')
+    parser.add_argument('--duration', type=float, default=10, help='每个并发级别的测量秒数 (默认 10)')
+    parser.add_argument('--ramp', type=float, default=5, help='开始测量前留给客户端加入的秒数 (默认 5)')
+    parser.add_argument('--post-ratio', type=float, default=0.05, help='POST /message 占请求的比例 (默认 0.05)')
+    parser.add_argument('--client-procs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='运行客户端的进程数 (默认 CPU 核数的一半)')
+    parser.add_argument('--keep-alive', action='store_true', help='客户端复用 HTTP/1.1 持久连接 (默认每个请求新建连接)')
+    parser.add_argument('--conditional', action='store_true', help='轮询带 If-None-Match，没有新消息时得到 304')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    rows = []
+    for engine in args.engines:
+        rows.extend(run_engine(engine, args))
+
+    if args.json:
+        print(json.dumps(rows, indent=2, ensure_ascii=False))
+        return
+
+    print(f"{'引擎':<9} {'并发':>6} {'长轮询':>6} {'请求/秒':>9} {'p50(ms)':>9} {'p99(ms)':>9} {'错误':>6} "
+          f"{'CPU%':>6} {'RSS(MB)':>8} {'线程':>6} {'连接数':>7}")
+    for r in rows:
+        print(f"{r['engine']:<9} {r['concurrency']:>6} {r['long_pollers']:>6} {r['rps']:>9.0f} {r['p50_ms']:>9.2f} "
+              f"{r['p99_ms']:>9.2f} {r['errors']:>6} {r.get('cpu_percent', 0):>6.0f} {r.get('rss_mb', 0):>8.1f} "
+              f"{r['threads']:>6} {r['connections']:>7}")
+
+
+if __name__ == '__main__':
+    main()
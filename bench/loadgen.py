@@ -0,0 +1,762 @@
+"""
+NeoChat 负载生成器
+用 asyncio 模拟成百上千个客户端连接各个服务器，按设定的速率发送消息，并按设定的频率断开、重新加入，
+统计吞吐量、端到端投递延迟分位数（从发送到每个接收者收到）以及服务器进程的 CPU 和内存。
+每次运行的结果以 JSON 追加到 --output 文件（每行一次），便于对比不同版本。
+
+目标（--target）:
+    tcp       server_tcp.py，换行分隔的 JSON
+    tcp-ws    server_tcp.py，同一端口上的 WebSocket
+    tcp-poll  server_tcp.py，同一端口上的 HTTP 轮询接口
+    ws        server_ws.py（需要 websockets）
+    https     server_https.py，HTTP 轮询
+    https-sse server_https.py，SSE 推送（GET /stream）
+    bridge    bridge_server.py（WebSocket）→ server_tcp.py（需要 websockets）
+
+用法:
+    python -m bench.loadgen --target tcp --clients 1000 --rate 200 --duration 30 --output results.jsonl
+    python -m bench.loadgen --target https --clients 200 --rate 20 --poll-interval 0.5
+    python -m bench.loadgen --target https --clients 200 --rate 20 --poll-wait 25     # 长轮询
+    python -m bench.loadgen --target tcp --connect 10.0.0.5:9999 --server-pid 1234   # 测试已在运行的服务器
+    python -m bench.loadgen --report results.jsonl                                    # 列出历次结果
+
+每个模拟客户端使用不同的回环地址（127.0.x.y，服务器按 IP 去重连接），需要 Linux；
+客户端较多时先调高文件描述符上限（ulimit -n）。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import random
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.loops import free_port, loopback_address
+from chat_metrics import HdrHistogram
+from chat_websocket import OP_CLOSE, OP_PING, OP_PONG, OP_TEXT, unmask
+
+TARGETS = ('tcp', 'tcp-ws', 'tcp-poll', 'ws', 'https', 'https-sse', 'bridge')
+
+# 负载消息的文本为 "lg#<编号>"，接收端在原始数据中查找编号，无需解析每条消息
+MARK = 'lg#'
+MARK_PATTERN = re.compile(rb'lg#(\d+)')
+
+
+class LoadStats:
+    """一次运行中所有客户端共享的统计"""
+
+    def __init__(self):
+        self.sent_at = []  # 消息编号 -> 发送时间（perf_counter）
+        self.sender = []  # 消息编号 -> 发送者编号
+        self.latency = HdrHistogram()
+        self.delivered = 0
+        self.first_send = None
+        self.last_delivery = None
+        self.connect_failures = 0
+        self.send_errors = 0
+        self.disconnects = 0  # 非主动断开的连接数
+        self.joins = 0
+        self.leaves = 0
+
+    def new_message(self, sender):
+        now = time.perf_counter()
+        if self.first_send is None:
+            self.first_send = now
+        self.sent_at.append(now)
+        self.sender.append(sender)
+        return len(self.sent_at) - 1
+
+    def received(self, client, data):
+        """在收到的原始数据中查找负载消息并记录延迟"""
+        now = time.perf_counter()
+        for match in MARK_PATTERN.finditer(data):
+            seq = int(match.group(1))
+            if seq >= len(self.sent_at) or self.sender[seq] == client.index:
+                continue
+            sent = self.sent_at[seq]
+            if sent < client.joined_at:
+                continue  # 加入前发送的消息（历史补发或轮询返回的旧消息）
+            self.latency.observe(now - sent)
+            self.delivered += 1
+            self.last_delivery = now
+
+
+class SimClient:
+    """模拟客户端的公共部分"""
+
+    def __init__(self, index, host, port, stats, room=None):
+        self.index = index
+        self.name = f"lg_{index}"
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.room = room
+        self.joined_at = float('inf')
+        self.closing = False
+        self.task = None
+
+    async def join(self):
+        await self.connect()
+        if self.room:
+            await self.send_text(f"/join {self.room}")
+        self.joined_at = time.perf_counter()
+        self.stats.joins += 1
+
+    async def send(self):
+        """发送一条负载消息"""
+        seq = self.stats.new_message(self.index)
+        try:
+            await self.send_text(f"{MARK}{seq}")
+        except Exception:
+            self.stats.send_errors += 1
+
+    async def leave(self):
+        self.closing = True
+        self.stats.leaves += 1
+        await self.close()
+
+    def _reader_done(self, task):
+        if task.cancelled():
+            return
+        task.exception()  # 连接被重置等异常同样视为断开
+        if not self.closing:
+            self.stats.disconnects += 1
+
+
+class LineClient(SimClient):
+    """server_tcp.py 的原始 TCP 客户端：第一行为用户名，之后每行一条消息"""
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, local_addr=(loopback_address(self.index), 0), limit=1024 * 1024)
+        self.writer.write(f"{self.name}\n".encode('utf-8'))
+        await self.writer.drain()
+        self.task = asyncio.create_task(self._read_loop())
+        self.task.add_done_callback(self._reader_done)
+
+    async def _read_loop(self):
+        reader = self.reader
+        stats = self.stats
+        tail = b''
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            # 只检查完整的行，避免编号被拆在两次读取之间
+            data = tail + data
+            end = data.rfind(b'\n') + 1
+            tail = data[end:]
+            if b'lg#' in data[:end]:
+                stats.received(self, data[:end])
+
+    async def send_text(self, text):
+        self.writer.write(f"{text}\n".encode('utf-8'))
+        await self.writer.drain()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        self.writer.close()
+
+
+class WebSocketClient(SimClient):
+    """WebSocket 客户端（RFC 6455，客户端帧加掩码）：第一条消息为用户名"""
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, local_addr=(loopback_address(self.index), 0), limit=1024 * 1024)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        self.writer.write((
+            "GET / HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "\r\n"
+        ).encode('ascii'))
+        await self.writer.drain()
+        status_line = (await self.reader.readuntil(b'\r\n\r\n')).split(b'\r\n', 1)[0]
+        if b' 101 ' not in status_line:
+            raise ConnectionError(f"WebSocket 握手失败: {status_line!r}")
+        await self.send_text(self.name)
+        self.task = asyncio.create_task(self._read_loop())
+        self.task.add_done_callback(self._reader_done)
+
+    def _frame(self, payload, opcode=OP_TEXT):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        return header + mask + unmask(payload, mask)
+
+    async def _read_loop(self):
+        reader = self.reader
+        stats = self.stats
+        while True:
+            head = await reader.readexactly(2)
+            opcode = head[0] & 0x0F
+            length = head[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await reader.readexactly(8))[0]
+            payload = await reader.readexactly(length) if length else b''
+            if opcode == OP_CLOSE:
+                return
+            if opcode == OP_PING:
+                self.writer.write(self._frame(payload, OP_PONG))
+            elif b'lg#' in payload:
+                stats.received(self, payload)
+
+    async def send_text(self, text):
+        self.writer.write(self._frame(text.encode('utf-8')))
+        await self.writer.drain()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        try:
+            self.writer.write(self._frame(struct.pack('!H', 1000), OP_CLOSE))
+        except Exception:
+            pass
+        self.writer.close()
+
+
+class PollClient(SimClient):
+    """HTTP 轮询客户端（server_https.py / server_tcp.py 的 /join、/messages、/message、/leave）"""
+
+    def __init__(self, index, host, port, stats, room=None, poll_interval=0.5, poll_wait=0):
+        super().__init__(index, host, port, stats, room=None)  # 轮询接口只使用默认房间
+        self.poll_interval = poll_interval
+        self.poll_wait = poll_wait  # 大于 0 时使用长轮询（GET /messages?wait=N），两次轮询之间不再等待
+        self.session_id = None
+        self.since = None
+
+    async def request(self, method, path, data=None):
+        """发送一个 HTTP/1.1 请求（Connection: close），返回 (状态码, JSON 响应体, 原始响应体)"""
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, local_addr=(loopback_address(self.index), 0))
+        try:
+            body = json.dumps(data).encode('utf-8') if data is not None else b''
+            writer.write((
+                f"{method} {path} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n"
+                "\r\n"
+            ).encode('ascii') + body)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, raw = response.partition(b'\r\n\r\n')
+        status = int(head.split(b' ', 2)[1]) if head else 0
+        try:
+            payload = json.loads(raw) if raw else {}
+        except ValueError:
+            payload = {}
+        return status, payload, raw
+
+    async def connect(self):
+        status, payload, _ = await self.request('POST', f"/join?username={urllib.parse.quote(self.name)}")
+        if status != 200 or not payload.get('session_id'):
+            raise ConnectionError(f"加入失败: HTTP {status}")
+        self.session_id = payload['session_id']
+        # 第一次轮询只取得当前最新序号
+        status, payload, _ = await self.request('GET', f"/messages?since=0&session_id={self.session_id}")
+        self.since = payload.get('total', 0)
+        self.task = asyncio.create_task(self._poll_loop())
+        self.task.add_done_callback(self._reader_done)
+
+    async def _poll_loop(self):
+        stats = self.stats
+        # 错开各客户端的轮询时刻
+        await asyncio.sleep(random.random() * self.poll_interval)
+        query = f"&wait={self.poll_wait}" if self.poll_wait else ''
+        while True:
+            status, payload, raw = await self.request(
+                'GET', f"/messages?since={self.since}&session_id={self.session_id}{query}")
+            if status != 200:
+                return
+            self.since = payload.get('total', self.since)
+            if b'lg#' in raw:
+                stats.received(self, raw)
+            if not payload.get('wait'):
+                await asyncio.sleep(self.poll_interval)
+
+    async def send_text(self, text):
+        status, _, _ = await self.request('POST', '/message', {'session_id': self.session_id, 'message': text})
+        if status != 200:
+            raise ConnectionError(f"HTTP {status}")
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        try:
+            await self.request('POST', '/leave', {'session_id': self.session_id})
+        except Exception:
+            pass
+
+
+class SSEClient(PollClient):
+    """server_https.py 的 SSE 推送客户端：加入后保持一个 GET /stream 响应接收消息，通过 POST /message 发送"""
+
+    async def connect(self):
+        status, payload, _ = await self.request('POST', f"/join?username={urllib.parse.quote(self.name)}")
+        if status != 200 or not payload.get('session_id'):
+            raise ConnectionError(f"加入失败: HTTP {status}")
+        self.session_id = payload['session_id']
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, local_addr=(loopback_address(self.index), 0), limit=1024 * 1024)
+        self.writer.write((
+            f"GET /stream?session_id={self.session_id} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Accept: text/event-stream\r\n"
+            "\r\n"
+        ).encode('ascii'))
+        await self.writer.drain()
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        status_line = head.split(b'\r\n', 1)[0].decode('latin-1')
+        if ' 200 ' not in status_line:
+            raise ConnectionError(f"推送连接失败: {status_line}")
+        self.task = asyncio.create_task(LineClient._read_loop(self))
+        self.task.add_done_callback(self._reader_done)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        self.writer.close()
+        try:
+            await self.request('POST', '/leave', {'session_id': self.session_id})
+        except Exception:
+            pass
+
+
+CLIENT_CLASSES = {
+    'tcp': LineClient,
+    'tcp-ws': WebSocketClient,
+    'tcp-poll': PollClient,
+    'ws': WebSocketClient,
+    'https': PollClient,
+    'https-sse': SSEClient,
+    'bridge': WebSocketClient,
+}
+
+
+def process_stats(pid):
+    """从 /proc 读取进程的 CPU 时间（秒）、RSS 和峰值 RSS（KB）；非 Linux 或进程不存在时返回 None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {
+        'cpu_seconds': (int(fields[11]) + int(fields[12])) / ticks,  # utime + stime
+        'rss_kb': int(status.get('VmRSS', '0 kB').split()[0]),
+        'peak_rss_kb': int(status.get('VmHWM', '0 kB').split()[0]),
+    }
+
+
+def raise_fd_limit():
+    """把本进程（以及随后启动的服务器进程）的文件描述符软上限调到硬上限"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class ServerProcesses:
+    """为目标启动所需的服务器进程（在临时目录中运行，输出写入 server.log）"""
+
+    def __init__(self, target, server_args=()):
+        self.target = target
+        self.server_args = list(server_args)
+        self.workdir = tempfile.mkdtemp(prefix='neochat_loadgen_')
+        self.processes = {}  # {名称: Popen}
+        self.port = None
+
+    def _spawn(self, name, argv):
+        log = open(os.path.join(self.workdir, f"{name}.log"), 'wb')
+        self.processes[name] = subprocess.Popen(
+            [sys.executable] + argv, cwd=self.workdir,
+            stdin=subprocess.PIPE,  # 保持控制台的标准输入打开
+            stdout=log, stderr=subprocess.STDOUT)
+
+    def start(self):
+        quiet = ['--log-level', 'warning']
+        if self.target in ('tcp', 'tcp-ws', 'tcp-poll'):
+            self.port = free_port()
+            self._spawn('server', [os.path.join(ROOT, 'server_tcp.py'), str(self.port)] + quiet + self.server_args)
+        elif self.target == 'ws':
+            self.port = free_port()
+            self._spawn('server', [os.path.join(ROOT, 'server_ws.py'), str(self.port)] + quiet + self.server_args)
+        elif self.target in ('https', 'https-sse'):
+            self.port = free_port()
+            self._spawn('server', [os.path.join(ROOT, 'server_https.py'), str(self.port)] + quiet + self.server_args)
+        elif self.target == 'bridge':
+            # 所有桥接连接来自同一 IP，TCP 服务器需要允许同一 IP 的多个连接
+            tcp_port = free_port()
+            self.port = free_port()
+            self._spawn('server', [os.path.join(ROOT, 'server_tcp.py'), str(tcp_port), '--allow-same-ip']
+                        + quiet + self.server_args)
+            with open(os.path.join(self.workdir, 'bridge_config.json'), 'w', encoding='utf-8') as f:
+                json.dump({'tcp_host': '127.0.0.1', 'tcp_port': tcp_port, 'ws_host': '127.0.0.1',
+                           'ws_port': self.port, 'log_level': 'warning'}, f)
+            self._spawn('bridge', [os.path.join(ROOT, 'bridge_server.py')])
+        return self.port
+
+    def check(self):
+        """有进程已退出时抛出异常（附带其输出的最后几行）"""
+        for name, process in self.processes.items():
+            if process.poll() is not None:
+                with open(os.path.join(self.workdir, f"{name}.log"), 'rb') as f:
+                    tail = f.read().decode('utf-8', 'replace').strip().splitlines()[-5:]
+                raise RuntimeError(f"{name} 进程已退出（返回码 {process.returncode}）:\n  " + '\n  '.join(tail))
+
+    def pids(self):
+        return {name: process.pid for name, process in self.processes.items()}
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def wait_for_port(host, port, processes=None, timeout=15.0):
+    """等待服务器开始监听"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if processes:
+            processes.check()
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('服务器启动超时')
+
+
+class LoadGenerator:
+    def __init__(self, args, host, port):
+        self.args = args
+        self.host = host
+        self.port = port
+        self.stats = LoadStats()
+        self.client_class = CLIENT_CLASSES[args.target]
+        self.clients = []  # 在线的客户端
+        self.next_index = 0
+        self.churn_ops = 0
+
+    def new_client(self):
+        index = self.next_index
+        self.next_index += 1
+        room = f"room{index % self.args.rooms}" if self.args.rooms > 1 else None
+        if issubclass(self.client_class, PollClient):
+            return self.client_class(index, self.host, self.port, self.stats,
+                              poll_interval=self.args.poll_interval, poll_wait=self.args.poll_wait)
+        return self.client_class(index, self.host, self.port, self.stats, room=room)
+
+    async def join_one(self, semaphore):
+        client = self.new_client()
+        async with semaphore:
+            try:
+                await asyncio.wait_for(client.join(), timeout=30)
+            except Exception:
+                self.stats.connect_failures += 1
+                return None
+        self.clients.append(client)
+        return client
+
+    async def ramp_up(self):
+        """建立全部连接，返回耗时（秒）"""
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+        started = time.perf_counter()
+        tasks = []
+        interval = 1.0 / self.args.connect_rate if self.args.connect_rate > 0 else 0
+        for _ in range(self.args.clients):
+            tasks.append(asyncio.create_task(self.join_one(semaphore)))
+            if interval:
+                await asyncio.sleep(interval)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    async def send_loop(self, deadline):
+        """开环发送：按固定间隔发送，落后时立即补发（不等待响应）"""
+        rate = self.args.rate
+        if rate <= 0:
+            return
+        senders = self.args.senders
+        started = time.perf_counter()
+        count = 0
+        pending = set()
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            due = started + count / rate
+            if due > now:
+                await asyncio.sleep(due - now)
+                continue
+            pool = self.clients[:senders] if senders else self.clients
+            if pool:
+                task = asyncio.create_task(random.choice(pool).send())
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            count += 1
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def churn_loop(self, deadline):
+        """按设定频率让随机客户端离开，并立即以新身份加入"""
+        rate = self.args.churn
+        if rate <= 0:
+            return
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+        while time.perf_counter() + 1.0 / rate < deadline:
+            await asyncio.sleep(random.expovariate(rate))
+            senders = self.args.senders
+            candidates = self.clients[senders:] if senders else self.clients
+            if not candidates:
+                continue
+            client = random.choice(candidates)
+            self.clients.remove(client)
+            asyncio.create_task(client.leave())
+            asyncio.create_task(self.join_one(semaphore))
+            self.churn_ops += 1
+
+    async def run(self, server_pids):
+        args = self.args
+        connect_seconds = await self.ramp_up()
+        await asyncio.sleep(args.warmup)
+
+        before = {name: process_stats(pid) for name, pid in server_pids.items()}
+        self_before = time.process_time()
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(self.send_loop(deadline), self.churn_loop(deadline))
+        sent_done = time.perf_counter()
+
+        # 等待在途消息送达：送达数在 drain 秒内不再增加即结束
+        last = -1
+        while self.stats.delivered != last and time.perf_counter() - sent_done < args.drain:
+            last = self.stats.delivered
+            await asyncio.sleep(max(0.5, args.poll_interval if self.client_class is PollClient else 0))
+        finished = time.perf_counter()
+        after = {name: process_stats(pid) for name, pid in server_pids.items()}
+        self_cpu = time.process_time() - self_before
+
+        for client in list(self.clients):
+            client.closing = True
+        await asyncio.gather(*(client.close() for client in self.clients), return_exceptions=True)
+
+        return self.result(connect_seconds, started, sent_done, finished, before, after, self_cpu)
+
+    def result(self, connect_seconds, started, sent_done, finished, before, after, self_cpu):
+        args = self.args
+        stats = self.stats
+        latency = stats.latency
+        quantiles = latency.percentiles()
+        active = (stats.last_delivery or sent_done) - started
+        wall = finished - started
+
+        servers = {}
+        for name in after:
+            if before.get(name) and after.get(name):
+                cpu = after[name]['cpu_seconds'] - before[name]['cpu_seconds']
+                servers[name] = {
+                    'cpu_seconds': round(cpu, 3),
+                    'cpu_percent': round(cpu / wall * 100, 1),
+                    'rss_mb': round(after[name]['rss_kb'] / 1024, 1),
+                    'peak_rss_mb': round(after[name]['peak_rss_kb'] / 1024, 1),
+                }
+            else:
+                servers[name] = None
+
+        return {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target': args.target,
+            'clients': args.clients,
+            'rate': args.rate,
+            'senders': args.senders,
+            'churn': args.churn,
+            'rooms': args.rooms,
+            'duration': args.duration,
+            'poll_wait': args.poll_wait,
+            'server_args': args.server_arg or [],
+            'connected': len(self.clients),
+            'connect_failures': stats.connect_failures,
+            'connect_seconds': round(connect_seconds, 3),
+            'sent': len(stats.sent_at),
+            'send_errors': stats.send_errors,
+            'delivered': stats.delivered,
+            'disconnects': stats.disconnects,
+            'churn_ops': self.churn_ops,
+            'messages_per_sec': round(len(stats.sent_at) / (sent_done - started), 1),
+            'deliveries_per_sec': round(stats.delivered / active, 1) if active > 0 else 0.0,
+            'latency_ms': {
+                'p50': round(quantiles[0.5] * 1000, 3),
+                'p95': round(quantiles[0.95] * 1000, 3),
+                'p99': round(quantiles[0.99] * 1000, 3),
+                'p999': round(quantiles[0.999] * 1000, 3),
+                'max': round(latency.max * 1000, 3),
+                'mean': round(latency.sum / latency.count * 1000, 3) if latency.count else 0.0,
+            },
+            'server': servers,
+            'loadgen_cpu_percent': round(self_cpu / wall * 100, 1),
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def print_result(r):
+    print("─" * 60)
+    print(f"目标: {r['target']} | 客户端 {r['connected']}/{r['clients']}（连接失败 {r['connect_failures']}，"
+          f"建立连接 {r['connect_seconds']:.1f} s）")
+    print(f"发送: {r['sent']} 条（{r['messages_per_sec']:.0f} 条/秒，错误 {r['send_errors']}）| "
+          f"断开/重连 {r['churn_ops']} 次 | 意外断开 {r['disconnects']}")
+    print(f"送达: {r['delivered']} 次（{r['deliveries_per_sec']:.0f} 次/秒）")
+    lat = r['latency_ms']
+    print(f"延迟(ms): p50 {lat['p50']:.2f}  p95 {lat['p95']:.2f}  p99 {lat['p99']:.2f}  "
+          f"p999 {lat['p999']:.2f}  max {lat['max']:.2f}")
+    for name, s in r['server'].items():
+        if s:
+            print(f"{name} 进程: CPU {s['cpu_percent']:.0f}% ({s['cpu_seconds']:.2f} s) | "
+                  f"RSS {s['rss_mb']:.1f} MB（峰值 {s['peak_rss_mb']:.1f} MB）")
+        else:
+            print(f"{name} 进程: 无法读取（需要 Linux /proc）")
+    print(f"负载生成器 CPU: {r['loadgen_cpu_percent']:.0f}%"
+          + ("（接近单核上限，结果可能受客户端限制）" if r['loadgen_cpu_percent'] > 90 else ""))
+    print("─" * 60)
+
+
+def print_report(path):
+    """列出结果文件中的历次运行"""
+    with open(path, encoding='utf-8') as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    print(f"{'时间':<20} {'版本':<9} {'目标':<9} {'客户端':>7} {'送达/秒':>10} "
+          f"{'p50(ms)':>9} {'p99(ms)':>9} {'CPU%':>6} {'RSS(MB)':>8}")
+    for r in results:
+        server = r['server'].get('server') or {}
+        print(f"{r['time']:<20} {r.get('git') or '-':<9} {r['target']:<9} {r['connected']:>7} "
+              f"{r['deliveries_per_sec']:>10.0f} {r['latency_ms']['p50']:>9.2f} {r['latency_ms']['p99']:>9.2f} "
+              f"{server.get('cpu_percent', 0):>6.0f} {server.get('rss_mb', 0):>8.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NeoChat 负载生成器')
+    parser.add_argument('--target', choices=TARGETS, default='tcp', help='被测服务器和协议 (默认 tcp)')
+    parser.add_argument('--clients', type=int, default=200, help='模拟客户端数量 (默认 200)')
+    parser.add_argument('--rate', type=float, default=50, help='所有客户端合计每秒发送的消息数 (默认 50)')
+    parser.add_argument('--senders', type=int, default=0, help='只由前 N 个客户端发送消息，0 表示随机选择任意客户端 (默认 0)')
+    parser.add_argument('--churn', type=float, default=0, help='每秒断开并以新身份重新加入的客户端数 (默认 0)')
+    parser.add_argument('--rooms', type=int, default=1, help='把客户端平均分到 N 个房间（tcp、tcp-ws、bridge）(默认 1)')
+    parser.add_argument('--duration', type=float, default=20, help='发送阶段的秒数 (默认 20)')
+    parser.add_argument('--warmup', type=float, default=1, help='连接建立后、开始发送前等待的秒数 (默认 1)')
+    parser.add_argument('--drain', type=float, default=10, help='发送结束后最多等待在途消息的秒数 (默认 10)')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='轮询目标的轮询间隔（秒）(默认 0.5)')
+    parser.add_argument('--poll-wait', type=float, default=0,
+                        help='轮询目标使用长轮询，每次请求最多挂起的秒数；0 表示普通轮询 (默认 0)')
+    parser.add_argument('--connect-rate', type=float, default=0, help='每秒建立的连接数，0 表示不限 (默认 0)')
+    parser.add_argument('--connect-concurrency', type=int, default=100, help='同时进行的连接握手数 (默认 100)')
+    parser.add_argument('--connect', metavar='HOST:PORT', help='测试已在运行的服务器，不自动启动')
+    parser.add_argument('--server-pid', type=int, action='append', default=[],
+                        help='配合 --connect 统计这些进程的 CPU 和内存（可重复）')
+    parser.add_argument('--server-arg', action='append', metavar='ARG',
+                        help='传给自动启动的服务器的额外参数（可重复，例如 --server-arg=--coalesce-ms=20）')
+    parser.add_argument('--output', help='把结果以 JSON 追加到此文件（每次运行一行）')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    parser.add_argument('--report', metavar='FILE', help='列出结果文件中的历次运行后退出')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.report:
+        print_report(args.report)
+        return
+
+    fd_limit = raise_fd_limit()
+    needed = args.clients * (2 if args.target in ('https', 'https-sse', 'tcp-poll') else 1) + 64
+    if fd_limit and fd_limit < needed:
+        print(f"⚠ 文件描述符上限 {fd_limit} 可能不足以支撑 {args.clients} 个客户端，请先调高 ulimit -n")
+
+    processes = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+        host, port = host or '127.0.0.1', int(port)
+        server_pids = {f"pid{pid}": pid for pid in args.server_pid}
+    else:
+        processes = ServerProcesses(args.target, args.server_arg or [])
+        host, port = '127.0.0.1', processes.start()
+        server_pids = processes.pids()
+
+    try:
+        async def run():
+            await wait_for_port(host, port, processes)
+            generator = LoadGenerator(args, host, port)
+            return await generator.run(server_pids)
+
+        result = asyncio.run(run())
+        if processes:
+            processes.check()
+    except RuntimeError as e:
+        print(f"✗ {e}")
+        sys.exit(1)
+    finally:
+        if processes:
+            processes.stop()
+
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        print_result(result)
+
+
+if __name__ == '__main__':
+    main()
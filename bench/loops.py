@@ -0,0 +1,180 @@
+"""
+事件循环对比基准
+分别以标准 asyncio 和 uvloop 启动 server_tcp.py，连接若干模拟客户端，
+由一个客户端持续发送消息，统计每秒送达消息数和 p99 扇出延迟
+（从发送到最后一个接收者收到的时间）。
+
+用法: python -m bench.loops [--clients 200] [--messages 500] [--rate 200]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from event_loop import resolve_loop
+
+
+def free_port():
+    """获取一个空闲端口"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def loopback_address(index):
+    """为第 index 个客户端分配不同的回环地址（服务器按 IP 去重连接）"""
+    index += 2
+    return f"127.0.{index // 250}.{index % 250 + 1}"
+
+
+def percentile(values, p):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+async def wait_for_port(port, timeout=10.0):
+    """等待服务器开始监听"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port, local_addr=('127.0.0.254', 0))
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('服务器启动超时')
+
+
+async def run_load(port, clients, messages, rate):
+    """连接客户端并发送消息，返回 (送达数, 耗时, 扇出延迟列表)"""
+    receivers = clients - 1
+    sent_at = {}
+    remaining = {}
+    last_arrival = {}
+    done = asyncio.Event()
+
+    async def reader_loop(reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            text = json.loads(line).get('message', '')
+            if not text.startswith('bench '):
+                continue
+            seq = int(text.split()[1])
+            last_arrival[seq] = time.perf_counter()
+            remaining[seq] -= 1
+            if remaining[seq] == 0 and len(last_arrival) == messages and all(v == 0 for v in remaining.values()):
+                done.set()
+
+    connections = []
+    for i in range(clients):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port, local_addr=(loopback_address(i), 0))
+        writer.write(f"bench_{i}\n".encode('utf-8'))
+        await writer.drain()
+        await reader.readline()  # 欢迎消息
+        connections.append((reader, writer))
+
+    await asyncio.sleep(0.5)  # 等待加入消息广播完毕
+    tasks = [asyncio.create_task(reader_loop(reader)) for reader, _ in connections[1:]]
+
+    sender = connections[0][1]
+    interval = 1.0 / rate if rate > 0 else 0
+    start = time.perf_counter()
+    for seq in range(messages):
+        remaining[seq] = receivers
+        sent_at[seq] = time.perf_counter()
+        sender.write(f"bench {seq}\n".encode('utf-8'))
+        await sender.drain()
+        if interval:
+            await asyncio.sleep(interval)
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout=60)
+    except asyncio.TimeoutError:
+        print("⚠ 部分消息未在 60 秒内送达")
+
+    elapsed = max(last_arrival.values(), default=start) - start
+    latencies = [last_arrival[seq] - sent_at[seq] for seq in last_arrival if remaining[seq] == 0]
+    delivered = sum(receivers - remaining[seq] for seq in remaining)
+
+    for task in tasks:
+        task.cancel()
+    for _, writer in connections:
+        writer.close()
+    return delivered, elapsed, latencies
+
+
+def bench_loop(loop_name, args):
+    """以指定事件循环启动服务器并运行一轮负载"""
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix='neochat_bench_')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server_tcp.py'), str(port), '--loop', loop_name],
+        cwd=workdir,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        async def run():
+            await wait_for_port(port)
+            return await run_load(port, args.clients, args.messages, args.rate)
+
+        delivered, elapsed, latencies = asyncio.run(run())
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'loop': loop_name,
+        'clients': args.clients,
+        'messages': args.messages,
+        'delivered': delivered,
+        'messages_per_sec': delivered / elapsed if elapsed > 0 else 0.0,
+        'fanout_p50_ms': percentile(latencies, 50) * 1000,
+        'fanout_p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NeoChat 事件循环对比基准')
+    parser.add_argument('--clients', type=int, default=200, help='模拟客户端数量')
+    parser.add_argument('--messages', type=int, default=500, help='发送的消息数')
+    parser.add_argument('--rate', type=float, default=200, help='每秒发送消息数，0 表示不限速')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+
+    loops = ['asyncio']
+    if resolve_loop('auto')[1] == 'uvloop':
+        loops.append('uvloop')
+    else:
+        print("⚠ 未安装 uvloop，仅测试标准 asyncio 事件循环")
+
+    results = [bench_loop(loop_name, args) for loop_name in loops]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'事件循环':<10} {'送达数':>10} {'消息/秒':>12} {'p50 扇出(ms)':>14} {'p99 扇出(ms)':>14}")
+    for r in results:
+        print(f"{r['loop']:<10} {r['delivered']:>10} {r['messages_per_sec']:>12.0f} "
+              f"{r['fanout_p50_ms']:>14.2f} {r['fanout_p99_ms']:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+运行指标开销基准
+1. 单次指标更新的耗时：普通整数加法、Counter.inc、Histogram.observe，以及加锁版本（server_https.py 使用）
+2. TCP 广播在开启 / 关闭指标（包括投递延迟记录）时每条送达消息消耗的 CPU 时间
+
+用法: python -m bench.metrics_overhead [--recipients 100 1000] [--messages 200] [--repeat 5]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_metrics import MetricsRegistry
+from server_tcp import DEFAULT_LATENCY_SAMPLE, ClientOutbox, Session, TCPChatServer
+from bench.fanout import CountingWriter
+
+
+class Box:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+
+def micro(number=1000000):
+    """每次操作的纳秒数"""
+    plain = Box()
+    registry = MetricsRegistry()
+    locked = MetricsRegistry(thread_safe=True)
+    disabled = MetricsRegistry(enabled=False)
+    cases = [
+        ('int += 1', 'box.value += 1', {'box': plain}),
+        ('Counter.inc()', 'c.inc()', {'c': registry.counter('c', '')}),
+        ('Counter.inc() 加锁', 'c.inc()', {'c': locked.counter('c', '')}),
+        ('Counter.inc() 关闭', 'c.inc()', {'c': disabled.counter('c', '')}),
+        ('Histogram.observe()', 'h.observe(0.0003)', {'h': registry.histogram('h', '')}),
+        ('Histogram.observe() 加锁', 'h.observe(0.0003)', {'h': locked.histogram('h', '')}),
+        ('perf_counter() x2 + observe()', 'h.observe(perf_counter() - perf_counter())',
+         {'h': registry.histogram('h2', ''), 'perf_counter': time.perf_counter}),
+        ('HdrHistogram.observe()', 'h.observe(0.0003)', {'h': registry.summary('s', '')}),
+    ]
+    results = []
+    for name, stmt, env in cases:
+        best = min(timeit.repeat(stmt, globals=env, number=number, repeat=3))
+        results.append({'case': name, 'ns_per_op': best / number * 1e9})
+    return results
+
+
+async def run_broadcast(recipients, messages, metrics, latency_sample=DEFAULT_LATENCY_SAMPLE):
+    """对指定接收者数量运行一轮广播，返回每条送达消息的 CPU 微秒数"""
+    server = TCPChatServer(port=0, queue_size=max(1024, messages), metrics=metrics, latency_sample=latency_sample)
+    server.log = lambda message, level='INFO', **fields: None
+
+    for i in range(recipients):
+        writer = CountingWriter()
+        session = Session(writer, f"bench:{i}", f"bench-{i}")
+        session.username = f"user_{i}"
+        session.outbox = ClientOutbox(server, writer, maxsize=server.queue_size, name=session.username)
+        server.sessions.add(session)
+
+    payload = {
+        'type': 'message',
+        'time': server.get_time(),
+        'username': 'bench',
+        'message': '你好，NeoChat！这是一条用于指标开销基准测试的中文消息。'
+    }
+
+    start_cpu = time.process_time()
+    for _ in range(messages):
+        await server.broadcast(payload, received=time.perf_counter())  # 开启指标时同时记录投递延迟
+        await asyncio.sleep(0)
+    outboxes = [session.outbox for session in server.sessions]
+    await asyncio.gather(*(outbox.flush(timeout=60) for outbox in outboxes))
+    cpu = time.process_time() - start_cpu
+
+    for outbox in outboxes:
+        outbox.stop()
+    server.is_running = False
+    return cpu / (recipients * messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NeoChat 运行指标开销基准')
+    parser.add_argument('--recipients', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--messages', type=int, default=200, help='每轮广播的消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='每种配置重复的轮数（取最小值）')
+    parser.add_argument('--latency-sample', type=int, default=DEFAULT_LATENCY_SAMPLE,
+                        help=f'开启指标时逐接收者写出延迟的采样间隔 (默认 {DEFAULT_LATENCY_SAMPLE})')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+
+    # TCPChatServer 会在当前目录创建 chat_logs，基准测试在临时目录中进行
+    os.chdir(tempfile.mkdtemp(prefix='neochat_bench_'))
+
+    micro_results = micro()
+    broadcast_results = []
+    for recipients in args.recipients:
+        row = {'recipients': recipients}
+        # 交替运行两种配置，减少 CPU 频率变化带来的偏差
+        for _ in range(args.repeat):
+            for metrics in (False, True):
+                key = 'on' if metrics else 'off'
+                cost = asyncio.run(run_broadcast(recipients, args.messages, metrics, args.latency_sample))
+                row[key] = min(row.get(key, cost), cost)
+        row['overhead_pct'] = (row['on'] - row['off']) / row['off'] * 100
+        broadcast_results.append(row)
+
+    if args.json:
+        print(json.dumps({'micro': micro_results, 'broadcast': broadcast_results}, indent=2, ensure_ascii=False))
+        return
+
+    print(f"{'操作':<32} {'ns/次':>8}")
+    for r in micro_results:
+        print(f"{r['case']:<32} {r['ns_per_op']:>8.1f}")
+    print()
+    print(f"{'接收者':>8} {'关闭(µs/送达)':>14} {'开启(µs/送达)':>14} {'开销':>8}")
+    for r in broadcast_results:
+        print(f"{r['recipients']:>8} {r['off']:>14.3f} {r['on']:>14.3f} {r['overhead_pct']:>7.1f}%")
+
+
+if __name__ == '__main__':
+    main()
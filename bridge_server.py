@@ -11,12 +11,33 @@ import logging
 import sys
 import os
 
+import event_loop
+import chat_logging
+from chat_metrics import MetricsRegistry, serve_metrics
+
 class WSToTCPBridge:
-    def __init__(self, ws_host='0.0.0.0', ws_port=8080, tcp_host='127.0.0.1', tcp_port=9999):
+    def __init__(self, ws_host='0.0.0.0', ws_port=8080, tcp_host='127.0.0.1', tcp_port=9999,
+                 metrics_port=0, metrics_host='0.0.0.0'):
         self.ws_host = ws_host
         self.ws_port = ws_port
         self.tcp_host = tcp_host
         self.tcp_port = tcp_port
+        self.active_connections = 0
+        
+        # 运行指标（metrics_port 不为 0 时开放 Prometheus 端口）
+        self.metrics = MetricsRegistry(prefix='neochat_bridge')
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        m = self.metrics
+        self.m_connections = m.counter('connections_total', '接受的 WebSocket 连接数')
+        self.m_connect_errors = m.counter('connect_errors_total', '连接 TCP 服务器失败的次数')
+        self.m_messages = m.counter('messages_total', '转发的消息数（按方向）', ('direction',))
+        self.m_bytes = m.counter('bytes_total', '转发的字节数（按方向，UTF-8）', ('direction',))
+        m.gauge('active_connections', '当前桥接的连接数', fn=lambda: self.active_connections)
+        self.m_ws_to_tcp_messages = self.m_messages.labels('ws_to_tcp')
+        self.m_ws_to_tcp_bytes = self.m_bytes.labels('ws_to_tcp')
+        self.m_tcp_to_ws_messages = self.m_messages.labels('tcp_to_ws')
+        self.m_tcp_to_ws_bytes = self.m_bytes.labels('tcp_to_ws')
         
         # 禁用日志噪音
         logging.getLogger('websockets.server').setLevel(logging.WARNING)
@@ -26,12 +47,18 @@ class WSToTCPBridge:
         """处理 WebSocket 客户端连接"""
         tcp_reader = None
         tcp_writer = None
+        self.m_connections.inc()
+        self.active_connections += 1
         
         try:
             # 连接到 TCP 服务器
-            print(f"[WebSocket] 新连接，正在连接到 TCP 服务器...")
-            tcp_reader, tcp_writer = await asyncio.open_connection(self.tcp_host, self.tcp_port)
-            print(f"[TCP] 已连接到 {self.tcp_host}:{self.tcp_port}")
+            chat_logging.log("新连接，正在连接到 TCP 服务器...", 'INFO', 'WebSocket')
+            try:
+                tcp_reader, tcp_writer = await asyncio.open_connection(self.tcp_host, self.tcp_port)
+            except OSError:
+                self.m_connect_errors.inc()
+                raise
+            chat_logging.log(f"已连接到 {self.tcp_host}:{self.tcp_port}", 'SUCCESS', 'TCP')
             
             # 转发 WebSocket -> TCP 和 TCP -> WebSocket
             ws_to_tcp = asyncio.create_task(self.forward_ws_to_tcp(websocket, tcp_writer))
@@ -40,18 +67,22 @@ class WSToTCPBridge:
             await asyncio.gather(ws_to_tcp, tcp_to_ws, return_exceptions=True)
             
         except Exception as e:
-            print(f"[错误] 桥接错误: {e}")
+            chat_logging.log(f"桥接错误: {e}", 'ERROR')
         finally:
+            self.active_connections -= 1
             if tcp_writer:
                 tcp_writer.close()
                 await tcp_writer.wait_closed()
-            print(f"[断开] 连接已关闭")
+            chat_logging.log("连接已关闭", 'INFO')
     
     async def forward_ws_to_tcp(self, websocket, tcp_writer):
         """转发 WebSocket 消息到 TCP"""
         try:
             async for message in websocket:
-                tcp_writer.write((message + '\n').encode('utf-8'))
+                data = (message + '\n').encode('utf-8')
+                tcp_writer.write(data)
+                self.m_ws_to_tcp_messages.inc()
+                self.m_ws_to_tcp_bytes.inc(len(data))
                 await tcp_writer.drain()
         except:
             pass
@@ -63,6 +94,8 @@ class WSToTCPBridge:
                 data = await tcp_reader.readline()
                 if not data:
                     break
+                self.m_tcp_to_ws_messages.inc()
+                self.m_tcp_to_ws_bytes.inc(len(data))
                 await websocket.send(data.decode('utf-8').strip())
         except:
             pass
@@ -74,11 +107,15 @@ class WSToTCPBridge:
         print("=" * 60)
         print(f"WebSocket 监听: {self.ws_host}:{self.ws_port}")
         print(f"TCP 目标服务器: {self.tcp_host}:{self.tcp_port}")
+        print(f"事件循环: {type(asyncio.get_running_loop()).__module__.split('.')[0]}")
         print("=" * 60)
         
         async with websockets.serve(self.handle_websocket, self.ws_host, self.ws_port):
             print("✓ 桥接服务器已启动")
             print("✓ 浏览器客户端请连接: ws://localhost:8080")
+            if self.metrics_port:
+                await serve_metrics(self.metrics, self.metrics_host, self.metrics_port)
+                print(f"✓ 指标端口: http://{self.metrics_host}:{self.metrics_port}/metrics")
             print("=" * 60)
             await asyncio.Future()  # 永久运行
 
@@ -102,7 +139,11 @@ def save_default_config():
         "tcp_port": 9999,
         "ws_host": "0.0.0.0",
         "ws_port": 8080,
-        "comment": "修改 tcp_host 和 tcp_port 以连接到内网穿透地址"
+        "loop": "asyncio",
+        "log_level": "info",
+        "log_format": "text",
+        "metrics_port": 0,
+        "comment": "修改 tcp_host 和 tcp_port 以连接到内网穿透地址；loop 可选 asyncio / uvloop / auto；log_level 可选 message / info / warning / error，log_format 可选 text / json；metrics_port 不为 0 时开放 Prometheus 指标端口"
     }
     
     try:
@@ -143,6 +184,7 @@ if __name__ == '__main__':
                         "tcp_port": tcp_port,
                         "ws_host": "0.0.0.0",
                         "ws_port": 8080,
+                        "loop": "asyncio",
                         "comment": "桥接到内网穿透服务器"
                     }
                     with open('bridge_config.json', 'w', encoding='utf-8') as f:
@@ -162,6 +204,17 @@ if __name__ == '__main__':
     tcp_port = config.get('tcp_port', 9999)
     ws_host = config.get('ws_host', '0.0.0.0')
     ws_port = config.get('ws_port', 8080)
+    loop_name = config.get('loop', 'asyncio')
+    metrics_port = config.get('metrics_port', 0)
+    metrics_host = config.get('metrics_host', '0.0.0.0')
+    if loop_name not in event_loop.LOOP_CHOICES:
+        print(f"⚠ 配置项 loop 无效: {loop_name}，使用 asyncio")
+        loop_name = 'asyncio'
+    try:
+        chat_logging.configure(config.get('log_level', 'info'), config.get('log_format', 'text'),
+                               config.get('log_sample', chat_logging.DEFAULT_SAMPLE))
+    except ValueError as e:
+        print(f"⚠ 日志配置无效: {e}，使用默认设置")
     
     # 支持命令行参数
     if len(sys.argv) >= 3:
@@ -176,10 +229,12 @@ if __name__ == '__main__':
         ws_host=ws_host,
         ws_port=ws_port,
         tcp_host=tcp_host,
-        tcp_port=tcp_port
+        tcp_port=tcp_port,
+        metrics_port=metrics_port,
+        metrics_host=metrics_host
     )
     
     try:
-        asyncio.run(bridge.start())
+        event_loop.run(bridge.start(), loop=loop_name)
     except KeyboardInterrupt:
         print("\n桥接服务器已关闭")
@@ -0,0 +1,251 @@
+"""
+NeoChat 消息编码与分帧
+默认协议为换行分隔的 UTF-8 JSON；客户端可以在握手时选择长度前缀分帧，
+每帧为 4 字节大端长度 + 负载，负载使用 msgpack、CBOR 或 JSON 编码。
+
+握手（客户端发送的第一行）:
+    旧客户端: 用户名\\n
+    新客户端: {"type": "hello", "username": "...", "framing": "length", "codecs": ["msgpack", "cbor", "json"]}\\n
+服务器回复一行 JSON: {"type": "hello", "framing": "length", "codec": "msgpack", "username": "..."}\\n
+之后双方都使用长度前缀帧。服务器发往客户端的帧负载为消息对象，
+客户端发往服务器的帧负载为消息文本（字符串）。
+"""
+
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# 长度前缀：4 字节无符号大端整数
+FRAME_HEADER = struct.Struct('!I')
+
+# 单帧负载的默认上限
+MAX_FRAME_SIZE = 1024 * 1024
+
+# 服务器按客户端给出的顺序选择第一个可用的编码
+CODEC_PREFERENCE = ('msgpack', 'cbor', 'json')
+
+
+class JSONCodec:
+    name = 'json'
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data.decode('utf-8'))
+
+    @classmethod
+    def frame(cls, obj):
+        return pack_frame(cls.encode(obj))
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+    @classmethod
+    def frame(cls, obj):
+        return pack_frame(cls.encode(obj))
+
+
+class CBORCodec:
+    name = 'cbor'
+
+    @staticmethod
+    def encode(obj):
+        return cbor2.dumps(obj)
+
+    @staticmethod
+    def decode(data):
+        return cbor2.loads(data)
+
+    @classmethod
+    def frame(cls, obj):
+        return pack_frame(cls.encode(obj))
+
+
+def available_codecs():
+    """当前环境可用的编码 {name: codec}（msgpack、cbor2 为可选依赖）"""
+    codecs = {}
+    if msgpack is not None:
+        codecs['msgpack'] = MsgpackCodec
+    if cbor2 is not None:
+        codecs['cbor'] = CBORCodec
+    codecs['json'] = JSONCodec
+    return codecs
+
+
+def get_codec(name):
+    """按名称获取编码，不可用时返回 None"""
+    return available_codecs().get(name)
+
+
+def negotiate(offered):
+    """从客户端提供的编码列表中选出服务器支持的第一个，都不支持时使用 JSON"""
+    codecs = available_codecs()
+    for name in offered or ():
+        if name in codecs:
+            return codecs[name]
+    return JSONCodec
+
+
+def parse_hello(line):
+    """解析握手行；是 hello 消息时返回字典，否则返回 None（旧客户端发送的用户名）"""
+    if not line.startswith('{'):
+        return None
+    try:
+        hello = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(hello, dict) and hello.get('type') == 'hello':
+        return hello
+    return None
+
+
+def pack_frame(payload):
+    """给负载加上长度前缀"""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameTooLarge(ValueError):
+    """单条消息超过大小上限；超长部分已被丢弃，连接可以继续使用"""
+
+    def __init__(self, size, max_size):
+        super().__init__(f"消息长度 {size} 超过上限 {max_size}")
+        self.size = size
+        self.max_size = max_size
+
+
+class FrameReader:
+    """单个连接的增量读取器
+
+    在 asyncio StreamReader 之上按块读取，复用同一个接收缓冲区，
+    并限制单条消息（一行或一帧）的大小。超长的消息会被逐块丢弃而不是缓存，
+    因此每个连接占用的内存不超过 max_size + chunk_size。
+    """
+
+    def __init__(self, reader, max_size=MAX_FRAME_SIZE, chunk_size=64 * 1024, counter=None):
+        self.reader = reader
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.counter = counter  # 可选的字节计数器（有 inc 方法），统计收到的字节数
+        self.buffer = bytearray()
+        self.discard_line = False  # 正在丢弃超长行的剩余部分（直到下一个换行）
+        self.discard_bytes = 0  # 超长帧尚未丢弃的字节数
+
+    async def _fill(self):
+        """再读取一块数据到缓冲区；连接关闭时返回 False"""
+        data = await self.reader.read(self.chunk_size)
+        if not data:
+            return False
+        if self.counter is not None:
+            self.counter.inc(len(data))
+        self.buffer += data
+        return True
+
+    async def peek(self, n):
+        """不消耗数据地查看开头至多 n 个字节（遇到换行或连接关闭时可能更短）"""
+        while len(self.buffer) < n and b'\n' not in self.buffer:
+            if not await self._fill():
+                break
+        return bytes(self.buffer[:n])
+
+    async def readexactly(self, n):
+        """读取恰好 n 个字节（调用方负责限制 n）；连接关闭时返回 None"""
+        if not await self._skip_discarded():
+            return None
+        buffer = self.buffer
+        while len(buffer) < n:
+            if not await self._fill():
+                return None
+        data = bytes(buffer[:n])
+        del buffer[:n]
+        return data
+
+    def discard(self, n):
+        """丢弃接下来的 n 个字节（超长帧的负载），在后续读取时逐块完成"""
+        self.discard_bytes += n
+
+    async def _skip_discarded(self):
+        """完成尚未丢弃的字节；连接关闭时返回 False"""
+        buffer = self.buffer
+        while self.discard_bytes:
+            dropped = min(self.discard_bytes, len(buffer))
+            del buffer[:dropped]
+            self.discard_bytes -= dropped
+            if self.discard_bytes and not await self._fill():
+                return False
+        return True
+
+    async def readline(self):
+        """读取一行（不含换行符）；连接关闭时返回 None，超长时抛出 FrameTooLarge"""
+        buffer = self.buffer
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end >= 0:
+                if self.discard_line:
+                    # 超长行的结尾，之前已报告过错误
+                    del buffer[:end + 1]
+                    self.discard_line = False
+                    start = 0
+                    continue
+                if end > self.max_size:
+                    del buffer[:end + 1]
+                    raise FrameTooLarge(end, self.max_size)
+                line = bytes(buffer[:end])
+                del buffer[:end + 1]
+                return line
+
+            if len(buffer) > self.max_size or self.discard_line:
+                # 没有换行且已超过上限：丢弃已缓存的数据，剩余部分读到换行为止
+                size = len(buffer)
+                buffer.clear()
+                start = 0
+                if not self.discard_line:
+                    self.discard_line = True
+                    raise FrameTooLarge(size, self.max_size)
+            else:
+                start = len(buffer)
+
+            if not await self._fill():
+                return None
+
+    async def read_frame(self):
+        """读取一个长度前缀帧的负载；连接关闭时返回 None，超长时抛出 FrameTooLarge"""
+        if not await self._skip_discarded():
+            return None
+        buffer = self.buffer
+        while True:
+            if len(buffer) >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(buffer)
+                if length > self.max_size:
+                    del buffer[:FRAME_HEADER.size]
+                    self.discard(length)
+                    raise FrameTooLarge(length, self.max_size)
+                end = FRAME_HEADER.size + length
+                if len(buffer) >= end:
+                    payload = bytes(buffer[FRAME_HEADER.size:end])
+                    del buffer[:end]
+                    return payload
+
+            if not await self._fill():
+                return None
@@ -0,0 +1,172 @@
+"""
+NeoChat 消息历史
+固定容量（按条数和字节数）的环形缓冲区，每条消息带单调递增的序号 seq。
+追加为 O(1)，"seq 之后的消息" 通过二分查找定位，为 O(log n)。
+每条消息可以标记所属房间，各房间的历史是同一个缓冲区按房间过滤的视图，总容量不随房间数增长；
+每个房间另有一份按序递增的序号索引，按房间查询同样二分定位，为 O(log n + 返回条数)，与其他房间的消息量无关。
+消息在到达时已写入聊天日志，超出容量的最旧消息直接淘汰。
+"""
+
+import bisect
+import heapq
+import threading
+
+DEFAULT_MAX_MESSAGES = 10000
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+def message_size(message):
+    """估算一条消息占用的字节数（按字段长度计，不做序列化）"""
+    size = 16
+    for key, value in message.items():
+        size += len(key) + (len(value) if isinstance(value, str) else 8)
+    return size
+
+
+class _SeqIndex:
+    """一个房间的消息序号（升序）；淘汰时前移 head，过半时压缩"""
+
+    __slots__ = ('seqs', 'head')
+
+    def __init__(self):
+        self.seqs = []
+        self.head = 0
+
+    def __len__(self):
+        return len(self.seqs) - self.head
+
+    def after(self, seq, limit=None):
+        """序号大于 seq 的部分；limit 只保留最新的若干个"""
+        start = bisect.bisect_right(self.seqs, seq, self.head)
+        if limit is not None:
+            start = max(start, len(self.seqs) - limit)
+        return self.seqs[start:]
+
+    def drop_first(self):
+        self.head += 1
+        if self.head * 2 >= len(self.seqs):
+            del self.seqs[:self.head]
+            self.head = 0
+
+
+class MessageHistory:
+    """带序号的消息环形缓冲区（线程安全）
+
+    每条消息可以带所属房间（None 表示所有房间都可见），since() 指定 room 时只返回该房间能看到的消息。
+    """
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.seqs = []  # 与 items 一一对应的序号，从 head 开始有效
+        self.items = []
+        self.sizes = []
+        self.rooms = []  # 与 items 一一对应的所属房间
+        self.room_index = {}  # {所属房间: _SeqIndex}，None 为所有房间可见的消息；房间的消息全部淘汰后移除
+        self.head = 0  # 最旧一条有效消息的下标，淘汰时前移，过半时压缩
+        self.total_bytes = 0
+        self.next_seq = 1
+        self.evicted_count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.seqs) - self.head
+
+    @property
+    def last_seq(self):
+        """最新一条消息的序号（还没有消息时为 0）"""
+        return self.next_seq - 1
+
+    @property
+    def first_seq(self):
+        """仍保留的最旧消息的序号（为空时为 next_seq）"""
+        with self.lock:
+            return self.seqs[self.head] if len(self.seqs) > self.head else self.next_seq
+
+    def append(self, message, room=None):
+        """追加一条消息，分配序号（同时写入 message['seq']）并返回；room 为所属房间，None 表示所有房间"""
+        size = message_size(message)
+        with self.lock:
+            seq = message['seq'] = self.next_seq
+            self.next_seq = seq + 1
+            self.seqs.append(seq)
+            self.items.append(message)
+            self.sizes.append(size)
+            self.rooms.append(room)
+            index = self.room_index.get(room)
+            if index is None:
+                index = self.room_index[room] = _SeqIndex()
+            index.seqs.append(seq)
+            self.total_bytes += size
+            self._evict()
+        return seq
+
+    def _evict(self):
+        """淘汰超出容量的最旧消息（持有锁时调用）"""
+        head = self.head
+        end = len(self.seqs)
+        total = self.total_bytes
+        sizes = self.sizes
+        # 至少保留最新一条，即使它本身超过字节上限
+        while end - head > 1 and (end - head > self.max_messages or total > self.max_bytes):
+            total -= sizes[head]
+            head += 1
+        if head == self.head:
+            return
+
+        room_index = self.room_index
+        for room in self.rooms[self.head:head]:
+            index = room_index[room]
+            index.drop_first()
+            if not index:
+                del room_index[room]
+
+        self.total_bytes = total
+        self.evicted_count += head - self.head
+        self.head = head
+        if head * 2 >= end:
+            # 压缩：一次性移除已淘汰的部分，均摊到每次追加为 O(1)
+            del self.seqs[:head]
+            del self.items[:head]
+            del self.sizes[:head]
+            del self.rooms[:head]
+            self.head = 0
+
+    def since(self, seq, limit=None, room=None):
+        """返回序号大于 seq 的消息（按序号排序）；limit 只保留最新的若干条
+
+        指定 room 时只返回属于该房间或所有房间可见的消息：在该房间和所有房间可见消息的序号索引中
+        分别二分定位，合并后按序号取出消息（缓冲区中的序号连续，下标可直接算出）。
+        """
+        with self.lock:
+            if room is None:
+                start = bisect.bisect_right(self.seqs, seq, self.head)
+                if limit is not None:
+                    start = max(start, len(self.items) - limit)
+                return self.items[start:]
+            if len(self.seqs) == self.head:
+                return []
+            seqs = [index.after(seq, limit) for index in (self.room_index.get(room), self.room_index.get(None))
+                    if index is not None]
+            seqs = list(heapq.merge(*seqs)) if len(seqs) > 1 else (seqs[0] if seqs else [])
+            if limit is not None and len(seqs) > limit:
+                seqs = seqs[len(seqs) - limit:]
+            offset = self.head - self.seqs[self.head]
+            items = self.items
+            return [items[s + offset] for s in seqs]
+
+    def snapshot(self):
+        """当前保留的全部消息"""
+        with self.lock:
+            return self.items[self.head:]
+
+    def clear(self):
+        """清空消息（序号继续递增，不会重复）"""
+        with self.lock:
+            self.seqs = []
+            self.items = []
+            self.sizes = []
+            self.rooms = []
+            self.room_index = {}
+            self.head = 0
+            self.total_bytes = 0
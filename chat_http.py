@@ -0,0 +1,226 @@
+"""
+NeoChat 轻量 HTTP/1.1 支持
+在 asyncio 连接上解析请求、构造响应，供 TCP 服务器的 HTTP 轮询接口和 WebSocket 升级使用。
+请求通过 chat_codec.FrameReader 读取，请求行、每个请求头和请求体都受同样的大小上限约束。
+"""
+
+import json
+import urllib.parse
+import zlib
+
+from chat_codec import FrameTooLarge
+
+# 以这些方法开头的连接按 HTTP 处理
+HTTP_METHODS = (b'GET ', b'POST ', b'PUT ', b'DELETE ', b'HEAD ', b'OPTIONS ', b'PATCH ')
+
+MAX_HEADERS = 100
+
+# 长轮询 GET /messages?wait=N 最多挂起的秒数（客户端请求超时应大于此值）
+MAX_POLL_WAIT = 30
+
+# 持久连接：空闲超过 KEEPALIVE_TIMEOUT 秒或处理了 MAX_KEEPALIVE_REQUESTS 个请求后关闭
+KEEPALIVE_TIMEOUT = 15
+MAX_KEEPALIVE_REQUESTS = 100
+
+# 响应体压缩：按 Accept-Encoding 协商，优先 gzip；小于 COMPRESS_MIN_SIZE 字节的响应体不压缩
+COMPRESSIONS = ('gzip', 'deflate')
+COMPRESS_MIN_SIZE = 1024
+DEFAULT_COMPRESS_LEVEL = 6
+
+STATUS_TEXT = {
+    200: 'OK',
+    204: 'No Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+}
+
+
+class HTTPError(Exception):
+    """请求格式错误，status 为应返回的状态码"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class HTTPRequest:
+    """解析后的 HTTP 请求"""
+
+    __slots__ = ('method', 'target', 'path', 'query', 'version', 'headers', 'body')
+
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.target = target
+        parsed = urllib.parse.urlparse(target)
+        self.path = parsed.path
+        self.query = urllib.parse.parse_qs(parsed.query)
+        self.version = version
+        self.headers = headers  # {小写名称: 值}
+        self.body = body
+
+    def param(self, name, default=''):
+        """查询参数的第一个值"""
+        return self.query.get(name, [default])[0]
+
+    def json(self):
+        """把请求体解析为 JSON 对象，为空或格式错误时返回 {}"""
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    @property
+    def keep_alive(self):
+        """客户端是否希望保持连接：HTTP/1.1 默认保持，HTTP/1.0 需要 Connection: keep-alive"""
+        tokens = self.header_tokens('connection')
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return 'close' not in tokens
+
+    def header_tokens(self, name):
+        """逗号分隔的请求头取值（小写）"""
+        return [token.strip().lower() for token in self.headers.get(name, '').split(',')]
+
+    @property
+    def is_websocket_upgrade(self):
+        return (self.method == 'GET'
+                and self.headers.get('upgrade', '').lower() == 'websocket'
+                and 'upgrade' in self.header_tokens('connection')
+                and bool(self.headers.get('sec-websocket-key')))
+
+
+def is_http_request(prefix):
+    """根据连接开头的字节判断是否为 HTTP 请求"""
+    return prefix.startswith(HTTP_METHODS)
+
+
+def poll_wait(value):
+    """解析长轮询的 wait 参数（秒），限制在 0 到 MAX_POLL_WAIT 之间；缺失或格式错误时为 0（立即返回）"""
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        return 0
+    if not wait > 0:
+        return 0  # 负数和 NaN
+    return min(wait, MAX_POLL_WAIT)
+
+
+def accepted_encoding(accept_encoding):
+    """从 Accept-Encoding 请求头中选出压缩方式（按 q 值，相同时优先 gzip），客户端不接受压缩时返回 None"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    default = weights.get('*', 0.0)
+    encoding = max(COMPRESSIONS, key=lambda name: weights.get(name, default))
+    return encoding if weights.get(encoding, default) > 0 else None
+
+
+def compress(body, encoding, level=DEFAULT_COMPRESS_LEVEL):
+    """按 gzip 或 deflate（HTTP 的 deflate 为 zlib 格式）压缩响应体；gzip 头中不写时间，相同输入得到相同输出"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+    return compressor.compress(body) + compressor.flush()
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match 请求头是否命中 etag（弱比较：忽略 W/ 前缀，* 匹配任意值）"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+async def read_request(frames):
+    """从 FrameReader 读取一个完整请求；连接关闭时返回 None，格式错误时抛出 HTTPError"""
+    try:
+        line = await frames.readline()
+        if line is None:
+            return None
+        parts = line.decode('latin-1').rstrip('\r').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HTTPError(400, '无效的请求行')
+        method, target, version = parts
+
+        headers = {}
+        while True:
+            line = await frames.readline()
+            if line is None:
+                return None
+            line = line.decode('latin-1').rstrip('\r')
+            if not line:
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HTTPError(431, '请求头过多')
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise HTTPError(400, '无效的请求头')
+            headers[name.strip().lower()] = value.strip()
+    except FrameTooLarge:
+        raise HTTPError(431, '请求头过长')
+
+    body = b''
+    if 'transfer-encoding' in headers:
+        raise HTTPError(400, '不支持分块请求体')
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(400, '无效的 Content-Length')
+    if length < 0:
+        raise HTTPError(400, '无效的 Content-Length')
+    if length > frames.max_size:
+        raise HTTPError(413, '请求体过大')
+    if length:
+        body = await frames.readexactly(length)
+        if body is None:
+            return None
+
+    return HTTPRequest(method.upper(), target, version, headers, body)
+
+
+def build_response(status, body=b'', content_type=None, headers=None, keep_alive=False):
+    """构造完整的响应字节串（304 以外始终带 Content-Length）"""
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Unknown')}"]
+    if content_type:
+        lines.append(f"Content-Type: {content_type}")
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    if status != 304:
+        lines.append(f"Content-Length: {len(body)}")  # 304 没有响应体，长度应与 200 响应一致，不写
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def json_response(data, status=200, keep_alive=False):
+    """JSON 响应（带 CORS 头，与 server_https.py 的格式一致）"""
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return build_response(status, body, 'application/json; charset=utf-8', CORS_HEADERS, keep_alive)
@@ -0,0 +1,190 @@
+"""
+NeoChat 日志输出
+log() 只把记录放进队列，由后台线程批量写到标准输出；终端或管道阻塞时不会卡住事件循环和请求线程。
+支持按级别过滤、JSON 行格式（供程序处理）、只在终端上着色，以及逐条聊天消息日志（MESSAGE 级别）的按秒采样。
+
+用法:
+    chat_logging.configure(level='info', fmt='json', sample=100)
+    chat_logging.log("服务器已就绪", 'SUCCESS')
+"""
+
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+# 级别: 优先级（SYSTEM 是控制台命令的输出，只有 error 级别才会过滤掉）
+LEVELS = {
+    'MESSAGE': 10,
+    'INFO': 20,
+    'SUCCESS': 20,
+    'WARNING': 30,
+    'SYSTEM': 35,
+    'ERROR': 40,
+}
+LEVEL_CHOICES = ('message', 'info', 'warning', 'error')
+FORMAT_CHOICES = ('text', 'json')
+
+DEFAULT_SAMPLE = 100  # 每秒最多输出的 MESSAGE 日志条数
+DEFAULT_QUEUE_SIZE = 10000
+
+COLORS = {
+    'INFO': '\033[96m',
+    'SUCCESS': '\033[92m',
+    'WARNING': '\033[93m',
+    'ERROR': '\033[91m',
+    'MESSAGE': '\033[94m',
+    'SYSTEM': '\033[95m',
+}
+ENDC = '\033[0m'
+
+
+class Logger:
+    """队列 + 后台写入线程；队列满时丢弃新记录并计数，不阻塞调用方"""
+
+    def __init__(self, level='message', fmt='text', sample=DEFAULT_SAMPLE, stream=None,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        if level not in LEVEL_CHOICES:
+            raise ValueError(f"未知的日志级别: {level}")
+        if fmt not in FORMAT_CHOICES:
+            raise ValueError(f"未知的日志格式: {fmt}")
+        self.level = level
+        self.min_level = LEVELS[level.upper()]
+        self.fmt = fmt
+        self.sample = sample  # 0 表示不采样
+        self.stream = stream or sys.stdout
+        self.color = fmt == 'text' and hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0  # 队列满被丢弃的记录数
+        self.sampled_out = 0  # 因采样未输出的 MESSAGE 记录总数
+        self._window = 0  # 当前采样窗口（整数秒）
+        self._window_count = 0
+        self._window_skipped = 0
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._write_loop, name='chat-logging', daemon=True)
+        self.thread.start()
+
+    def settings(self):
+        """构造同样配置所需的参数（传给子进程的 configure()）"""
+        return {'level': self.level, 'fmt': self.fmt, 'sample': self.sample}
+
+    def enabled(self, level):
+        return LEVELS.get(level, LEVELS['INFO']) >= self.min_level
+
+    def log(self, message, level='INFO', source=None, **fields):
+        """记录一条日志（立即返回）；fields 只出现在 JSON 格式中"""
+        if not self.enabled(level):
+            return
+        now = time.time()
+        if level == 'MESSAGE' and self.sample:
+            with self._lock:
+                window = int(now)
+                if window != self._window:
+                    skipped, self._window_skipped = self._window_skipped, 0
+                    self._window, self._window_count = window, 0
+                    if skipped:
+                        self._put((now, 'WARNING', source,
+                                   f"已省略 {skipped} 条消息日志（采样上限 {self.sample} 条/秒）", {'sampled_out': skipped}))
+                if self._window_count >= self.sample:
+                    self._window_skipped += 1
+                    self.sampled_out += 1
+                    return
+                self._window_count += 1
+        self._put((now, level, source, message, fields))
+
+    def _put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            record = self.queue.get()
+            batch = [record]
+            # 一次取走队列中已有的记录，合并为一次写入
+            while len(batch) < 512:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.stream.write(''.join(self.format(*record) for record in batch))
+                self.stream.flush()
+            except Exception:
+                pass
+            for _ in batch:
+                self.queue.task_done()
+
+    def format(self, timestamp, level, source, message, fields):
+        moment = datetime.fromtimestamp(timestamp)
+        if self.fmt == 'json':
+            record = {'time': moment.isoformat(timespec='milliseconds'), 'level': level, 'message': message}
+            if source:
+                record['source'] = source
+            record.update(fields)
+            return json.dumps(record, ensure_ascii=False, default=str) + '\n'
+        prefix = f" [{source}]" if source else ""
+        head = f"[{moment.strftime('%H:%M:%S.%f')[:-3]}]{prefix} [{level}]"
+        if self.color:
+            head = f"{COLORS.get(level, ENDC)}{head}{ENDC}"
+        return f"{head} {message}\n"
+
+    def flush(self, timeout=2.0):
+        """等待队列中的记录写出（最多 timeout 秒）"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def configure(level='message', fmt='text', sample=DEFAULT_SAMPLE, stream=None):
+    """设置进程的日志输出（替换之前的配置，先写出已排队的记录）"""
+    global _logger
+    with _logger_lock:
+        if _logger is not None:
+            _logger.flush()
+        _logger = Logger(level, fmt, sample, stream)
+    return _logger
+
+
+def get_logger():
+    global _logger
+    if _logger is None:
+        with _logger_lock:
+            if _logger is None:
+                _logger = Logger()
+    return _logger
+
+
+def log(message, level='INFO', source=None, **fields):
+    """记录一条日志（不阻塞），见 Logger.log"""
+    get_logger().log(message, level, source, **fields)
+
+
+def flush(timeout=2.0):
+    if _logger is not None:
+        _logger.flush(timeout)
+
+
+def add_arguments(parser):
+    """向 argparse 解析器添加日志相关的命令行参数"""
+    parser.add_argument('--log-level', choices=LEVEL_CHOICES, default='message',
+                        help='最低日志级别: message=包括每条聊天消息, info, warning, error (默认 message)')
+    parser.add_argument('--log-format', choices=FORMAT_CHOICES, default='text',
+                        help='日志格式: text=文本（终端中着色）, json=每行一个 JSON 对象 (默认 text)')
+    parser.add_argument('--log-sample', type=int, default=DEFAULT_SAMPLE,
+                        help=f'每秒最多输出的聊天消息日志条数，0 表示不限 (默认 {DEFAULT_SAMPLE})')
+
+
+def configure_from_args(args):
+    return configure(args.log_level, args.log_format, args.log_sample)
+
+
+atexit.register(flush)
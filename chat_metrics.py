@@ -0,0 +1,440 @@
+"""
+NeoChat 运行指标
+计数器、仪表、直方图和 HDR 风格的延迟分布（输出为带分位数的 summary），
+以 Prometheus 文本格式（0.0.4）从单独的 HTTP 端口输出（GET /metrics）。
+asyncio 服务器在事件循环线程中更新和输出指标，热路径上只是一次整数加法，不加锁；
+多线程服务器（server_https.py）创建 MetricsRegistry(thread_safe=True)，更新时加锁。
+
+用法:
+    metrics = MetricsRegistry()
+    received = metrics.counter('messages_received_total', '收到的聊天消息数')
+    received.inc()
+    await serve_metrics(metrics, '0.0.0.0', 9100)   # 或 start_metrics_thread(...)
+"""
+
+import asyncio
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 默认的延迟直方图区间上界（秒）：50 µs - 5 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# 延迟分布输出的分位数
+QUANTILES = (0.5, 0.95, 0.99, 0.999)
+
+
+class Counter:
+    """只增不减的计数器"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """可增可减的当前值"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram:
+    """固定区间的直方图（输出时再累加为 Prometheus 的累计区间）"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # 最后一个区间为 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class HdrHistogram:
+    """HDR 风格的延迟分布：以微秒为单位，按 2 的幂分段、段内线性细分，
+    在 1 µs - max_seconds 的整个范围内相对误差不超过 1 / 2**(sub_bucket_bits - 1)（默认 1.6%），
+    可以查询任意分位数。observe() 只做整数运算和一次列表下标加一。
+    """
+
+    __slots__ = ('sub_bucket_bits', 'half', 'max_value', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, sub_bucket_bits=7, max_seconds=60.0):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.half = 1 << (sub_bucket_bits - 1)
+        self.max_value = int(max_seconds * 1000000)  # 超出的值计入最后一个区间
+        self.counts = [0] * (self._index(self.max_value) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    def _upper(self, index):
+        """区间内的最大值（微秒）"""
+        if index < self.half * 2:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+    def observe(self, seconds):
+        value = int(seconds * 1000000)
+        if value > self.max_value:
+            value = self.max_value
+        elif value < 0:
+            value = 0
+        shift = value.bit_length() - self.sub_bucket_bits  # 与 _index() 相同，内联以减少一次调用
+        self.counts[value if shift <= 0 else shift * self.half + (value >> shift)] += 1
+        self.sum += seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """q 分位数（0-1，秒）；按区间上界报告，不会低估"""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(q * self.count + 0.999999))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._upper(index) / 1000000, self.max)
+        return self.max
+
+    def percentiles(self, quantiles=QUANTILES):
+        """{分位数: 秒}，一次遍历"""
+        result = {}
+        if not self.count:
+            return {q: 0.0 for q in quantiles}
+        ranks = sorted((max(1, int(q * self.count + 0.999999)), q) for q in quantiles)
+        seen = 0
+        i = 0
+        for index, count in enumerate(list(self.counts)):
+            seen += count
+            while i < len(ranks) and seen >= ranks[i][0]:
+                result[ranks[i][1]] = min(self._upper(index) / 1000000, self.max)
+                i += 1
+            if i == len(ranks):
+                break
+        for _, q in ranks[i:]:
+            result[q] = self.max
+        return result
+
+
+class _LockedCounter(Counter):
+    __slots__ = ('lock',)
+
+    def __init__(self, lock):
+        super().__init__()
+        self.lock = lock
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class _LockedGauge(Gauge):
+    __slots__ = ('lock',)
+
+    def __init__(self, lock):
+        super().__init__()
+        self.lock = lock
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+
+class _LockedHistogram(Histogram):
+    __slots__ = ('lock',)
+
+    def __init__(self, buckets, lock):
+        super().__init__(buckets)
+        self.lock = lock
+
+    def observe(self, value):
+        with self.lock:
+            Histogram.observe(self, value)
+
+
+class _LockedHdrHistogram(HdrHistogram):
+    __slots__ = ('lock',)
+
+    def __init__(self, lock):
+        super().__init__()
+        self.lock = lock
+
+    def observe(self, seconds):
+        with self.lock:
+            HdrHistogram.observe(self, seconds)
+
+
+class _NullMetric:
+    """关闭指标时使用的空操作对象"""
+
+    __slots__ = ()
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def labels(self, *values):
+        return self
+
+
+NULL_METRIC = _NullMetric()
+
+
+class MetricFamily:
+    """同名指标：无标签时只有一个子指标；有标签时按标签值创建子指标"""
+
+    def __init__(self, registry, name, help_text, kind, labelnames=(), fn=None, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.fn = fn  # 输出时调用，返回数值（有标签时返回 {标签值元组: 数值}）
+        self.buckets = buckets
+        self.children = {}  # {标签值元组: 指标}
+
+    def labels(self, *values):
+        """返回标签值对应的子指标（第一次使用时创建）"""
+        child = self.children.get(values)
+        if child is None:
+            lock = self.registry.lock
+            if lock is None:
+                child = self.children[values] = self.registry._new_metric(self.kind, self.buckets)
+            else:
+                with lock:
+                    child = self.children.get(values)
+                    if child is None:
+                        child = self.children[values] = self.registry._new_metric(self.kind, self.buckets)
+        return child
+
+    def samples(self):
+        """[(后缀, 标签字典, 数值)]"""
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                return []
+            if not self.labelnames:
+                return [('', {}, value)]
+            return [('', dict(zip(self.labelnames, key if isinstance(key, tuple) else (key,))), v)
+                    for key, v in value.items()]
+
+        samples = []
+        for values, metric in list(self.children.items()):
+            labels = dict(zip(self.labelnames, values))
+            if self.kind == 'summary':
+                for q, value in metric.percentiles().items():
+                    samples.append(('', dict(labels, quantile=format_value(q)), value))
+                samples.append(('_sum', labels, metric.sum))
+                samples.append(('_count', labels, metric.count))
+                continue
+            if self.kind != 'histogram':
+                samples.append(('', labels, metric.value))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.bounds + (float('inf'),), list(metric.counts)):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=format_value(bound)), cumulative))
+            samples.append(('_sum', labels, metric.sum))
+            samples.append(('_count', labels, metric.count))
+        return samples
+
+
+class MetricsRegistry:
+    """一个进程的全部指标；enabled=False 时返回空操作对象（用于测量指标本身的开销）"""
+
+    def __init__(self, prefix='neochat', thread_safe=False, enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.lock = threading.Lock() if thread_safe else None
+        self.families = {}
+        self.start_time = time.time()
+        self.gauge('process_start_time_seconds', '进程启动时间（Unix 时间戳）', fn=lambda: self.start_time)
+        self.gauge('uptime_seconds', '运行时长（秒）', fn=lambda: time.time() - self.start_time)
+
+    def _new_metric(self, kind, buckets=None):
+        if self.lock is None:
+            if kind == 'counter':
+                return Counter()
+            if kind == 'gauge':
+                return Gauge()
+            if kind == 'summary':
+                return HdrHistogram()
+            return Histogram(buckets)
+        if kind == 'counter':
+            return _LockedCounter(self.lock)
+        if kind == 'gauge':
+            return _LockedGauge(self.lock)
+        if kind == 'summary':
+            return _LockedHdrHistogram(self.lock)
+        return _LockedHistogram(buckets, self.lock)
+
+    def _register(self, name, help_text, kind, labelnames, fn, buckets=None):
+        name = f"{self.prefix}_{name}" if self.prefix else name
+        if name in self.families:
+            raise ValueError(f"指标已存在: {name}")
+        family = self.families[name] = MetricFamily(self, name, help_text, kind, labelnames, fn, buckets)
+        if fn is not None:
+            return None
+        if not self.enabled:
+            return NULL_METRIC
+        return family if labelnames else family.labels()
+
+    def counter(self, name, help_text, labelnames=(), fn=None):
+        """注册计数器；fn 不为空时输出时调用 fn() 取值（用于已有的统计字段），返回 None"""
+        return self._register(name, help_text, 'counter', labelnames, fn)
+
+    def gauge(self, name, help_text, labelnames=(), fn=None):
+        """注册仪表；队列深度、在线人数等当前值通常用 fn 在输出时计算，热路径上没有开销"""
+        return self._register(name, help_text, 'gauge', labelnames, fn)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(name, help_text, 'histogram', labelnames, None, buckets)
+
+    def summary(self, name, help_text, labelnames=()):
+        """注册 HDR 延迟分布，输出 QUANTILES 中的分位数（自启动以来的全部观测值）"""
+        return self._register(name, help_text, 'summary', labelnames, None)
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+        for family in list(self.families.values()):
+            samples = family.samples()
+            if not samples and family.fn is None and not self.enabled:
+                continue
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{family.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _response(status, body):
+    reason = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed'}[status]
+    content_type = CONTENT_TYPE if status == 200 else 'text/plain; charset=utf-8'
+    head = (f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+    return head.encode('ascii') + body
+
+
+async def serve_metrics(registry, host='0.0.0.0', port=9100):
+    """在当前事件循环中启动指标端口（与服务器在同一线程，读取指标时无需加锁），返回 asyncio.Server"""
+
+    async def handle(reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=10.0)
+            method, path = head.split(b' ', 2)[:2]
+            if method not in (b'GET', b'HEAD'):
+                response = _response(405, b'method not allowed\n')
+            elif path.split(b'?', 1)[0] in (b'/metrics', b'/'):
+                response = _response(200, registry.render().encode('utf-8'))
+            else:
+                response = _response(404, b'not found\n')
+            if method == b'HEAD':
+                response = response.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+            writer.write(response)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def start_metrics_thread(registry, host='0.0.0.0', port=9100):
+    """在后台线程中启动指标端口（用于多线程服务器），返回 ThreadingHTTPServer"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] in ('/metrics', '/'):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+            else:
+                body = b'not found\n'
+                self.send_response(404)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics-http', daemon=True).start()
+    return httpd
+
+
+def add_arguments(parser):
+    """向 argparse 解析器添加指标端口参数"""
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Prometheus 指标端口（GET /metrics），0 表示不开启 (默认 0)')
+    parser.add_argument('--metrics-host', default='0.0.0.0', help='指标端口的监听地址 (默认 0.0.0.0)')
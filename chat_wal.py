@@ -0,0 +1,244 @@
+"""
+NeoChat 追加写入的聊天日志（NDJSON 分段日志）
+每条消息到达时交给 ChatLog.append()，由后台线程批量写入并 fsync（组提交）：
+每隔 flush_ms 毫秒或积累 flush_records 条记录提交一次，崩溃最多丢失一个提交周期内的消息。
+日志按大小或时间切分为多个段文件，read_records() 按顺序跨段读取（包括 log_retention 压缩后的段）。
+
+用法: python chat_wal.py [目录] [--prefix tcp] [--since 序号]   # 以 NDJSON 输出记录
+"""
+
+import argparse
+import bz2
+import gzip
+import json
+import lzma
+import os
+import re
+import sys
+import threading
+import time
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENT_SECONDS = 3 * 60 * 60
+DEFAULT_FLUSH_MS = 50
+DEFAULT_FLUSH_RECORDS = 256
+
+SEGMENT_SUFFIX = '.ndjson'
+
+# 压缩后的段: {扩展名: 打开函数}
+ARCHIVE_OPENERS = {
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+    '.bz2': bz2.open,
+}
+
+
+def segment_name(prefix, index):
+    return f"{prefix}-{index:06d}{SEGMENT_SUFFIX}"
+
+
+def open_log(path, mode='rb'):
+    """按扩展名打开日志文件（压缩或未压缩）"""
+    for extension, opener in ARCHIVE_OPENERS.items():
+        if path.endswith(extension):
+            return opener(path, mode)
+    return open(path, mode)
+
+
+def scan_segments(directory, prefix):
+    """按编号顺序返回目录中属于 prefix 的段 [(编号, 路径)]，包括压缩后的段"""
+    pattern = re.compile(re.escape(prefix) + r'-(\d{6})' + re.escape(SEGMENT_SUFFIX) + r'(\.gz|\.xz|\.bz2)?$')
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    segments = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+def list_segments(directory, prefix):
+    """按顺序返回目录中属于 prefix 的段文件路径"""
+    return [path for _, path in scan_segments(directory, prefix)]
+
+
+def read_records(directory, prefix, since=0):
+    """按写入顺序跨段迭代记录；since 跳过序号不大于它的消息
+
+    每段末尾未写完的行（崩溃时的半条记录）会被忽略。
+    """
+    for path in list_segments(directory, prefix):
+        try:
+            f = open_log(path)
+        except FileNotFoundError:
+            # 读取期间该段刚被压缩
+            archives = [path + extension for extension in ARCHIVE_OPENERS if os.path.exists(path + extension)]
+            if not archives:
+                continue
+            f = open_log(archives[0])
+        with f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since and record.get('seq', since + 1) <= since:
+                    continue
+                yield record
+
+
+class ChatLog:
+    """追加写入的分段日志，后台线程负责组提交和段切换（线程安全）"""
+
+    def __init__(self, directory, prefix, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 segment_seconds=DEFAULT_SEGMENT_SECONDS, flush_ms=DEFAULT_FLUSH_MS,
+                 flush_records=DEFAULT_FLUSH_RECORDS, fsync=True, log=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.flush_interval = flush_ms / 1000.0
+        self.flush_records = flush_records
+        self.fsync = fsync
+        self.log = log  # log(message, level)，写入出错时报告
+
+        self.pending = []  # 等待提交的记录（在写入线程中序列化）
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock)  # 唤醒写入线程
+        self.committed = threading.Condition(lock)  # 通知 sync() 的等待者
+        self.appended_count = 0  # 已交给 append 的记录数
+        self.committed_count = 0  # 已提交（写入并 fsync）的记录数
+        self.commit_count = 0  # 提交次数
+        self.bytes_written = 0
+        self.closed = False
+        self.rotate_requested = False
+
+        os.makedirs(directory, exist_ok=True)
+        existing = scan_segments(directory, prefix)
+        # 重启后从新的段开始写，不在可能被截断的旧段末尾追加
+        self.segment_index = existing[-1][0] + 1 if existing else 1
+        self.file = None
+        self.segment_path = None
+        self.segment_size = 0
+        self.segment_started = 0.0
+        self._open_segment()
+
+        self.thread = threading.Thread(target=self._commit_loop, name=f"chat-log-{prefix}", daemon=True)
+        self.thread.start()
+
+    def _open_segment(self):
+        self.segment_path = os.path.join(self.directory, segment_name(self.prefix, self.segment_index))
+        self.file = open(self.segment_path, 'ab')
+        self.segment_size = self.file.tell()
+        self.segment_started = time.monotonic()
+        self.segment_index += 1
+
+    def append(self, record):
+        """追加一条记录（dict），立即返回；满 flush_records 条时提前唤醒写入线程"""
+        with self.condition:
+            if self.closed:
+                return
+            self.pending.append(record)
+            self.appended_count += 1
+            if len(self.pending) >= self.flush_records:
+                self.condition.notify()
+
+    def sync(self, timeout=5.0, rotate=False):
+        """等待此前追加的记录全部提交；rotate=True 时提交后切换到新段。返回是否按时完成"""
+        with self.condition:
+            target = self.appended_count
+            if rotate:
+                self.rotate_requested = True
+            self.condition.notify()
+            return self.committed.wait_for(lambda: self.committed_count >= target or self.closed, timeout)
+
+    def close(self):
+        """提交剩余记录并关闭当前段"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(timeout=5.0)
+
+    def _commit_loop(self):
+        while True:
+            with self.condition:
+                if not self.pending and not self.closed and not self.rotate_requested:
+                    self.condition.wait(self.flush_interval)
+                batch, self.pending = self.pending, []
+                closing = self.closed
+                rotate, self.rotate_requested = self.rotate_requested, False
+
+            if batch:
+                self._write(batch)
+            if (rotate and self.segment_size) or self._segment_full():
+                self._rotate()
+
+            with self.condition:
+                self.committed_count += len(batch)
+                self.committed.notify_all()
+            if closing:
+                break
+
+        try:
+            self.file.close()
+            if not self.segment_size:
+                os.remove(self.segment_path)  # 不留下空段
+        except OSError:
+            pass
+
+    def _write(self, batch):
+        data = ''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+                       for record in batch).encode('utf-8')
+        try:
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+        except OSError as e:
+            if self.log:
+                self.log(f"写入聊天日志失败: {e}", 'ERROR')
+            return
+        self.segment_size += len(data)
+        self.bytes_written += len(data)
+        self.commit_count += 1
+
+    def _segment_full(self):
+        if self.segment_size >= self.segment_bytes:
+            return True
+        return self.segment_size > 0 and time.monotonic() - self.segment_started >= self.segment_seconds
+
+    def _rotate(self):
+        try:
+            self.file.close()
+            self._open_segment()
+        except OSError as e:
+            if self.log:
+                self.log(f"切换聊天日志段失败: {e}", 'ERROR')
+
+    def summary(self):
+        """统计信息文本"""
+        return (f"聊天日志: 当前段 {os.path.basename(self.segment_path)} | 已提交 {self.committed_count} 条，"
+                f"{self.commit_count} 次提交，{self.bytes_written // 1024} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='读取 NeoChat 聊天日志')
+    parser.add_argument('directory', nargs='?', default='chat_logs', help='日志目录 (默认 chat_logs)')
+    parser.add_argument('--prefix', default='tcp', help='段文件前缀: tcp、tcp_w<编号> 或 http (默认 tcp)')
+    parser.add_argument('--since', type=int, default=0, help='只输出序号大于此值的消息')
+    args = parser.parse_args()
+
+    for record in read_records(args.directory, args.prefix, args.since):
+        sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+NeoChat 原生 WebSocket 支持（RFC 6455）
+TCP 服务器在同一端口上识别 WebSocket 升级请求后直接处理，浏览器客户端无需经过桥接服务器。
+只实现聊天所需的部分：文本/二进制消息、分片、ping/pong 和关闭握手，不支持扩展（压缩）。
+"""
+
+import base64
+import hashlib
+import json
+import struct
+
+from chat_codec import FrameTooLarge
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_VERSION = '13'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_PROTOCOL_ERROR = 1002
+
+
+def accept_key(key):
+    """根据客户端的 Sec-WebSocket-Key 计算 Sec-WebSocket-Accept"""
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def handshake_response(key):
+    """101 Switching Protocols 响应"""
+    return (
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"Sec-WebSocket-Accept: {accept_key(key)}\r\n"
+        "\r\n"
+    ).encode('ascii')
+
+
+def version_supported(request):
+    """握手请求的 Sec-WebSocket-Version 是否为 13（RFC 6455 §4.2.1）"""
+    return request.headers.get('sec-websocket-version', '').strip() == WEBSOCKET_VERSION
+
+
+def upgrade_required_response():
+    """不支持客户端请求的协议版本：426 并在 Sec-WebSocket-Version 中列出支持的版本（RFC 6455 §4.2.2）"""
+    return (
+        "HTTP/1.1 426 Upgrade Required\r\n"
+        f"Sec-WebSocket-Version: {WEBSOCKET_VERSION}\r\n"
+        "Content-Length: 0\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+    ).encode('ascii')
+
+
+def encode_frame(payload, opcode=OP_TEXT):
+    """编码一个服务器发出的（不加掩码的）完整帧"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def close_frame(code, reason=''):
+    """关闭帧"""
+    return encode_frame(struct.pack('!H', code) + reason.encode('utf-8'), OP_CLOSE)
+
+
+def unmask(data, mask):
+    """去除客户端帧的掩码（整数异或，避免逐字节循环）"""
+    if not data:
+        return data
+    length = len(data)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
+class WebSocketCodec:
+    """WebSocket 连接的消息编码：每条消息为一个 JSON 文本帧
+
+    与 chat_codec 中的编码接口一致，服务器广播时对所有 WebSocket 客户端只编码一次。
+    """
+    name = 'websocket'
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    @classmethod
+    def frame(cls, obj):
+        return encode_frame(cls.encode(obj))
+
+
+async def read_message(frames, writer):
+    """读取一条完整的客户端消息文本（合并分片，处理控制帧）
+
+    连接关闭时返回 None；消息超过 frames.max_size 时丢弃整条消息并抛出 FrameTooLarge。
+    """
+    parts = []
+    size = 0
+    oversize = False
+    while True:
+        header = await frames.readexactly(2)
+        if header is None:
+            return None
+        first, second = header
+        fin = first & 0x80
+        opcode = first & 0x0F
+        length = second & 0x7F
+
+        if length == 126:
+            extended = await frames.readexactly(2)
+            if extended is None:
+                return None
+            (length,) = struct.unpack('!H', extended)
+        elif length == 127:
+            extended = await frames.readexactly(8)
+            if extended is None:
+                return None
+            (length,) = struct.unpack('!Q', extended)
+
+        # 客户端发出的帧必须加掩码
+        if not second & 0x80:
+            writer.write(close_frame(CLOSE_PROTOCOL_ERROR, 'unmasked frame'))
+            return None
+        mask = await frames.readexactly(4)
+        if mask is None:
+            return None
+
+        if opcode >= OP_CLOSE:
+            if length > 125 or not fin:
+                writer.write(close_frame(CLOSE_PROTOCOL_ERROR, 'invalid control frame'))
+                return None
+            payload = await frames.readexactly(length)
+            if payload is None:
+                return None
+            payload = unmask(payload, mask)
+            if opcode == OP_CLOSE:
+                writer.write(encode_frame(payload[:2], OP_CLOSE))
+                return None
+            if opcode == OP_PING:
+                writer.write(encode_frame(payload, OP_PONG))
+            continue
+
+        size += length
+        if oversize or size > frames.max_size:
+            # 超长消息逐块丢弃，读到最后一个分片后报告
+            oversize = True
+            parts.clear()
+            frames.discard(length)
+        else:
+            payload = await frames.readexactly(length)
+            if payload is None:
+                return None
+            parts.append(unmask(payload, mask))
+
+        if fin:
+            if oversize:
+                raise FrameTooLarge(size, frames.max_size)
+            return b''.join(parts).decode('utf-8')
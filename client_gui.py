@@ -7,11 +7,17 @@ NeoChat GUI 客户端
 
 import socket
 import threading
+import time
 import tkinter as tk
 from tkinter import messagebox, ttk
 import json
 from datetime import datetime
 
+from chat_codec import CODEC_PREFERENCE, FRAME_HEADER, available_codecs, get_codec, pack_frame
+
+# 连接意外断开后的重连间隔（秒），总计与服务器默认的会话保留时间（60 秒）相当
+RECONNECT_DELAYS = (1, 2, 4, 8, 15, 30)
+
 
 def draw_rounded_rect(canvas, x1, y1, x2, y2, radius=15, **kwargs):
     """在 Canvas 上绘制圆角矩形"""
@@ -101,23 +107,31 @@ class RoundedButton(tk.Canvas):
         self._draw()
 
 class ChatClient:
-    def __init__(self):
+    def __init__(self, binary=False, resume=False):
         self.socket = None
         self.connected = False
         self.username = ""
         self.server_address = ""
         self.receive_thread = None
+        self.binary = binary  # 请求长度前缀分帧（msgpack/CBOR）
+        self.resume = resume  # 请求恢复令牌，断线后自动重连
+        self.codec = None  # 服务器确认的编码；None 表示换行分隔的 JSON
+        self.buffer = b""  # 握手后已收到但尚未处理的数据
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.host = None
+        self.port = None
+        self.resume_token = None  # 服务器发放的会话恢复令牌
+        self.last_seq = 0  # 收到的最新消息序号，重连时服务器从这里开始补发
+        self.reconnecting = False
         
     def connect(self, host, port, username):
         """连接到服务器"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(5)  # 设置5秒超时
-            self.socket.connect((host, port))
-            
-            # 发送用户名
-            self.socket.send(f"{username}\n".encode('utf-8'))
+            self._open(host, port)
+            self.host, self.port = host, port
             self.username = username
+            self._handshake(username)
             self.connected = True
             self.socket.settimeout(None)  # 取消超时限制
             return True, "连接成功"
@@ -128,8 +142,61 @@ class ChatClient:
         except Exception as e:
             return False, str(e)
     
+    def _open(self, host, port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(5)  # 设置5秒超时
+        self.socket.connect((host, port))
+    
+    def _handshake(self, username, resume=False):
+        """发送 hello 握手并读取服务器回复，协商分帧方式和编码；返回服务器是否恢复了原会话
+        
+        resume=True 时带上恢复令牌和最后收到的序号，服务器只补发断线期间错过的消息。
+        既不要求分帧也不要求重连时只发送用户名，不支持握手的旧服务器也能正常登录。
+        """
+        self.buffer = b""
+        if not (self.binary or self.resume):
+            self._send_raw(f"{username}\n".encode('utf-8'))
+            return False
+        hello = {
+            'type': 'hello',
+            'username': username,
+            'framing': 'length' if self.binary else 'line'
+        }
+        if self.binary:
+            codecs = available_codecs()
+            hello['codecs'] = [name for name in CODEC_PREFERENCE if name in codecs]
+        if resume:
+            hello['resume'] = self.resume_token
+            hello['last_seq'] = self.last_seq
+        self._send_raw((json.dumps(hello, ensure_ascii=False) + '\n').encode('utf-8'))
+        
+        # 回复是一行 JSON，后面可能紧跟着第一批帧
+        while b'\n' not in self.buffer:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ConnectionError("服务器在握手时关闭了连接")
+            self.bytes_received += len(data)
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        reply = json.loads(line.decode('utf-8'))
+        
+        if reply.get('type') == 'hello':
+            self.username = reply.get('username', username)
+            self.codec = get_codec(reply.get('codec')) if reply.get('framing') == 'length' else None
+            self.resume_token = reply.get('resume_token')
+            return bool(reply.get('resumed'))
+        # 不支持握手的旧服务器把 hello 当作了用户名，保留这一行交给接收线程
+        self.buffer = line + b'\n' + self.buffer
+        return False
+    
+    def _send_raw(self, data):
+        self.socket.sendall(data)
+        self.bytes_sent += len(data)
+    
     def disconnect(self):
-        """断开连接"""
+        """断开连接（主动退出：通知服务器不再保留会话）"""
+        if self.connected and not self.reconnecting:
+            self.send_message('/quit')
         self.connected = False
         if self.socket:
             try:
@@ -139,10 +206,13 @@ class ChatClient:
             self.socket = None
     
     def send_message(self, message):
-        """发送消息"""
-        if self.connected and self.socket:
+        """发送消息（重连期间返回 False）"""
+        if self.connected and self.socket and not self.reconnecting:
             try:
-                self.socket.send(f"{message}\n".encode('utf-8'))
+                if self.codec:
+                    self._send_raw(pack_frame(self.codec.encode(message)))
+                else:
+                    self._send_raw(f"{message}\n".encode('utf-8'))
                 return True
             except:
                 self.connected = False
@@ -150,42 +220,104 @@ class ChatClient:
         return False
     
     def receive_messages(self, callback):
-        """接收消息的线程函数"""
-        buffer = ""
+        """接收消息的线程函数
+        
+        callback 收到已解码的消息字典（无法解析的行收到原始字符串）。
+        连接意外断开时用恢复令牌自动重连，服务器补发断线期间的消息。
+        """
+        while self._receive_loop(callback) and self._reconnect(callback):
+            pass
+        
+        self.connected = False
+        self._notice(callback, '已断开与服务器的连接')
+    
+    def _receive_loop(self, callback):
+        """接收直到连接关闭，返回连接是否为意外断开"""
+        buffer, self.buffer = self.buffer, b""
         while self.connected:
             try:
-                data = self.socket.recv(4096).decode('utf-8')
+                # 先处理握手时已收到的数据，再继续接收
+                if self.codec:
+                    buffer = self._split_frames(buffer, callback)
+                else:
+                    while b'\n' in buffer:
+                        line, buffer = buffer.split(b'\n', 1)
+                        line = line.decode('utf-8').strip()
+                        if line:
+                            try:
+                                self._deliver(json.loads(line), callback)
+                            except ValueError:
+                                callback(line)
+                
+                data = self.socket.recv(65536)
                 if not data:
                     break
-                
+                self.bytes_received += len(data)
                 buffer += data
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line.strip():
-                        callback(line.strip())
                         
             except Exception as e:
                 if self.connected:
-                    callback(json.dumps({
-                        'type': 'system',
-                        'time': datetime.now().strftime('%H:%M:%S'),
-                        'message': f'连接错误: {e}'
-                    }))
+                    self._notice(callback, f'连接错误: {e}')
                 break
-        
-        self.connected = False
-        callback(json.dumps({
+        return self.connected
+    
+    def _reconnect(self, callback):
+        """用恢复令牌重新连接，成功时返回 True；没有令牌或用户已主动断开时返回 False"""
+        if not self.resume_token:
+            return False
+        self.reconnecting = True
+        try:
+            for attempt, delay in enumerate(RECONNECT_DELAYS, 1):
+                self._notice(callback, f'连接已断开，{delay} 秒后第 {attempt} 次重连...')
+                time.sleep(delay)
+                if not self.connected:
+                    return False
+                try:
+                    self.socket.close()
+                    self._open(self.host, self.port)
+                    resumed = self._handshake(self.username, resume=True)
+                    self.socket.settimeout(None)
+                except (OSError, ValueError):
+                    continue
+                if not resumed:
+                    self._notice(callback, f'会话已过期，已作为 {self.username} 重新加入')
+                return True
+            return False
+        finally:
+            self.reconnecting = False
+    
+    def _deliver(self, message, callback):
+        """记录消息序号后交给回调"""
+        if isinstance(message, dict) and isinstance(message.get('seq'), int):
+            self.last_seq = max(self.last_seq, message['seq'])
+        callback(message)
+    
+    def _notice(self, callback, text):
+        callback({
             'type': 'system',
             'time': datetime.now().strftime('%H:%M:%S'),
-            'message': '已断开与服务器的连接'
-        }))
+            'message': text
+        })
+    
+    def _split_frames(self, buffer, callback):
+        """从缓冲区中取出完整的长度前缀帧，返回剩余数据"""
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(buffer) - offset >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+            self._deliver(self.codec.decode(buffer[offset + header_size:end]), callback)
+            offset = end
+        return buffer[offset:]
 
 
 class LoginWindow:
     def __init__(self):
         self.window = tk.Tk()
         self.window.title("NeoChat - 登录")
-        self.window.geometry("460x360")
+        self.window.geometry("460x390")
         self.window.resizable(False, False)
         
         # 居中窗口
@@ -263,6 +395,24 @@ class LoginWindow:
         self.port_entry.pack(side=tk.LEFT)
         self.port_entry.insert(0, "17201")
         
+        # 二进制分帧（服务器不支持时自动回退到换行 JSON）
+        self.binary_var = tk.BooleanVar(value=False)
+        binary_check = ttk.Checkbutton(
+            main_frame,
+            text="使用二进制分帧（msgpack / CBOR，可节省流量）",
+            variable=self.binary_var
+        )
+        binary_check.pack(anchor=tk.W, pady=(0, 5))
+        
+        # 断线重连（需要支持 hello 握手的服务器）
+        self.resume_var = tk.BooleanVar(value=False)
+        resume_check = ttk.Checkbutton(
+            main_frame,
+            text="断线后自动重连（需要新版服务器）",
+            variable=self.resume_var
+        )
+        resume_check.pack(anchor=tk.W, pady=(0, 5))
+        
         # 连接按钮（圆角）
         btn_container = tk.Frame(main_frame, bg="white")
         btn_container.pack(fill=tk.X, pady=(10, 0))
@@ -310,7 +460,7 @@ class LoginWindow:
         self.window.update()
         
         # 创建客户端并连接
-        self.client = ChatClient()
+        self.client = ChatClient(binary=self.binary_var.get(), resume=self.resume_var.get())
         result = self.client.connect(host, port, username)
         
         if isinstance(result, tuple) and result[0] is True:
@@ -653,9 +803,9 @@ class ChatWindow:
         self.message_canvas.yview_moveto(1.0)
     
     def on_message_received(self, message_json):
-        """接收到消息的回调"""
+        """接收到消息的回调（通常收到已解码的消息字典）"""
         try:
-            msg = json.loads(message_json)
+            msg = message_json if isinstance(message_json, dict) else json.loads(message_json)
             
             if msg.get('type') == 'system':
                 self.window.after(0, self.add_system_message, msg.get('message', ''))
@@ -684,6 +834,10 @@ class ChatWindow:
             messagebox.showerror("错误", "未连接到服务器！")
             return
         
+        if self.client.reconnecting:
+            self.add_system_message("正在重新连接，消息未发送")
+            return
+        
         # 发送消息
         if self.client.send_message(message):
             # 立即显示自己发送的消息
@@ -0,0 +1,50 @@
+"""
+NeoChat 事件循环选择
+在标准 asyncio 事件循环和 uvloop（已安装时）之间切换，未安装 uvloop 时自动回退
+"""
+
+import asyncio
+import sys
+
+# 可选的事件循环: asyncio=标准循环, uvloop=优先 uvloop, auto=已安装 uvloop 时使用
+LOOP_CHOICES = ('asyncio', 'uvloop', 'auto')
+
+
+def resolve_loop(name='asyncio'):
+    """返回 (loop_factory, 实际使用的事件循环名称)，loop_factory 为 None 表示标准循环"""
+    if name not in LOOP_CHOICES:
+        raise ValueError(f"未知的事件循环: {name}")
+
+    if name == 'asyncio':
+        return None, 'asyncio'
+
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            print("⚠ 未安装 uvloop，回退到标准 asyncio 事件循环（pip install uvloop）")
+        return None, 'asyncio'
+
+    return uvloop.new_event_loop, 'uvloop'
+
+
+def new_event_loop(name='asyncio'):
+    """按名称创建事件循环"""
+    factory, _ = resolve_loop(name)
+    return factory() if factory else asyncio.new_event_loop()
+
+
+def run(main, loop='asyncio'):
+    """与 asyncio.run 相同，但使用指定的事件循环"""
+    factory, _ = resolve_loop(loop)
+
+    if factory is None:
+        return asyncio.run(main)
+
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=factory) as runner:
+            return runner.run(main)
+
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
@@ -0,0 +1,259 @@
+"""
+NeoChat 日志压缩与保留策略
+后台线程定期检查 chat_logs/：已关闭的聊天日志段（同一前缀下已有更新的段）和旧版 JSON 日志
+交给独立的工作进程用标准库编码（gzip / lzma / bz2）压缩，事件循环和请求线程不受影响。
+随后按最长保留时间和目录总大小删除最旧的归档。所有归档记录在 manifest.json 中，
+chat_wal.read_records() 可以直接读取压缩后的段，其他文件可用 chat_wal.open_log() 打开。
+
+用法: python log_retention.py [目录] [--compress gzip] [--max-age-days 30] [--max-size-mb 1024]   # 执行一次
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from chat_wal import ARCHIVE_OPENERS, SEGMENT_SUFFIX
+
+# 压缩编码: 扩展名
+CODECS = {
+    'gzip': '.gz',
+    'lzma': '.xz',
+    'bz2': '.bz2',
+}
+COMPRESS_CHOICES = tuple(CODECS) + ('none',)
+
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_SIZE_MB = 1024
+DEFAULT_INTERVAL = 10 * 60
+
+SEGMENT_PATTERN = re.compile(r'^(.+)-(\d{6})' + re.escape(SEGMENT_SUFFIX) + r'$')
+LEGACY_PATTERN = re.compile(r'^chat_log_.*\.json$')
+ARCHIVE_PATTERN = re.compile(r'\.(gz|xz|bz2)$')
+
+
+def compress_file(path, codec, level=None):
+    """在工作进程中压缩一个文件：先写临时文件并落盘，再替换原文件
+
+    返回归档信息（NDJSON 段同时统计记录数和序号范围）。
+    """
+    extension = CODECS[codec]
+    opener = ARCHIVE_OPENERS[extension]
+    archive = path + extension
+    temp = archive + '.tmp'
+    kwargs = {}
+    if level is not None:
+        kwargs['preset' if codec == 'lzma' else 'compresslevel'] = level
+
+    records = 0
+    first_seq = last_seq = None
+    is_segment = path.endswith(SEGMENT_SUFFIX)
+    with open(path, 'rb') as src, opener(temp, 'wb', **kwargs) as dst:
+        if is_segment:
+            for line in src:
+                dst.write(line)
+                records += 1
+                try:
+                    seq = json.loads(line).get('seq')
+                except ValueError:
+                    continue
+                if seq is not None:
+                    first_seq = seq if first_seq is None else first_seq
+                    last_seq = seq
+        else:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    with open(temp, 'rb') as f:
+        os.fsync(f.fileno())
+
+    stat = os.stat(path)
+    os.replace(temp, archive)
+    os.utime(archive, (stat.st_atime, stat.st_mtime))  # 保留原修改时间，用于按时间清理
+    os.remove(path)
+    return {
+        'file': os.path.basename(archive),
+        'source': os.path.basename(path),
+        'codec': codec,
+        'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'original_bytes': stat.st_size,
+        'compressed_bytes': os.path.getsize(archive),
+        'records': records if is_segment else None,
+        'first_seq': first_seq,
+        'last_seq': last_seq,
+    }
+
+
+class LogRetention:
+    """日志目录的压缩和保留管理（后台线程调度，压缩在单独进程中执行）"""
+
+    def __init__(self, directory, compress='gzip', level=None, max_age_days=DEFAULT_MAX_AGE_DAYS,
+                 max_size_mb=DEFAULT_MAX_SIZE_MB, interval=DEFAULT_INTERVAL, log=None):
+        if compress not in COMPRESS_CHOICES:
+            raise ValueError(f"未知的压缩编码: {compress}")
+        self.directory = directory
+        self.compress = None if compress == 'none' else compress
+        self.level = level
+        self.max_age = max_age_days * 86400 if max_age_days else None  # 0 表示不按时间清理
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb else None  # 0 表示不限大小
+        self.interval = interval
+        self.log = log  # log(message, level)
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.executor = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.compressed_count = 0
+        self.removed_count = 0
+
+    def start(self):
+        """启动后台线程（立即执行一次检查）"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='log-retention', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self._log(f"日志保留任务错误: {type(e).__name__}: {e}", 'ERROR')
+            self.stop_event.wait(self.interval)
+
+    def _log(self, message, level='INFO'):
+        if self.log:
+            self.log(message, level)
+
+    def closed_files(self):
+        """可以压缩的文件：每个前缀下最新段以外的未压缩段，以及旧版 JSON 日志"""
+        latest = {}
+        segments = []
+        legacy = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                prefix, index = match.group(1), int(match.group(2))
+                segments.append((prefix, index, name))
+                latest[prefix] = max(latest.get(prefix, 0), index)
+            elif LEGACY_PATTERN.match(name):
+                legacy.append(name)
+        closed = [name for prefix, index, name in segments if index < latest[prefix]]
+        return [os.path.join(self.directory, name) for name in sorted(closed) + sorted(legacy)]
+
+    def run_once(self):
+        """执行一次压缩和清理"""
+        if self.compress:
+            paths = self.closed_files()
+            if paths:
+                if self.executor is None:
+                    # spawn：不从带有事件循环和日志线程的进程 fork
+                    self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+                futures = [(path, self.executor.submit(compress_file, path, self.compress, self.level))
+                           for path in paths]
+                entries = []
+                for path, future in futures:
+                    try:
+                        entries.append(future.result())
+                    except Exception as e:
+                        self._log(f"压缩日志失败: {os.path.basename(path)}: {e}", 'ERROR')
+                if entries:
+                    self.compressed_count += len(entries)
+                    original = sum(entry['original_bytes'] for entry in entries)
+                    compressed = sum(entry['compressed_bytes'] for entry in entries)
+                    self._log(f"✓ 已压缩 {len(entries)} 个日志文件: {original // 1024} KB → {compressed // 1024} KB", 'SUCCESS')
+                    self._update_manifest(added=entries)
+        self._enforce_limits()
+
+    def _enforce_limits(self):
+        """删除超过保留时间的归档，总大小超限时从最旧的归档开始删除（不删除仍在写入的段）"""
+        archives = []
+        total = 0
+        # 不压缩时，已关闭的原始文件也按保留策略删除
+        deletable = set() if self.compress else {os.path.basename(path) for path in self.closed_files()}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            total += stat.st_size
+            if ARCHIVE_PATTERN.search(name) or name in deletable:
+                archives.append((stat.st_mtime, name, stat.st_size))
+        archives.sort()
+
+        now = time.time()
+        removed = []
+        for mtime, name, size in archives:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            oversize = self.max_size is not None and total > self.max_size
+            if not expired and not oversize:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                self._log(f"删除日志失败: {name}: {e}", 'ERROR')
+                continue
+            total -= size
+            removed.append(name)
+
+        if removed:
+            self.removed_count += len(removed)
+            self._log(f"✓ 按保留策略删除了 {len(removed)} 个旧日志 | 目录大小 {total // 1024} KB", 'SUCCESS')
+            self._update_manifest(removed=removed)
+
+    def load_manifest(self):
+        """读取归档索引 {'archives': [...]}"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'archives': []}
+
+    def _update_manifest(self, added=(), removed=()):
+        """更新归档索引（先写临时文件再替换，读取方不会看到半个文件）"""
+        manifest = self.load_manifest()
+        removed = set(removed)
+        archives = [entry for entry in manifest.get('archives', []) if entry['file'] not in removed]
+        archives.extend(added)
+        manifest = {
+            'updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'archives': archives,
+        }
+        temp = self.manifest_path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(temp, self.manifest_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='压缩并清理 NeoChat 聊天日志（执行一次）')
+    parser.add_argument('directory', nargs='?', default='chat_logs', help='日志目录 (默认 chat_logs)')
+    parser.add_argument('--compress', choices=COMPRESS_CHOICES, default='gzip', help='压缩编码 (默认 gzip)')
+    parser.add_argument('--max-age-days', type=float, default=DEFAULT_MAX_AGE_DAYS,
+                        help=f'归档最长保留天数，0 表示不限 (默认 {DEFAULT_MAX_AGE_DAYS})')
+    parser.add_argument('--max-size-mb', type=float, default=DEFAULT_MAX_SIZE_MB,
+                        help=f'日志目录总大小上限（MB），0 表示不限 (默认 {DEFAULT_MAX_SIZE_MB})')
+    args = parser.parse_args()
+
+    retention = LogRetention(args.directory, args.compress, max_age_days=args.max_age_days,
+                             max_size_mb=args.max_size_mb, log=lambda message, level: print(f"[{level}] {message}"))
+    try:
+        retention.run_once()
+    finally:
+        retention.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,10 @@ NeoChat HTTPS 服务端
 """
 
 import asyncio
+import argparse
 import json
 from datetime import datetime
+import multiprocessing
 import signal
 import sys
 import platform
@@ -18,6 +20,18 @@ import ssl
 import os
 import time
 
+import chat_logging
+import chat_metrics
+import event_loop
+from chat_metrics import MetricsRegistry, start_metrics_thread
+from chat_codec import FrameReader
+from chat_http import (COMPRESS_MIN_SIZE, CORS_HEADERS, DEFAULT_COMPRESS_LEVEL, KEEPALIVE_TIMEOUT,
+                       MAX_KEEPALIVE_REQUESTS, HTTPError, accepted_encoding, build_response, compress,
+                       etag_matches, json_response, poll_wait, read_request)
+from chat_history import MessageHistory
+from chat_wal import ChatLog
+from log_retention import LogRetention
+
 class Colors:
     """终端颜色代码"""
     HEADER = '\033[95m'
@@ -29,52 +43,141 @@ class Colors:
     ENDC = '\033[0m'
     BOLD = '\033[1m'
 
+# SSE 推送（GET /stream）：无新消息时每隔 SSE_KEEPALIVE 秒写一行注释保持连接，
+# 并建议浏览器断线 SSE_RETRY_MS 毫秒后重连；最近 SSE_CACHE_SIZE 条消息的事件编码被缓存复用
+SSE_KEEPALIVE = 15
+SSE_RETRY_MS = 3000
+SSE_CACHE_SIZE = 1024
+
+# GET /messages 的响应体按 (since, wait) 缓存，下一条消息到达时整体失效；
+# 大部分轮询没有新消息、落在同一个游标上，命中缓存时不加锁、不切片、不序列化
+POLL_CACHE_SIZE = 256
+
+# 两种 HTTP 引擎：asyncio（默认，单个事件循环处理所有连接）和 threaded（每个连接一个线程）
+ENGINES = ('asyncio', 'threaded')
+DEFAULT_MAX_CONNECTIONS = 10000
+LISTEN_BACKLOG = 128  # 长轮询客户端在新消息到达时同时重新连接，默认的 5 会导致 SYN 重传
+REQUEST_TIMEOUT = 30.0  # 读取连接上第一个请求的最长时间（秒）
+REJECT_LINGER = 1.0  # 拒绝超出上限的连接时，等待读掉客户端请求的最长时间（秒）
+
+SESSION_EXPIRED = {
+    'error': '会话已失效，请重新登录',
+    'session_expired': True
+}
+
+# 两个引擎对不支持的请求方法都返回 405 JSON 响应
+UNSUPPORTED_METHOD = {'error': '不支持的请求方法'}
+UNSUPPORTED_METHOD_HEADERS = dict(CORS_HEADERS, Allow=CORS_HEADERS['Access-Control-Allow-Methods'])
+
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream; charset=utf-8',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',  # 禁止反向代理缓冲事件
+    'Access-Control-Allow-Origin': '*',
+}
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>NeoChat HTTP Server</title>
+</head>
+<body>
+    <h1>🚀 NeoChat HTTP 服务器</h1>
+    <p>服务器运行中</p>
+    <h2>API 端点:</h2>
+    <ul>
+        <li>POST /join?username=xxx - 加入聊天</li>
+        <li>POST /message - 发送消息 (JSON: {session_id, message})</li>
+        <li>GET /messages?since=0&amp;wait=25 - 获取消息（wait 为长轮询的最长等待秒数）</li>
+        <li>GET /stream?session_id=xxx - SSE 推送消息（断线后按 Last-Event-ID 续传）</li>
+        <li>POST /leave - 离开聊天 (JSON: {session_id})</li>
+    </ul>
+</body>
+</html>
+"""
+
 class HTTPChatServer:
-    def __init__(self, host='0.0.0.0', port=9999, use_ssl=False, certfile=None, keyfile=None):
+    def __init__(self, host='0.0.0.0', port=9999, use_ssl=False, certfile=None, keyfile=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, compress_min_size=COMPRESS_MIN_SIZE):
         self.host = host
         self.port = port
         self.use_ssl = use_ssl
         self.certfile = certfile
         self.keyfile = keyfile
+        # 响应体压缩：不小于 compress_min_size 字节的 JSON 响应按 Accept-Encoding 压缩，级别为 0 时不压缩
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
         self.clients = {}  # {session_id: username}
         self.username_to_session = {}  # {username: session_id} 用户名到会话的映射
         self.client_activity = {}  # {session_id: last_active_time}
-        self.messages = []  # 消息历史
+        # 消息历史：固定容量的环形缓冲区；每条消息同时追加到聊天日志，淘汰时无需再保存
+        self.history = MessageHistory()
         self.message_count = 0
         self.start_time = datetime.now()
         self.is_running = True
         self.session_counter = 0
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()  # messages_body 持锁时调用 get_messages 会再次获取
+        self.new_message = threading.Condition(self.lock)  # 长轮询请求和 SSE 推送在此等待新消息
+        self.sse_events = {}  # {seq: 编码后的 SSE 事件}，所有推送连接共享
+        self.sse_streams = 0  # 打开的 SSE 推送连接数
+        self.poll_cache = {}  # {(since, wait): (响应体, ETag, 消息数, {编码: 压缩后的响应体})}，record_message 时换成新的空字典
+        self.etag_prefix = format(int(time.time()), 'x')  # 区分服务器重启前后相同的消息序号
+        self.on_message = None  # 新消息回调（asyncio 引擎用它唤醒等待者），在持有 self.lock 时调用
         self.session_timeout = 300  # 5分钟无活动则超时
         
-        # 日志相关
+        # 日志相关：每条消息到达时追加写入聊天日志（组提交）
         self.log_dir = 'chat_logs'
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
+        self.chat_log = ChatLog(self.log_dir, 'http', log=self.log)
+        
+        # 运行指标：请求在多个线程中处理，指标更新时加锁
+        self.metrics = MetricsRegistry(thread_safe=True)
+        self._register_metrics()
         
         # 启动会话清理线程
         self.cleanup_thread = threading.Thread(target=self._cleanup_inactive_sessions, daemon=True)
         self.cleanup_thread.start()
         
-        # 启动定时日志保存和内存清理线程（每3小时）
+        # 启动定时会话快照线程（每3小时）
         self.periodic_task_thread = threading.Thread(target=self._periodic_save_and_clear, daemon=True)
         self.periodic_task_thread.start()
         
-    def log(self, message, level='INFO'):
-        """格式化日志输出"""
-        timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        colors = {
-            'INFO': Colors.CYAN,
-            'SUCCESS': Colors.GREEN,
-            'WARNING': Colors.YELLOW,
-            'ERROR': Colors.RED,
-            'MESSAGE': Colors.BLUE,
-            'SYSTEM': Colors.HEADER
-        }
-        
-        color = colors.get(level, Colors.ENDC)
-        print(f"{color}[{timestamp}] [{level}]{Colors.ENDC} {message}")
+    ENDPOINTS = ('/', '/join', '/message', '/messages', '/stream', '/leave')
+    
+    def _register_metrics(self):
+        """注册指标：请求计数和耗时，以及输出时才计算的当前值"""
+        m = self.metrics
+        self.m_requests = m.counter('http_requests_total', 'HTTP 请求数（按方法、端点和状态码）',
+                                    ('method', 'endpoint', 'status'))
+        self.m_request_seconds = m.histogram('http_request_seconds', '处理 HTTP 请求的耗时（秒，按端点）', ('endpoint',))
+        self.m_joins = m.counter('joins_total', '加入聊天室的次数')
+        self.m_leaves = m.counter('leaves_total', '离开聊天室的次数（包括超时）')
+        self.m_messages_in = m.counter('messages_received_total', '收到的客户端消息数（包括命令）')
+        self.m_messages_out = m.counter('messages_sent_total', '轮询响应中返回的消息数')
+        self.m_bytes_in = m.counter('bytes_received_total', '读取的请求体字节数')
+        self.m_bytes_out = m.counter('bytes_sent_total', '发送的响应体字节数')
+        self.m_poll_cache_hits = m.counter('poll_cache_hits_total', '直接使用缓存响应体的 GET /messages 请求数')
+        self.m_compressed = m.counter('http_compressed_total', '压缩后发送的响应数（按编码）', ('encoding',))
+        self.m_connections = m.counter('http_connections_total', '接受的 HTTP 连接数（持久连接上的多个请求只算一次）')
+        m.counter('history_evicted_total', '被挤出内存历史的消息数', fn=lambda: self.history.evicted_count)
+        m.gauge('sessions', '在线会话数', fn=lambda: len(self.clients))
+        m.gauge('sse_streams', '打开的 SSE 推送连接数', fn=lambda: self.sse_streams)
+        m.gauge('history_messages', '内存历史中的消息数', fn=lambda: len(self.history))
+        m.gauge('chat_log_pending_records', '聊天日志中等待组提交的记录数',
+                fn=lambda: self.chat_log.appended_count - self.chat_log.committed_count)
+    
+    def record_request(self, method, path, status, size, started, encoding=None):
+        """记录一次请求的指标（未知路径归为 other，避免标签无限增长）；size 为实际发送（压缩后）的字节数"""
+        endpoint = path if path in self.ENDPOINTS else 'other'
+        self.m_requests.labels(method, endpoint, str(status)).inc()
+        self.m_request_seconds.labels(endpoint).observe(time.perf_counter() - started)
+        self.m_bytes_out.inc(size)
+        if encoding:
+            self.m_compressed.labels(encoding).inc()
+    
+    def log(self, message, level='INFO', **fields):
+        """日志输出（交给后台线程写出，不阻塞请求线程；fields 只出现在 JSON 格式的日志中）"""
+        chat_logging.log(message, level, **fields)
     
     def get_time(self):
         """获取当前时间字符串"""
@@ -110,6 +213,7 @@ class HTTPChatServer:
                             username = self.clients[session_id]
                             del self.clients[session_id]
                             del self.client_activity[session_id]
+                            self.m_leaves.inc()
                             
                             # 清理用户名映射
                             if username in self.username_to_session and self.username_to_session[username] == session_id:
@@ -120,27 +224,32 @@ class HTTPChatServer:
                                 'time': self.get_time(),
                                 'message': f"{username} 连接超时，已离开聊天室"
                             }
-                            self.messages.append(leave_msg)
+                            self.record_message(leave_msg)
                             self.log(f"✗ {username} 会话超时 | 剩余: {len(self.clients)}人", 'WARNING')
                             
             except Exception as e:
                 self.log(f"会话清理错误: {e}", 'ERROR')
     
+    def record_message(self, message):
+        """保存消息到历史（分配序号）并追加到聊天日志（调用方持有 self.lock）"""
+        self.history.append(message)
+        self.chat_log.append(message)
+        self.poll_cache = {}
+        self.new_message.notify_all()
+        if self.on_message:
+            self.on_message()
+    
     def _save_logs_to_file(self):
-        """保存对话和用户访问情况到日志文件"""
+        """把在线会话快照写入聊天日志，并等待此前的消息全部落盘"""
         try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            log_file = os.path.join(self.log_dir, f'chat_log_{timestamp}.json')
-            
             with self.lock:
-                log_data = {
-                    'save_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                self.chat_log.append({
+                    'type': 'snapshot',
+                    'time': self.get_time(),
                     'server_start_time': self.start_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'total_messages': len(self.messages),
+                    'last_seq': self.history.last_seq,
                     'message_count': self.message_count,
-                    'current_online_users': len(self.clients),
                     'online_users': list(self.clients.values()),
-                    'messages': self.messages.copy(),
                     'session_info': [
                         {
                             'session_id': sid,
@@ -149,33 +258,21 @@ class HTTPChatServer:
                         }
                         for sid, uname in self.clients.items()
                     ]
-                }
+                })
+                online_count = len(self.clients)
             
-            with open(log_file, 'w', encoding='utf-8') as f:
-                json.dump(log_data, f, ensure_ascii=False, indent=2)
+            if not self.chat_log.sync():
+                self.log("保存日志超时", 'ERROR')
+                return False
             
-            self.log(f"✓ 日志已保存: {log_file} | 消息数: {len(self.messages)} | 在线用户: {len(self.clients)}", 'SUCCESS')
+            self.log(f"✓ 日志已保存: {self.chat_log.segment_path} | 最新序号: {self.history.last_seq} | 在线用户: {online_count}", 'SUCCESS')
             return True
         except Exception as e:
             self.log(f"保存日志失败: {e}", 'ERROR')
             return False
     
-    def _clear_memory(self):
-        """清除内存中的消息历史和旧的活动记录"""
-        try:
-            with self.lock:
-                old_message_count = len(self.messages)
-                self.messages.clear()
-                self.message_count = 0
-                # 保留当前在线用户的会话，但清空离线用户的记录
-                self.log(f"✓ 内存已清理: 清除了 {old_message_count} 条消息", 'SUCCESS')
-            return True
-        except Exception as e:
-            self.log(f"清理内存失败: {e}", 'ERROR')
-            return False
-    
     def _periodic_save_and_clear(self):
-        """定期（每3小时）保存日志并清理内存"""
+        """定期（每3小时）记录在线会话快照（消息在到达时已写入聊天日志）"""
         interval = 3 * 60 * 60  # 3小时（秒）
         
         while self.is_running:
@@ -186,12 +283,9 @@ class HTTPChatServer:
                 if not self.is_running:
                     break
                 
-                self.log("开始执行定期日志保存和内存清理...", 'SYSTEM')
+                self.log("开始执行定期会话快照...", 'SYSTEM')
                 
-                # 1. 保存日志
                 if self._save_logs_to_file():
-                    # 2. 清理内存
-                    self._clear_memory()
                     self.log("定期任务完成", 'SUCCESS')
                 else:
                     self.log("定期任务失败：日志保存失败", 'ERROR')
@@ -238,6 +332,7 @@ class HTTPChatServer:
             self.clients[session_id] = username
             self.username_to_session[username] = session_id
             self.client_activity[session_id] = datetime.now()
+            self.m_joins.inc()
             
             # 添加系统消息
             join_msg = {
@@ -245,7 +340,7 @@ class HTTPChatServer:
                 'time': self.get_time(),
                 'message': f"{username} 加入了聊天室"
             }
-            self.messages.append(join_msg)
+            self.record_message(join_msg)
             
             self.log(f"✓ {username} 加入聊天室 | 会话: {session_id} | 在线人数: {len(self.clients)}", 'SUCCESS')
             
@@ -264,6 +359,7 @@ class HTTPChatServer:
                 
                 if session_id in self.client_activity:
                     del self.client_activity[session_id]
+                self.m_leaves.inc()
                 
                 # 添加系统消息
                 leave_msg = {
@@ -271,7 +367,7 @@ class HTTPChatServer:
                     'time': self.get_time(),
                     'message': f"{username} 离开了聊天室"
                 }
-                self.messages.append(leave_msg)
+                self.record_message(leave_msg)
                 
                 self.log(f"✗ {username} 离开聊天室 | 剩余: {len(self.clients)}人", 'INFO')
                 return True
@@ -285,32 +381,43 @@ class HTTPChatServer:
             
             # 更新活动时间
             self.client_activity[session_id] = datetime.now()
+            self.m_messages_in.inc()
             
             username = self.clients[session_id]
+            is_command = message.startswith('/')
             
-            # 检查是否是命令
-            if message.startswith('/'):
-                return self.handle_command(username, message)
-            
-            self.message_count += 1
-            
-            msg = {
-                'type': 'message',
-                'time': self.get_time(),
-                'username': username,
-                'message': message
-            }
-            self.messages.append(msg)
-            
-            self.log(f"{username}: {message[:50]}{'...' if len(message) > 50 else ''}", 'MESSAGE')
-            
-            return {'success': True, 'message': msg}
+            if not is_command:
+                self.message_count += 1
+                
+                msg = {
+                    'type': 'message',
+                    'time': self.get_time(),
+                    'username': username,
+                    'message': message
+                }
+                self.record_message(msg)
+                
+                self.log(f"{username}: {message[:50]}{'...' if len(message) > 50 else ''}", 'MESSAGE', username=username)
+                
+                return {'success': True, 'message': msg}
+        
+        return self.handle_command(username, message)
     
     def handle_command(self, username, command):
-        """处理客户端命令"""
+        """处理客户端命令（调用方不持有 self.lock）
+        
+        /savelog 要等待聊天日志落盘（最长 5 秒），在锁外执行；持锁等待会让其他所有请求一起卡住，
+        包括 asyncio 引擎事件循环上的 GET。
+        """
         parts = command.split()
         cmd = parts[0].lower()
+        saved = self._save_logs_to_file() if cmd == '/savelog' else False
         
+        with self.lock:
+            return self._command_response(username, command, cmd, saved)
+    
+    def _command_response(self, username, command, cmd, saved):
+        """生成并记录命令的回复（调用方持有 self.lock）"""
         response = None
         
         if cmd == '/help':
@@ -344,7 +451,7 @@ class HTTPChatServer:
             }
         
         elif cmd == '/savelog':
-            if self._save_logs_to_file():
+            if saved:
                 response = {
                     'type': 'system',
                     'time': self.get_time(),
@@ -365,17 +472,144 @@ class HTTPChatServer:
             }
         
         if response:
-            self.messages.append(response)
+            self.record_message(response)
             self.log(f"{username} 执行命令: {command}", 'SYSTEM')
         
         return {'success': True, 'message': response}
     
     def get_messages(self, since=0):
-        """获取消息（从指定索引开始）"""
+        """获取序号大于 since 的消息，返回 (消息列表, 最新序号)"""
         with self.lock:
-            return self.messages[since:]
+            last_seq = self.history.last_seq
+            if since > last_seq:
+                since = 0  # 服务器已重启，从头开始
+            return self.history.since(since), last_seq
     
-    def print_banner(self):
+    def wait_for_message(self, since, timeout):
+        """阻塞到出现序号大于 since 的消息或服务器停止，最多 timeout 秒（线程引擎使用）
+        
+        长轮询和 SSE 推送在此等待，等待期间释放锁，空闲的房间里挂起的请求不消耗 CPU。
+        """
+        with self.lock:
+            if since == self.history.last_seq:
+                self.new_message.wait_for(lambda: self.history.last_seq > since or not self.is_running, timeout)
+    
+    def messages_body(self, since, wait):
+        """GET /messages 的响应，返回 (序列化后的响应体, ETag, 消息数)
+        
+        同一 (since, wait) 的响应在下一条消息到达前不变：第一次请求序列化后放入缓存，之后的请求
+        不加锁直接复用。ETag 由服务器启动时间和最新序号组成，在下一条消息到达前同样不变。
+        """
+        key = (since, wait)
+        cached = self.poll_cache.get(key)
+        if cached is not None:
+            self.m_poll_cache_hits.inc()
+            return cached
+        with self.lock:
+            messages, last_seq = self.get_messages(since)
+            body = json.dumps({
+                'success': True,
+                'messages': messages,
+                'total': last_seq,
+                'wait': wait
+            }, ensure_ascii=False).encode('utf-8')
+            entry = (body, f'"{self.etag_prefix}-{last_seq}"', len(messages), {})
+            if len(self.poll_cache) < POLL_CACHE_SIZE:
+                self.poll_cache[key] = entry
+            return entry
+    
+    def poll_response(self, since, wait, accept_encoding):
+        """GET /messages 的响应，按 Accept-Encoding 压缩，返回 (响应体, ETag, 编码, 消息数)
+        
+        压缩结果随缓存的响应体保存，同一段历史（例如重连时的 since=0）每种编码只压缩一次；
+        压缩后的表示使用带编码后缀的 ETag，与未压缩的表示区分。
+        """
+        body, etag, count, compressed = self.messages_body(since, wait)
+        body, encoding = self.compress_body(body, accept_encoding, compressed)
+        if encoding:
+            etag = f'{etag[:-1]}-{encoding}"'
+        return body, etag, encoding, count
+    
+    def compress_body(self, body, accept_encoding, cache=None):
+        """按 Accept-Encoding 压缩响应体，返回 (响应体, 编码)；不压缩时编码为 None
+        
+        cache 为同一响应体已有的压缩结果 {编码: 字节串}，命中时直接复用，未命中时压缩后放入。
+        """
+        if not self.compress_level or len(body) < self.compress_min_size:
+            return body, None
+        encoding = accepted_encoding(accept_encoding)
+        if encoding is None:
+            return body, None
+        compressed = cache.get(encoding) if cache is not None else None
+        if compressed is None:
+            compressed = compress(body, encoding, self.compress_level)
+            if cache is not None:
+                cache[encoding] = compressed
+        return compressed, encoding
+    
+    def stream_chunk(self, session_id, since):
+        """SSE 推送的一次等待结束后要写出的数据，返回 (字节串, 新的 since, 是否结束推送)"""
+        messages, last_seq = self.get_messages(since)
+        if not self.update_activity(session_id):
+            # 会话已离开或超时，通知客户端不要再重连
+            return b'event: expired\ndata: {}\n\n', since, True
+        if messages:
+            self.m_messages_out.inc(len(messages))
+            return self.encode_events(messages), last_seq, False
+        return b': keepalive\n\n', since, False  # 注释行：保持连接，也能及时发现已断开的客户端
+    
+    def handle_post(self, path, query, data):
+        """POST 端点（/join、/message、/leave），返回 (状态码, 响应数据)"""
+        if path == '/join':
+            # 加入聊天
+            username = query.get('username', [''])[0] or data.get('username', 'Anonymous')
+            session_id, username = self.create_session(username)
+            return 200, {
+                'success': True,
+                'session_id': session_id,
+                'username': username,
+                'online_count': len(self.clients)
+            }
+        
+        if path == '/message':
+            # 发送消息
+            session_id = data.get('session_id', '')
+            message = data.get('message', '')
+            if not session_id or not message:
+                return 400, {'error': '缺少参数'}
+            return 200, self.send_message(session_id, message)
+        
+        if path == '/leave':
+            # 离开聊天
+            session_id = data.get('session_id', '')
+            if not session_id:
+                return 400, {'error': '缺少会话ID'}
+            self.remove_session(session_id)
+            return 200, {'success': True}
+        
+        return 404, {'error': '未找到端点'}
+    
+    def encode_events(self, messages):
+        """把消息编码为 SSE 事件（id 为消息序号）；每条消息只编码一次，各推送连接共享同一个 bytes 对象"""
+        with self.lock:
+            events = []
+            for message in messages:
+                seq = message['seq']
+                event = self.sse_events.get(seq)
+                if event is None:
+                    data = json.dumps(message, ensure_ascii=False)
+                    event = self.sse_events[seq] = f"id: {seq}\ndata: {data}\n\n".encode('utf-8')
+                events.append(event)
+            while len(self.sse_events) > SSE_CACHE_SIZE:
+                del self.sse_events[next(iter(self.sse_events))]  # 按插入顺序淘汰最早的条目
+            return b''.join(events)
+    
+    def wake_waiters(self):
+        """唤醒所有挂起的长轮询请求（关闭服务器时调用）"""
+        with self.lock:
+            self.new_message.notify_all()
+    
+    def print_banner(self, engine='asyncio'):
         """打印服务器启动横幅"""
         print("\n" + "═" * 60)
         print(f"{Colors.BOLD}{Colors.CYAN}      NeoChat HTTP 服务器{Colors.ENDC}")
@@ -383,6 +617,8 @@ class HTTPChatServer:
         print(f"{Colors.GREEN}✓{Colors.ENDC} 服务器已启动")
         print(f"{Colors.GREEN}✓{Colors.ENDC} 监听地址: {Colors.BOLD}{self.host}:{self.port}{Colors.ENDC}")
         print(f"{Colors.GREEN}✓{Colors.ENDC} 协议类型: {Colors.BOLD}HTTP/1.1{Colors.ENDC}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} HTTP 引擎: {Colors.BOLD}{engine}{Colors.ENDC}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 聊天日志: {Colors.BOLD}{self.chat_log.segment_path}{Colors.ENDC}")
         
         if self.host == '0.0.0.0':
             local_ip = self.get_local_ip()
@@ -395,19 +631,89 @@ class HTTPChatServer:
         print(f"{Colors.YELLOW}📝{Colors.ENDC} API 端点:")
         print(f"  • POST /join?username=xxx - 加入聊天")
         print(f"  • POST /message - 发送消息")
-        print(f"  • GET /messages?since=0 - 获取消息")
+        print(f"  • GET /messages?since=0&wait=25 - 获取消息（wait 秒内无新消息时挂起等待）")
+        print(f"  • GET /stream?session_id=xxx - SSE 推送消息（Last-Event-ID 续传）")
         print(f"  • POST /leave - 离开聊天")
         print(f"{Colors.YELLOW}💡{Colors.ENDC} 支持内网穿透 HTTP 隧道")
         print("═" * 60)
 
+def poll_query(query):
+    """解析 GET /messages 的查询参数，返回 (session_id, since, wait)"""
+    try:
+        since = int(query.get('since', ['0'])[0])
+    except ValueError:
+        since = 0
+    return query.get('session_id', [''])[0], since, poll_wait(query.get('wait', ['0'])[0])
+
+def response_headers(etag=None, encoding=None):
+    """JSON 响应的 CORS、缓存验证和压缩相关响应头"""
+    headers = dict(CORS_HEADERS)
+    if etag:
+        headers['ETag'] = etag
+        headers['Cache-Control'] = 'no-cache'  # 每次使用前都要带 If-None-Match 重新验证
+    if etag or encoding:
+        headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+def stream_since(last_event_id, query):
+    """SSE 推送的起点：断线重连时浏览器在 Last-Event-ID 请求头中带上最后收到的序号，首次连接可用 since 参数"""
+    try:
+        return int(last_event_id or query.get('since', ['0'])[0])
+    except ValueError:
+        return 0
+
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """多线程 HTTP 服务器"""
-    pass
+    daemon_threads = True  # 挂起的长轮询请求不阻止进程退出
+    request_queue_size = LISTEN_BACKLOG
 
-def create_handler(chat_server):
-    """创建请求处理器"""
+def create_handler(chat_server, keepalive_timeout=KEEPALIVE_TIMEOUT, max_requests=MAX_KEEPALIVE_REQUESTS):
+    """创建请求处理器
+    
+    使用 HTTP/1.1 持久连接：轮询请求复用同一个连接，连接空闲 keepalive_timeout 秒
+    或处理了 max_requests 个请求后关闭；keepalive_timeout 为 0 时每个响应后都关闭连接。
+    """
     
     class ChatHTTPRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        timeout = keepalive_timeout or REQUEST_TIMEOUT  # 等待下一个请求的最长时间（秒）
+        requests_handled = 0
+        
+        def setup(self):
+            super().setup()
+            chat_server.m_connections.inc()
+        
+        def end_headers(self):
+            """所有响应都经过这里：达到单连接请求数上限或服务器停止时告知客户端关闭连接"""
+            self.requests_handled += 1
+            if not self.close_connection:
+                if (not keepalive_timeout or self.requests_handled >= max_requests
+                        or not chat_server.is_running):
+                    self.send_header('Connection', 'close')  # 同时设置 close_connection
+                elif self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
+            super().end_headers()
+        
+        def send_error(self, code, message=None, explain=None):
+            """不支持的请求方法（BaseHTTPRequestHandler 默认返回 501 HTML 页面）与 asyncio 引擎一样返回 405 JSON
+            
+            HEAD 请求只发送响应头（Content-Length 仍为响应体长度），否则持久连接上的下一个响应会错位。
+            """
+            if code != 501:
+                super().send_error(code, message, explain)
+                return
+            body = json.dumps(UNSUPPORTED_METHOD, ensure_ascii=False).encode('utf-8')
+            self.send_response(405)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            for name, value in UNSUPPORTED_METHOD_HEADERS.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+        
         def log_message(self, format, *args):
             """禁用默认日志 - 防止HTTP请求头被记录为聊天消息"""
             pass
@@ -417,14 +723,67 @@ def create_handler(chat_server):
             pass
         
         def send_json_response(self, data, status=200):
-            """发送 JSON 响应"""
+            """发送 JSON 响应（较大的响应体按 Accept-Encoding 压缩）"""
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            body, encoding = chat_server.compress_body(body, self.headers.get('Accept-Encoding'))
+            self.send_json_body(body, status, encoding=encoding)
+        
+        def send_json_body(self, body, status=200, etag=None, encoding=None):
+            """发送已序列化（按 encoding 压缩）的 JSON 响应体；带 etag 时客户端每次使用前都要重新验证"""
             self.send_response(status)
             self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-            self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+            for name, value in response_headers(etag, encoding).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+            self.wfile.write(body)
+            chat_server.record_request(self.command, self.request_path, status, len(body), self.started, encoding)
+        
+        def send_not_modified(self, etag):
+            """If-None-Match 命中：304 没有响应体"""
+            self.send_response(304)
+            for name, value in response_headers(etag).items():
+                self.send_header(name, value)
+            self.end_headers()
+            chat_server.record_request(self.command, self.request_path, 304, 0, self.started)
+        
+        def stream_messages(self, query):
+            """SSE 推送：保持响应不结束，每条新消息写成一个事件，事件 id 为消息序号
+            
+            浏览器断线重连时在 Last-Event-ID 请求头中带上最后收到的序号，从下一条继续推送；
+            首次连接可用 since 参数指定起点。推送连接同时作为会话心跳。
+            """
+            session_id = query.get('session_id', [''])[0]
+            if not session_id or not chat_server.update_activity(session_id):
+                self.send_json_response(SESSION_EXPIRED, 401)
+                return
+            since = stream_since(self.headers.get('Last-Event-ID'), query)
+            
+            self.send_response(200)
+            for name, value in SSE_HEADERS.items():
+                self.send_header(name, value)
+            self.send_header('Connection', 'close')  # 不带 Content-Length，响应体持续到连接关闭
+            self.end_headers()
+            
+            with chat_server.lock:
+                chat_server.sse_streams += 1
+            size = 0
+            try:
+                chunk = f"retry: {SSE_RETRY_MS}\n\n".encode('ascii')
+                done = False
+                while True:
+                    self.wfile.write(chunk)
+                    size += len(chunk)
+                    if done or not chat_server.is_running:
+                        break
+                    chat_server.wait_for_message(since, SSE_KEEPALIVE)
+                    chunk, since, done = chat_server.stream_chunk(session_id, since)
+            except (ConnectionError, ssl.SSLError):
+                pass
+            finally:
+                with chat_server.lock:
+                    chat_server.sse_streams -= 1
+                chat_server.record_request('GET', '/stream', 200, size, self.started)
         
         def do_OPTIONS(self):
             """处理 CORS 预检请求"""
@@ -432,115 +791,330 @@ def create_handler(chat_server):
             self.send_header('Access-Control-Allow-Origin', '*')
             self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
             self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+            self.send_header('Content-Length', '0')
             self.end_headers()
         
         def do_GET(self):
             """处理 GET 请求"""
+            self.started = time.perf_counter()
             parsed_path = urllib.parse.urlparse(self.path)
-            path = parsed_path.path
+            path = self.request_path = parsed_path.path
             query = urllib.parse.parse_qs(parsed_path.query)
             
             if path == '/':
                 # 主页
+                body = INDEX_PAGE.encode('utf-8')
                 self.send_response(200)
                 self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
                 self.end_headers()
-                html = """
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <meta charset="utf-8">
-                    <title>NeoChat HTTP Server</title>
-                </head>
-                <body>
-                    <h1>🚀 NeoChat HTTP 服务器</h1>
-                    <p>服务器运行中</p>
-                    <h2>API 端点:</h2>
-                    <ul>
-                        <li>POST /join?username=xxx - 加入聊天</li>
-                        <li>POST /message - 发送消息 (JSON: {session_id, message})</li>
-                        <li>GET /messages?since=0 - 获取消息</li>
-                        <li>POST /leave - 离开聊天 (JSON: {session_id})</li>
-                    </ul>
-                </body>
-                </html>
-                """
-                self.wfile.write(html.encode('utf-8'))
+                self.wfile.write(body)
+                chat_server.record_request('GET', path, 200, len(body), self.started)
             
             elif path == '/messages':
                 # 获取消息（同时作为心跳）
-                since = int(query.get('since', ['0'])[0])
-                session_id = query.get('session_id', [''])[0]
+                session_id, since, wait = poll_query(query)
                 
                 # 验证会话并更新活动时间
                 if session_id and not chat_server.update_activity(session_id):
-                    self.send_json_response({
-                        'error': '会话已失效，请重新登录',
-                        'session_expired': True
-                    }, 401)
+                    self.send_json_response(SESSION_EXPIRED, 401)
                     return
                 
-                messages = chat_server.get_messages(since)
-                self.send_json_response({
-                    'success': True,
-                    'messages': messages,
-                    'total': len(chat_server.messages)
-                })
+                if wait:
+                    chat_server.wait_for_message(since, wait)
+                body, etag, encoding, count = chat_server.poll_response(
+                    since, wait, self.headers.get('Accept-Encoding'))
+                if etag_matches(self.headers.get('If-None-Match'), etag):
+                    self.send_not_modified(etag)
+                else:
+                    chat_server.m_messages_out.inc(count)
+                    self.send_json_body(body, etag=etag, encoding=encoding)
+            
+            elif path == '/stream':
+                self.stream_messages(query)
             
             else:
                 self.send_json_response({'error': '未找到端点'}, 404)
         
         def do_POST(self):
             """处理 POST 请求"""
+            self.started = time.perf_counter()
             parsed_path = urllib.parse.urlparse(self.path)
-            path = parsed_path.path
+            path = self.request_path = parsed_path.path
             query = urllib.parse.parse_qs(parsed_path.query)
             
             # 读取请求体
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length).decode('utf-8') if content_length > 0 else '{}'
+            chat_server.m_bytes_in.inc(content_length)
             
             try:
                 data = json.loads(body) if body else {}
             except:
                 data = {}
+            if not isinstance(data, dict):
+                data = {}
             
-            if path == '/join':
-                # 加入聊天
-                username = query.get('username', [''])[0] or data.get('username', 'Anonymous')
-                session_id, username = chat_server.create_session(username)
-                self.send_json_response({
-                    'success': True,
-                    'session_id': session_id,
-                    'username': username,
-                    'online_count': len(chat_server.clients)
-                })
-            
-            elif path == '/message':
-                # 发送消息
-                session_id = data.get('session_id', '')
-                message = data.get('message', '')
-                
-                if not session_id or not message:
-                    self.send_json_response({'error': '缺少参数'}, 400)
-                    return
+            status, result = chat_server.handle_post(path, query, data)
+            self.send_json_response(result, status)
+    
+    return ChatHTTPRequestHandler
+
+class AsyncHTTPServer:
+    """asyncio HTTP/1.1 引擎：在一个事件循环上处理所有连接，端点和响应格式与线程引擎相同
+    
+    事件循环运行在后台线程中（主线程运行控制台）。挂起的长轮询和 SSE 推送共享一个 Future，
+    不各自占用线程；同时打开的连接数达到 max_connections 时，新连接在接受后立即得到 503 并被关闭。
+    连接在响应后保持打开，按顺序处理后续请求（包括流水线发送的请求），空闲 keepalive_timeout 秒
+    或处理了 max_requests 个请求后关闭。
+    """
+    
+    def __init__(self, chat_server, host, port, max_connections=DEFAULT_MAX_CONNECTIONS, loop_name='asyncio',
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, max_requests=MAX_KEEPALIVE_REQUESTS):
+        self.chat_server = chat_server
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.loop_name = loop_name
+        self.loop = None
+        self.thread = None
+        self.thread_id = None
+        self.ready = threading.Event()  # 开始监听或启动失败
+        self.error = None
+        self.stopped = None  # asyncio.Event，shutdown() 时设置
+        self.connections = {}  # {连接处理任务: writer}
+        self.idle = set()  # 正在等待下一个请求的连接处理任务
+        self.waiter = None  # 长轮询和 SSE 推送共同等待的 Future，有新消息时完成
+        
+        m = chat_server.metrics
+        self.m_rejected = m.counter('http_connections_rejected_total', '因连接数达到上限而返回 503 并关闭的连接数')
+        m.gauge('http_connections', '打开的 HTTP 连接数（asyncio 引擎）', fn=lambda: len(self.connections))
+    
+    def start(self):
+        """在后台线程中启动事件循环，开始监听后返回；监听失败时抛出异常"""
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+    
+    def _run(self):
+        self.thread_id = threading.get_ident()
+        self.loop = event_loop.new_event_loop(self.loop_name)
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        except Exception as e:
+            self.error = e
+        finally:
+            self.loop.close()
+            self.ready.set()
+    
+    def shutdown(self):
+        """停止服务并等待事件循环线程结束（在其他线程中调用）"""
+        try:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        except (AttributeError, RuntimeError):
+            pass  # 尚未启动或事件循环已关闭
+        if self.thread:
+            self.thread.join(timeout=5)
+    
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=LISTEN_BACKLOG)
+        self.chat_server.on_message = self.notify
+        self.ready.set()
+        
+        await self.stopped.wait()
+        server.close()
+        self.chat_server.on_message = None
+        
+        # 空闲的持久连接直接关闭；挂起的长轮询和推送立即返回，响应后关闭连接
+        for task in self.idle:
+            self.connections[task].close()
+        self._wake()
+        if self.connections:
+            await asyncio.wait(self.connections, timeout=1.0)
+        for writer in self.connections.values():
+            writer.close()
+        if self.connections:
+            await asyncio.wait(self.connections, timeout=1.0)
+    
+    def notify(self):
+        """新消息到达时由 record_message 调用（也可能来自控制台或会话清理线程）"""
+        if threading.get_ident() == self.thread_id:
+            self._wake()
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+    
+    def _wake(self):
+        waiter = self.waiter
+        if waiter is not None:
+            self.waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+    
+    async def wait_for_message(self, since, timeout):
+        """挂起到出现序号大于 since 的消息或服务器停止，最多 timeout 秒"""
+        chat_server = self.chat_server
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while chat_server.history.last_seq == since and chat_server.is_running:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            if self.waiter is None:
+                self.waiter = loop.create_future()
+            await asyncio.wait([self.waiter], timeout=remaining)
+    
+    async def handle_connection(self, reader, writer):
+        """处理一个连接：按顺序处理连接上的请求，直到客户端或服务器不再保持连接"""
+        chat_server = self.chat_server
+        chat_server.m_connections.inc()
+        if len(self.connections) >= self.max_connections:
+            # 不读取请求、不登记连接，直接拒绝
+            self.m_rejected.inc()
+            writer.write(json_response({'error': '服务器繁忙，请稍后重试'}, 503))
+            try:
+                # 先关闭写方向，再短暂读掉客户端已发送的请求：接收缓冲区中有未读数据时直接关闭会发出 RST，
+                # 客户端可能收不到 503
+                writer.write_eof()
+                await asyncio.wait_for(reader.read(65536), timeout=REJECT_LINGER)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        frames = FrameReader(reader)
+        handled = 0
+        try:
+            while True:
+                # 流水线发送的请求已在 frames 的缓冲区中，逐个读出并按顺序响应
+                self.idle.add(task)
+                try:
+                    request = await asyncio.wait_for(
+                        read_request(frames), timeout=self.keepalive_timeout if handled else REQUEST_TIMEOUT)
+                except HTTPError as e:
+                    writer.write(json_response({'error': str(e)}, e.status))
+                    request = None
+                except (asyncio.TimeoutError, ConnectionError):
+                    request = None
+                finally:
+                    self.idle.discard(task)
+                if request is None:
+                    break
                 
-                result = chat_server.send_message(session_id, message)
-                self.send_json_response(result)
-            
-            elif path == '/leave':
-                # 离开聊天
-                session_id = data.get('session_id', '')
-                if session_id:
-                    chat_server.remove_session(session_id)
-                    self.send_json_response({'success': True})
+                handled += 1
+                started = time.perf_counter()
+                keep_alive = (request.keep_alive and chat_server.is_running and self.keepalive_timeout > 0
+                              and handled < self.max_requests)
+                if request.method == 'GET' and request.path == '/stream':
+                    await self.stream_messages(request, writer, started)
+                    keep_alive = False
                 else:
-                    self.send_json_response({'error': '缺少会话ID'}, 400)
-            
+                    writer.write(await self.handle_request(request, started, keep_alive))
+                await writer.drain()
+                if not keep_alive or not chat_server.is_running:
+                    break
+            await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            chat_server.log(f"HTTP 请求处理错误: {type(e).__name__}: {e}", 'ERROR')
+        finally:
+            del self.connections[task]
+            writer.close()
+    
+    async def handle_request(self, request, started, keep_alive=False):
+        """处理 /stream 以外的请求，返回完整的响应字节串（keep_alive 决定响应后是否保持连接）"""
+        chat_server = self.chat_server
+        method, path = request.method, request.path
+        
+        if method == 'OPTIONS':
+            return build_response(200, headers=CORS_HEADERS, keep_alive=keep_alive)
+        
+        if method == 'GET' and path == '/':
+            body = INDEX_PAGE.encode('utf-8')
+            chat_server.record_request(method, path, 200, len(body), started)
+            return build_response(200, body, 'text/html; charset=utf-8', keep_alive=keep_alive)
+        
+        if method == 'GET' and path == '/messages':
+            # 获取消息（同时作为心跳）
+            session_id, since, wait = poll_query(request.query)
+            if session_id and not chat_server.update_activity(session_id):
+                status, data = 401, SESSION_EXPIRED
             else:
-                self.send_json_response({'error': '未找到端点'}, 404)
+                if wait:
+                    await self.wait_for_message(since, wait)
+                    keep_alive = keep_alive and chat_server.is_running  # 等待期间服务器可能已停止
+                body, etag, encoding, count = chat_server.poll_response(
+                    since, wait, request.headers.get('accept-encoding'))
+                if etag_matches(request.headers.get('if-none-match'), etag):
+                    chat_server.record_request(method, path, 304, 0, started)
+                    return build_response(304, headers=response_headers(etag), keep_alive=keep_alive)
+                chat_server.m_messages_out.inc(count)
+                chat_server.record_request(method, path, 200, len(body), started, encoding)
+                return build_response(200, body, 'application/json; charset=utf-8', response_headers(etag, encoding),
+                                      keep_alive)
+        elif method == 'POST':
+            chat_server.m_bytes_in.inc(len(request.body))
+            # handle_post 要获取 chat_server.lock，/savelog 还会同步写盘，放到线程池中执行，不阻塞事件循环
+            status, data = await asyncio.get_running_loop().run_in_executor(
+                None, chat_server.handle_post, path, request.query, request.json())
+        elif method == 'GET':
+            status, data = 404, {'error': '未找到端点'}
+        else:
+            body = json.dumps(UNSUPPORTED_METHOD, ensure_ascii=False).encode('utf-8')
+            response = build_response(405, body, 'application/json; charset=utf-8', UNSUPPORTED_METHOD_HEADERS,
+                                      keep_alive)
+            # HEAD 请求只发送响应头（Content-Length 仍为响应体长度）
+            return response[:-len(body)] if method == 'HEAD' else response
+        
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        body, encoding = chat_server.compress_body(body, request.headers.get('accept-encoding'))
+        chat_server.record_request(method, path, status, len(body), started, encoding)
+        return build_response(status, body, 'application/json; charset=utf-8', response_headers(encoding=encoding),
+                              keep_alive)
     
-    return ChatHTTPRequestHandler
+    async def stream_messages(self, request, writer, started):
+        """SSE 推送（与线程引擎相同的事件格式），等待新消息时不占用线程"""
+        chat_server = self.chat_server
+        session_id = request.param('session_id')
+        if not session_id or not chat_server.update_activity(session_id):
+            body = json.dumps(SESSION_EXPIRED, ensure_ascii=False).encode('utf-8')
+            writer.write(build_response(401, body, 'application/json; charset=utf-8', CORS_HEADERS))
+            chat_server.record_request('GET', '/stream', 401, len(body), started)
+            return
+        since = stream_since(request.headers.get('last-event-id'), request.query)
+        
+        # 不带 Content-Length，响应体持续到连接关闭
+        head = ['HTTP/1.1 200 OK'] + [f"{name}: {value}" for name, value in SSE_HEADERS.items()] + ['Connection: close']
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        
+        with chat_server.lock:
+            chat_server.sse_streams += 1
+        size = 0
+        try:
+            chunk = f"retry: {SSE_RETRY_MS}\n\n".encode('ascii')
+            done = False
+            while True:
+                writer.write(chunk)
+                size += len(chunk)
+                await writer.drain()
+                if done or not chat_server.is_running:
+                    break
+                await self.wait_for_message(since, SSE_KEEPALIVE)
+                chunk, since, done = chat_server.stream_chunk(session_id, since)
+        finally:
+            with chat_server.lock:
+                chat_server.sse_streams -= 1
+            chat_server.record_request('GET', '/stream', 200, size, started)
 
 def server_console(chat_server):
     """服务器控制台"""
@@ -568,12 +1142,17 @@ def server_console(chat_server):
                 chat_server.log(f"运行时长: {uptime:.0f} 秒", 'SYSTEM')
                 chat_server.log(f"在线人数: {len(chat_server.clients)}", 'SYSTEM')
                 chat_server.log(f"消息总数: {chat_server.message_count}", 'SYSTEM')
+                chat_server.log(f"历史消息: {len(chat_server.history)} 条 | 最新序号 {chat_server.history.last_seq} | "
+                                f"已淘汰 {chat_server.history.evicted_count} 条", 'SYSTEM')
+                chat_server.log(chat_server.chat_log.summary(), 'SYSTEM')
+                chat_logging.flush()
                 print()
             
             elif message.lower() == 'list':
                 if chat_server.clients:
                     print()
                     chat_server.log(f"在线用户 ({len(chat_server.clients)}):", 'SYSTEM')
+                    chat_logging.flush()  # 列表直接打印，先写出排队的日志保持顺序
                     for session_id, username in chat_server.clients.items():
                         print(f"  • {username} ({session_id})")
                     print()
@@ -595,7 +1174,7 @@ def server_console(chat_server):
                         'username': 'Server',
                         'message': message
                     }
-                    chat_server.messages.append(broadcast_msg)
+                    chat_server.record_message(broadcast_msg)
                     chat_server.log(f"已广播: {message}", 'SUCCESS')
                     chat_server.message_count += 1
                     
@@ -611,38 +1190,81 @@ def signal_handler(sig, frame):
     print(f"\n{Colors.YELLOW}[系统] 收到中断信号{Colors.ENDC}")
     sys.exit(0)
 
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='NeoChat HTTP 服务器')
+    parser.add_argument('port', nargs='?', default='9999', help='监听端口 (默认 9999)')
+    parser.add_argument('--engine', choices=ENGINES, default='asyncio',
+                        help='HTTP 引擎: asyncio=单个事件循环处理所有连接, threaded=每个连接一个线程 (默认 asyncio)')
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help=f'asyncio 引擎同时打开的连接数上限，超出时返回 503 (默认 {DEFAULT_MAX_CONNECTIONS})')
+    parser.add_argument('--loop', choices=event_loop.LOOP_CHOICES, default='asyncio',
+                        help='asyncio 引擎使用的事件循环: asyncio, uvloop, auto (默认 asyncio)')
+    parser.add_argument('--keepalive-timeout', type=float, default=KEEPALIVE_TIMEOUT,
+                        help=f'持久连接空闲多少秒后关闭，0 表示每个响应后关闭连接 (默认 {KEEPALIVE_TIMEOUT})')
+    parser.add_argument('--max-keepalive-requests', type=int, default=MAX_KEEPALIVE_REQUESTS,
+                        help=f'一个连接最多处理的请求数 (默认 {MAX_KEEPALIVE_REQUESTS})')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=DEFAULT_COMPRESS_LEVEL,
+                        metavar='0-9', help=f'gzip/deflate 压缩级别，0 表示不压缩 (默认 {DEFAULT_COMPRESS_LEVEL})')
+    parser.add_argument('--compress-min-size', type=int, default=COMPRESS_MIN_SIZE,
+                        help=f'压缩的最小响应体字节数 (默认 {COMPRESS_MIN_SIZE})')
+    chat_metrics.add_arguments(parser)
+    chat_logging.add_arguments(parser)
+    return parser.parse_args()
+
 def main():
     """主函数"""
     signal.signal(signal.SIGINT, signal_handler)
     
-    port = 9999
-    if len(sys.argv) > 1:
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print(f"{Colors.RED}错误: 无效的端口号{Colors.ENDC}")
-            sys.exit(1)
+    args = parse_args()
+    try:
+        port = int(args.port)
+    except ValueError:
+        print(f"{Colors.RED}错误: 无效的端口号{Colors.ENDC}")
+        sys.exit(1)
+    chat_logging.configure_from_args(args)
+    
+    chat_server = HTTPChatServer(port=port, compress_level=args.compress_level,
+                                 compress_min_size=args.compress_min_size)
+    chat_server.print_banner(args.engine)
     
-    chat_server = HTTPChatServer(port=port)
-    chat_server.print_banner()
+    # 在后台压缩已关闭的日志段并按保留策略清理
+    retention = LogRetention(chat_server.log_dir, log=chat_server.log)
+    retention.start()
     
-    handler = create_handler(chat_server)
-    httpd = ThreadedHTTPServer((chat_server.host, chat_server.port), handler)
+    if args.engine == 'asyncio':
+        httpd = AsyncHTTPServer(chat_server, chat_server.host, chat_server.port, args.max_connections, args.loop,
+                                args.keepalive_timeout, args.max_keepalive_requests)
+        httpd.start()
+    else:
+        handler = create_handler(chat_server, args.keepalive_timeout, args.max_keepalive_requests)
+        httpd = ThreadedHTTPServer((chat_server.host, chat_server.port), handler)
+        # 在单独线程中运行服务器
+        server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        server_thread.start()
     
     chat_server.log("HTTP 服务器已就绪，等待连接...", 'SUCCESS')
     
-    # 在单独线程中运行服务器
-    server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
-    server_thread.start()
+    metrics_httpd = None
+    if args.metrics_port:
+        metrics_httpd = start_metrics_thread(chat_server.metrics, args.metrics_host, args.metrics_port)
+        chat_server.log(f"指标端口已就绪: http://{args.metrics_host}:{args.metrics_port}/metrics", 'SUCCESS')
     
     try:
         server_console(chat_server)
     except KeyboardInterrupt:
         print(f"\n{Colors.YELLOW}[服务器] 已关闭{Colors.ENDC}")
     finally:
+        chat_server.is_running = False
+        chat_server.wake_waiters()
         httpd.shutdown()
+        if metrics_httpd:
+            metrics_httpd.shutdown()
+        chat_server.chat_log.close()
+        retention.stop()
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # 打包后日志压缩进程池的子进程在这里接管，不进入 main()
     try:
         main()
     except KeyboardInterrupt:
@@ -4,8 +4,10 @@ NeoChat TCP 服务端
 """
 
 import asyncio
+import argparse
 import json
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 import signal
 import sys
 import platform
@@ -13,6 +15,24 @@ import socket
 import os
 import time
 import threading
+import multiprocessing
+import tempfile
+import secrets
+import re
+
+import event_loop
+import chat_logging
+from chat_metrics import MetricsRegistry, serve_metrics
+import chat_metrics
+from chat_codec import FrameReader, FrameTooLarge, negotiate, parse_hello, available_codecs
+from chat_history import DEFAULT_MAX_BYTES, DEFAULT_MAX_MESSAGES, MessageHistory
+from chat_wal import DEFAULT_FLUSH_MS, DEFAULT_SEGMENT_BYTES, ChatLog
+from log_retention import COMPRESS_CHOICES, DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_SIZE_MB, LogRetention
+from chat_http import (CORS_HEADERS, KEEPALIVE_TIMEOUT, MAX_KEEPALIVE_REQUESTS, HTTPError, build_response,
+                       is_http_request, json_response, poll_wait, read_request)
+from chat_websocket import WebSocketCodec, handshake_response, upgrade_required_response, version_supported
+import chat_websocket
+from tcp_cluster import ClusterHub, ClusterLink, cluster_supported
 
 class Colors:
     """终端颜色代码"""
@@ -25,42 +45,446 @@ class Colors:
     ENDC = '\033[0m'
     BOLD = '\033[1m'
 
+def log_line(message, level='INFO', prefix=None, **fields):
+    """日志输出（交给后台线程写出，不阻塞事件循环；prefix 用于区分多进程模式下的工作进程）"""
+    chat_logging.log(message, level, prefix, **fields)
+
+# 慢客户端处理策略
+SLOW_POLICIES = ('drop_oldest', 'disconnect', 'block')
+
+# 每次写入合并帧数的统计区间上界（最后一档为更大的批量）
+BATCH_BUCKETS = (1, 4, 16, 64)
+
+# 聊天消息的投递延迟阶段: (指标标签, 显示名称)
+LATENCY_STAGES = (
+    ('receive_to_enqueue', '收到→入队'),  # 读出消息到放入全部接收者的发送队列
+    ('enqueue_to_write', '入队→写出'),  # 每个接收者：入队到 drain() 完成
+    ('fanout', '总扇出'),  # 读出消息到最后一个接收者 drain() 完成
+)
+# 后两个阶段每条消息要逐接收者计时，默认每 10 条聊天消息跟踪一条（收到→入队每条都统计）
+DEFAULT_LATENCY_SAMPLE = 10
+
+# 新用户默认进入的房间
+DEFAULT_ROOM = 'lobby'
+MAX_ROOM_NAME = 32
+ROOM_NAME_PATTERN = re.compile(r'[\w-]+')  # 字母（包括中文）、数字、下划线和连字符
+DEFAULT_MAX_ROOMS = 1000  # 每个进程同时存在的房间数上限，空房间在最后一个成员离开时移除
+
+# HTTP 轮询会话超过此时间（秒）没有请求即视为离线（与 server_https.py 一致）
+POLL_SESSION_TIMEOUT = 300
+POLL_SWEEP_INTERVAL = 30
+
+# 断线后会话保留多少秒等待客户端带令牌重连
+DEFAULT_RESUME_GRACE = 60
+
+HTTP_INDEX_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>NeoChat</title></head>
+<body>
+<h1>NeoChat 服务器</h1>
+<p>此端口同时支持 TCP 客户端、WebSocket（ws://本地址）和 HTTP 轮询接口（/join、/messages、/message、/leave）。</p>
+</body></html>
+"""
+
+def valid_room_name(name):
+    """房间名不超过 MAX_ROOM_NAME 个字符，只能包含字母（包括中文）、数字、下划线和连字符"""
+    return 0 < len(name) <= MAX_ROOM_NAME and ROOM_NAME_PATTERN.fullmatch(name) is not None
+
+class ChatRoom:
+    """聊天房间（频道）：成员集合；本房间的历史是服务器消息历史按房间过滤的视图，不单独保存"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.members = set()  # {Session}
+        self.waiter = None  # 长轮询请求共同等待的 Future，房间有新消息时完成
+
+class Session:
+    """单个客户端连接的会话状态"""
+    
+    __slots__ = ('writer', 'username', 'address', 'ip', 'connect_time', 'outbox', 'room', 'codec',
+                 'inbox', 'last_active', 'token', 'resume_token', 'waiter', 'room_seqs')
+    
+    def __init__(self, writer, address, ip):
+        self.writer = writer
+        self.username = None  # 登录（发送用户名）前为 None
+        self.address = address
+        self.ip = ip
+        self.connect_time = datetime.now()
+        self.outbox = None  # ClientOutbox，登录后创建
+        self.room = None  # 当前所在房间名
+        self.codec = None  # 长度前缀帧的负载编码；None 表示换行分隔的 JSON
+        self.inbox = None  # HTTP 轮询会话：等待下次轮询取走的私人消息
+        self.last_active = time.monotonic()  # HTTP 轮询会话最近一次请求的时间
+        self.token = None  # HTTP 轮询会话的 session_id
+        self.resume_token = None  # 断线重连时用于恢复会话的令牌（hello 握手的客户端才有）
+        self.waiter = None  # HTTP 轮询会话：长轮询等待私人消息的 Future
+        self.room_seqs = {}  # {room_name: 离开该房间时的最新序号}，回到房间时只补发之后的消息
+    
+class SessionRegistry:
+    """在线会话表：按连接、用户名和 IP 建立索引，查找和去重均为 O(1)"""
+    
+    def __init__(self):
+        self.by_writer = {}  # {writer: Session} 已登录的会话
+        self.by_username = {}  # {username: Session}
+        self.by_ip = {}  # {ip_address: Session} 根据IP防止重复连接（包括尚未登录的连接）
+        self.name_counters = {}  # {基础用户名: 下一个尝试的后缀}
+        self.reserved = {}  # {username: Session} 断线后等待重连恢复的会话，用户名暂不释放
+    
+    def __len__(self):
+        return len(self.by_writer)
+    
+    def __iter__(self):
+        return iter(list(self.by_writer.values()))
+    
+    def get(self, writer):
+        """根据连接查找已登录的会话"""
+        return self.by_writer.get(writer)
+    
+    def usernames(self):
+        """在线用户名列表"""
+        return list(self.by_username)
+    
+    def unique_username(self, username):
+        """返回不与在线用户（包括等待恢复的会话）重名的用户名，重名时自动添加后缀"""
+        if username not in self.by_username and username not in self.reserved:
+            return username
+        counter = self.name_counters.get(username, 1)
+        candidate = f"{username}_{counter}"
+        while candidate in self.by_username or candidate in self.reserved:
+            counter += 1
+            candidate = f"{username}_{counter}"
+        self.name_counters[username] = counter + 1
+        return candidate
+    
+    def track_ip(self, session):
+        """记录 IP 最近的连接，返回被替换的旧会话（没有时为 None）"""
+        old_session = self.by_ip.get(session.ip)
+        self.by_ip[session.ip] = session
+        return old_session
+    
+    def add(self, session):
+        """登录完成后登记会话"""
+        self.by_writer[session.writer] = session
+        self.by_username[session.username] = session
+    
+    def remove(self, session):
+        """从所有索引中移除会话；索引已指向其他会话时保持不变"""
+        if self.by_writer.get(session.writer) is session:
+            del self.by_writer[session.writer]
+        if self.by_username.get(session.username) is session:
+            del self.by_username[session.username]
+        if self.by_ip.get(session.ip) is session:
+            del self.by_ip[session.ip]
+    
+    def is_registered(self, session):
+        """会话是否仍在在线表中"""
+        return self.by_writer.get(session.writer) is session
+    
+    def reserve(self, session):
+        """断线的会话等待恢复期间保留其用户名"""
+        self.reserved[session.username] = session
+    
+    def unreserve(self, session):
+        if self.reserved.get(session.username) is session:
+            del self.reserved[session.username]
+
+class PollingConnection:
+    """HTTP 轮询会话的占位连接：消息写入会话的 inbox，由下次轮询取走"""
+    
+    def close(self):
+        pass
+    
+    async def wait_closed(self):
+        pass
+    
+    def get_extra_info(self, name, default=None):
+        return default
+
+class Delivery:
+    """一条聊天消息的投递计时：收到时间、入队完成时间（perf_counter）和尚未写出的接收者数"""
+    
+    __slots__ = ('received', 'enqueued', 'pending')
+    
+    def __init__(self, received):
+        self.received = received
+        self.enqueued = received
+        self.pending = 0
+
+class ClientOutbox:
+    """单个客户端的有界发送队列，由独立的写任务负责排空"""
+    
+    def __init__(self, server, writer, maxsize=1024, policy='drop_oldest', slow_timeout=10.0, name='Unknown'):
+        self.server = server
+        self.writer = writer
+        self.name = name  # 日志中显示的用户名
+        self.maxsize = maxsize
+        self.policy = policy
+        self.slow_timeout = slow_timeout
+        self.queue = deque()
+        self.deliveries = deque()  # 与 queue 一一对应：需要计时的帧为 Delivery，其余为 None
+        self.tracked = 0  # deliveries 中 Delivery 的个数
+        self.ready = asyncio.Event()  # 队列中有待发送的数据
+        self.space = asyncio.Event()  # 队列有空位（block 策略使用）
+        self.space.set()
+        self.idle = asyncio.Event()  # 队列已全部写出
+        self.idle.set()
+        self.over_since = None  # 队列达到高水位的起始时间
+        self.dropped = 0
+        self.closed = False
+        self.task = asyncio.create_task(self._drain_loop())
+    
+    def put_nowait(self, data, wake=True, delivery=None):
+        """非阻塞入队；仅在 block 策略且队列已满时返回 False
+        
+        wake=False 时不立即唤醒写任务，由服务器的合并 tick 统一唤醒。
+        delivery 不为空时，帧写出后记录入队到写出的延迟。
+        """
+        if self.closed:
+            return True
+        
+        if len(self.queue) >= self.maxsize:
+            if self.policy == 'block':
+                self.space.clear()
+                return False
+            
+            if self.policy == 'disconnect':
+                now = time.monotonic()
+                if self.over_since is None:
+                    self.over_since = now
+                elif now - self.over_since > self.slow_timeout:
+                    self.server.log(f"{self.name} 发送队列持续满载超过 {self.slow_timeout:g} 秒，断开连接", 'WARNING')
+                    self.abort()
+                    return True
+            
+            # 丢弃最旧的消息，保证队列有界
+            self.queue.popleft()
+            dropped = self.deliveries.popleft()
+            if dropped is not None:
+                self.tracked -= 1
+                self.server.settle_delivery(dropped, time.perf_counter())
+            self.dropped += 1
+            self.server.dropped_messages += 1
+        
+        self.queue.append(data)
+        self.deliveries.append(delivery)
+        if delivery is not None:
+            delivery.pending += 1
+            self.tracked += 1
+        self.idle.clear()
+        if wake:
+            self.ready.set()
+        return True
+    
+    async def put(self, data, delivery=None):
+        """入队；block 策略下队列满时等待写任务腾出空位"""
+        while not self.put_nowait(data, delivery=delivery):
+            await self.space.wait()
+    
+    async def _drain_loop(self):
+        """写任务：把队列中积压的帧合并为一次 writelines 写入套接字"""
+        writer = self.writer
+        queue = self.queue
+        deliveries = self.deliveries
+        tracked = ()
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                
+                while queue:
+                    batch = list(queue)
+                    queue.clear()
+                    if self.tracked:
+                        tracked = [delivery for delivery in deliveries if delivery is not None]
+                        self.tracked = 0
+                    deliveries.clear()
+                    self.space.set()
+                    writer.writelines(batch)
+                    self.server.record_batch(len(batch))
+                    self.server.m_bytes_out.inc(sum(map(len, batch)))
+                    await writer.drain()
+                    if tracked:
+                        self.server.record_written(tracked, time.perf_counter())
+                        tracked = ()
+                
+                # 队列写空后才认为客户端已恢复
+                self.over_since = None
+                self.idle.set()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if not self.closed:
+                self.server.log(f"向 {self.name} 发送消息失败: {e}", 'WARNING')
+                now = time.perf_counter()
+                for delivery in tracked:
+                    self.server.settle_delivery(delivery, now)
+                self.abort()
+        finally:
+            self.idle.set()
+    
+    async def flush(self, timeout=2.0):
+        """等待队列写空（用于关闭前尽量送达最后的消息）"""
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def abort(self):
+        """立即断开连接，由 handle_client 负责后续清理"""
+        self.stop()
+        try:
+            self.writer.transport.abort()
+        except Exception:
+            pass
+    
+    def stop(self):
+        """停止写任务并丢弃未发送的数据"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        # 未写出的消息不再等待这个接收者
+        now = time.perf_counter()
+        for delivery in self.deliveries:
+            if delivery is not None:
+                self.server.settle_delivery(delivery, now)
+        self.deliveries.clear()
+        self.tracked = 0
+        self.space.set()
+        self.idle.set()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
 class TCPChatServer:
-    def __init__(self, host='0.0.0.0', port=9999):
+    def __init__(self, host='0.0.0.0', port=9999, queue_size=1024, slow_policy='drop_oldest', slow_timeout=10.0,
+                 coalesce_ms=0, coalesce_min_ms=2, max_message_size=64 * 1024,
+                 history_size=DEFAULT_MAX_MESSAGES, history_bytes=DEFAULT_MAX_BYTES,
+                 log_flush_ms=DEFAULT_FLUSH_MS, log_segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 backfill_count=50, backfill_minutes=0, resume_grace=DEFAULT_RESUME_GRACE, allow_same_ip=False,
+                 max_rooms=DEFAULT_MAX_ROOMS,
+                 metrics_port=0, metrics_host='0.0.0.0', metrics=True, latency_sample=DEFAULT_LATENCY_SAMPLE):
         self.host = host
         self.port = port
-        self.clients = {}  # {writer: username}
-        self.client_info = {}  # {writer: {address, connect_time}}
-        self.ip_to_writer = {}  # {ip_address: writer} 根据IP防止重复连接
-        self.messages = []  # 消息历史
+        self.sessions = SessionRegistry()  # 在线会话（连接、用户名、IP 索引）
+        # 消息历史（所有房间）：固定容量的环形缓冲区；每条消息同时追加到聊天日志，淘汰时无需再保存
+        self.history = MessageHistory(history_size, history_bytes)
+        
+        # 加入房间时补发最近的消息：最多 backfill_count 条，backfill_minutes > 0 时只补发这段时间内的
+        self.backfill_count = backfill_count
+        self.backfill_minutes = backfill_minutes
+        self._backfill_cache = {}  # {(房间, codec): (秒, 已包含的最大序号, 已编码的帧, 拼接后的缓冲区)}
+        self.backfill_sent = 0
+        self.backfill_cache_hits = 0
+        
+        # 断线重连：hello 握手的客户端获得恢复令牌，断线后会话保留 resume_grace 秒（0 表示关闭），
+        # 期间带令牌和最后收到的序号重连时回到原房间，只补发缺失的消息，不广播离开/加入
+        self.resume_grace = resume_grace
+        # 同一 IP 的新连接默认顶替旧连接；经桥接服务器或 NAT 接入的多个用户共用一个 IP 时需要关闭
+        self.allow_same_ip = allow_same_ip
+        self.resume_sessions = {}  # {resume_token: Session} 在线或等待恢复的会话
+        self.resume_timers = {}  # {resume_token: TimerHandle} 等待恢复的会话到期后广播离开
+        self.resumed_count = 0
+        self.rooms = {DEFAULT_ROOM: ChatRoom(DEFAULT_ROOM)}  # {room_name: ChatRoom}
+        self.max_rooms = max_rooms
         self.message_count = 0
+        self.dropped_messages = 0  # 因慢客户端被丢弃的消息数
+        self.poll_sessions = {}  # {session_id: Session} HTTP 轮询会话
+        self.long_polls = set()  # 正在长轮询的连接处理任务，关闭时等待它们写完响应
+        self.idle_http = {}  # {连接处理任务: writer} 等待下一个请求的持久 HTTP 连接，关闭时直接断开
+        
+        # 慢客户端处理
+        if slow_policy not in SLOW_POLICIES:
+            raise ValueError(f"未知的慢客户端策略: {slow_policy}")
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.slow_timeout = slow_timeout
+        
+        # 单条消息（一行或一帧）的大小上限，超过的消息被丢弃而不会缓存
+        self.max_message_size = max_message_size
+        self.rejected_messages = 0  # 因超长或格式错误被拒绝的消息数
+        
+        # 消息合并窗口（0 表示关闭）：窗口内到达的消息每个客户端只刷新一次
+        self.coalesce_max = coalesce_ms / 1000.0
+        self.coalesce_min = min(coalesce_min_ms, coalesce_ms) / 1000.0
+        self.coalesce_window = 0.0  # 当前窗口，随负载自适应，空闲时为 0
+        self._last_broadcast = 0.0
+        self._dirty_outboxes = set()  # 等待本次 tick 刷新的发送队列
+        self._flush_handle = None
+        
+        # 写入批量统计
+        self.flush_count = 0  # 写入次数
+        self.flushed_frames = 0  # 写出的帧数
+        self.max_batch = 0
+        self.batch_histogram = [0] * (len(BATCH_BUCKETS) + 1)
         self.start_time = datetime.now()
         self.is_running = True
+        self.stopped = None  # 非交互模式下等待关闭的事件
+        self.loop = None  # 运行服务器的事件循环，后台线程通过它调度需要在循环中执行的操作
+        
+        # 多进程模式（--workers）下由工作进程设置
+        self.cluster = None  # ClusterLink
+        self.worker_id = None
         
-        # 日志相关
+        # 日志相关：聊天日志在 start() 中打开（此时才知道工作进程编号）
         self.log_dir = 'chat_logs'
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
+        self.log_flush_ms = log_flush_ms
+        self.log_segment_bytes = log_segment_bytes
+        self.chat_log = None  # ChatLog
         
-        # 启动定时日志保存和内存清理线程（每3小时）
+        # 运行指标：在事件循环线程中更新，metrics_port 不为 0 时在 start() 中开放 Prometheus 端口
+        self.metrics = MetricsRegistry(enabled=metrics)
+        self.track_latency = metrics  # 记录聊天消息的投递延迟（关闭指标时一并关闭）
+        self.latency_sample = max(1, latency_sample)  # 每 N 条聊天消息跟踪一条的逐接收者写出时间
+        self._latency_skip = 0
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self._register_metrics()
+        
+        # 启动定时会话快照和内存清理线程（每3小时）
         self.periodic_task_thread = threading.Thread(target=self._periodic_save_and_clear, daemon=True)
         self.periodic_task_thread.start()
         
-    def log(self, message, level='INFO'):
-        """格式化日志输出"""
-        timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        colors = {
-            'INFO': Colors.CYAN,
-            'SUCCESS': Colors.GREEN,
-            'WARNING': Colors.YELLOW,
-            'ERROR': Colors.RED,
-            'MESSAGE': Colors.BLUE,
-            'SYSTEM': Colors.HEADER
-        }
-        
-        color = colors.get(level, Colors.ENDC)
-        print(f"{color}[{timestamp}] [{level}]{Colors.ENDC} {message}")
+    def _register_metrics(self):
+        """注册指标：热路径上的计数器和直方图，以及输出时才计算的当前值"""
+        m = self.metrics
+        self.m_connections = m.counter('connections_total', '接受的连接数（按协议）', ('protocol',))
+        self.m_joins = m.counter('joins_total', '加入聊天室的次数（不含断线恢复）')
+        self.m_leaves = m.counter('leaves_total', '离开聊天室的次数')
+        self.m_messages_in = m.counter('messages_received_total', '收到的客户端消息数（包括命令）')
+        self.m_bytes_in = m.counter('bytes_received_total', '从客户端连接读取的字节数')
+        self.m_bytes_out = m.counter('bytes_sent_total', '发送队列写给客户端的字节数')
+        self.m_broadcast = m.histogram('broadcast_seconds', '一次广播把消息放入全部接收者发送队列的耗时（秒）')
+        # 聊天消息的端到端投递延迟（HDR 分布，输出 p50/p95/p99/p999）
+        latency = m.summary('delivery_latency_seconds', '聊天消息的投递延迟（秒，按阶段）', ('stage',))
+        self.latency = {stage: latency.labels(stage) for stage, _ in LATENCY_STAGES}
+        self.lat_enqueue = self.latency['receive_to_enqueue']
+        self.lat_write = self.latency['enqueue_to_write']
+        self.lat_fanout = self.latency['fanout']
+        m.counter('messages_sent_total', '发送队列写给客户端的消息帧数', fn=lambda: self.flushed_frames)
+        m.counter('writes_total', '发送队列的合并写入次数', fn=lambda: self.flush_count)
+        m.counter('dropped_messages_total', '因发送队列满被丢弃的消息数', fn=lambda: self.dropped_messages)
+        m.counter('rejected_messages_total', '因超长或格式错误被拒绝的消息数', fn=lambda: self.rejected_messages)
+        m.counter('history_evicted_total', '被挤出内存历史的消息数', fn=lambda: self.history.evicted_count)
+        m.counter('backfills_total', '加入房间时的历史补发次数', fn=lambda: self.backfill_sent)
+        m.counter('resumed_sessions_total', '断线后恢复的会话数', fn=lambda: self.resumed_count)
+        m.gauge('sessions', '在线会话数（包括 HTTP 轮询会话）', fn=lambda: len(self.sessions))
+        m.gauge('poll_sessions', 'HTTP 轮询会话数', fn=lambda: len(self.poll_sessions))
+        m.gauge('detached_sessions', '断线后等待恢复的会话数', fn=lambda: len(self.resume_timers))
+        m.gauge('rooms', '房间数', fn=lambda: len(self.rooms))
+        m.gauge('history_messages', '内存历史中的消息数', fn=lambda: len(self.history))
+        m.gauge('outbox_queued_frames', '所有发送队列中等待写出的帧数', fn=lambda: self._outbox_depths()[0])
+        m.gauge('outbox_queued_frames_max', '积压最多的发送队列中的帧数', fn=lambda: self._outbox_depths()[1])
+        m.gauge('chat_log_pending_records', '聊天日志中等待组提交的记录数',
+                fn=lambda: self.chat_log.appended_count - self.chat_log.committed_count)
+    
+    def _outbox_depths(self):
+        """(所有发送队列的积压帧数之和, 最大值)"""
+        depths = [len(session.outbox.queue) for session in self.sessions if session.outbox]
+        return sum(depths), max(depths, default=0)
+    
+    def log(self, message, level='INFO', **fields):
+        """日志输出（fields 只出现在 JSON 格式的日志中）"""
+        prefix = f"W{self.worker_id}" if self.worker_id is not None else None
+        log_line(message, level, prefix, **fields)
     
     def get_time(self):
         """获取当前时间字符串"""
@@ -77,59 +501,64 @@ class TCPChatServer:
         except:
             return "127.0.0.1"
     
+    def open_chat_log(self):
+        """打开追加写入的聊天日志（多进程模式下每个工作进程各写一组段文件）"""
+        prefix = f'tcp_w{self.worker_id}' if self.worker_id is not None else 'tcp'
+        self.chat_log = ChatLog(self.log_dir, prefix, flush_ms=self.log_flush_ms,
+                                segment_bytes=self.log_segment_bytes, log=self.log)
+    
     def _save_logs_to_file(self):
-        """保存对话和用户访问情况到日志文件"""
+        """把在线会话快照写入聊天日志，并等待此前的消息全部落盘（在线程池中调用，不阻塞事件循环）"""
+        if self.chat_log is None:
+            return False
         try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            log_file = os.path.join(self.log_dir, f'chat_log_{timestamp}.json')
-            
-            # 收集在线用户信息
-            online_users = []
             session_info = []
-            for writer, username in list(self.clients.items()):
-                online_users.append(username)
-                info = self.client_info.get(writer, {})
+            for session in self.sessions:
                 session_info.append({
-                    'username': username,
-                    'address': info.get('address', 'Unknown'),
-                    'connect_time': info.get('connect_time', datetime.now()).strftime('%Y-%m-%d %H:%M:%S'),
-                    'online_duration': (datetime.now() - info.get('connect_time', datetime.now())).total_seconds()
+                    'username': session.username,
+                    'address': session.address,
+                    'connect_time': session.connect_time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'online_duration': (datetime.now() - session.connect_time).total_seconds()
                 })
             
-            log_data = {
-                'save_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            self.chat_log.append({
+                'type': 'snapshot',
+                'time': self.get_time(),
                 'server_start_time': self.start_time.strftime('%Y-%m-%d %H:%M:%S'),
-                'total_messages': len(self.messages),
+                'last_seq': self.history.last_seq,
                 'message_count': self.message_count,
-                'current_online_users': len(self.clients),
-                'online_users': online_users,
-                'messages': self.messages.copy(),
+                'online_users': [info['username'] for info in session_info],
                 'session_info': session_info
-            }
-            
-            with open(log_file, 'w', encoding='utf-8') as f:
-                json.dump(log_data, f, ensure_ascii=False, indent=2)
+            })
+            if not self.chat_log.sync():
+                self.log("保存日志超时", 'ERROR')
+                return False
             
-            self.log(f"✓ 日志已保存: {log_file} | 消息数: {len(self.messages)} | 在线用户: {len(self.clients)}", 'SUCCESS')
+            self.log(f"✓ 日志已保存: {self.chat_log.segment_path} | 最新序号: {self.history.last_seq} | 在线用户: {len(session_info)}", 'SUCCESS')
             return True
         except Exception as e:
             self.log(f"保存日志失败: {e}", 'ERROR')
             return False
     
     def _clear_memory(self):
-        """清除内存中的消息历史"""
+        """移除已无成员的房间（消息历史由环形缓冲区限制容量，不再整体清空）
+        
+        房间表只在事件循环中修改，后台线程通过 loop.call_soon_threadsafe 调度本方法。
+        """
         try:
-            old_message_count = len(self.messages)
-            self.messages.clear()
-            self.message_count = 0
-            self.log(f"✓ 内存已清理: 清除了 {old_message_count} 条消息", 'SUCCESS')
+            removed = 0
+            for name, room in list(self.rooms.items()):
+                if not room.members and name != DEFAULT_ROOM:
+                    del self.rooms[name]
+                    removed += 1
+            self.log(f"✓ 内存已清理: 移除了 {removed} 个空房间 | 历史保留 {len(self.history)} 条", 'SUCCESS')
             return True
         except Exception as e:
             self.log(f"清理内存失败: {e}", 'ERROR')
             return False
     
     def _periodic_save_and_clear(self):
-        """定期（每3小时）保存日志并清理内存"""
+        """定期（每3小时）记录在线会话快照并清理空房间（消息在到达时已写入聊天日志）"""
         interval = 3 * 60 * 60  # 3小时（秒）
         
         while self.is_running:
@@ -140,12 +569,12 @@ class TCPChatServer:
                 if not self.is_running:
                     break
                 
-                self.log("开始执行定期日志保存和内存清理...", 'SYSTEM')
+                self.log("开始执行定期会话快照和内存清理...", 'SYSTEM')
                 
-                # 1. 保存日志
+                # 1. 会话快照
                 if self._save_logs_to_file():
-                    # 2. 清理内存
-                    self._clear_memory()
+                    # 2. 清理内存（在事件循环中执行）
+                    self.loop.call_soon_threadsafe(self._clear_memory)
                     self.log("定期任务完成", 'SUCCESS')
                 else:
                     self.log("定期任务失败：日志保存失败", 'ERROR')
@@ -154,138 +583,155 @@ class TCPChatServer:
                 self.log(f"定期任务错误: {e}", 'ERROR')
     
     async def handle_client(self, reader, writer):
-        """处理单个客户端连接"""
+        """处理单个连接：根据开头的字节分派给 TCP 聊天协议、WebSocket 或 HTTP 轮询接口"""
+        # 每个连接一个增量读取器，复用接收缓冲区并限制单条消息大小
+        frames = FrameReader(reader, max_size=self.max_message_size, counter=self.m_bytes_in)
+        
+        try:
+            prefix = await asyncio.wait_for(frames.peek(8), timeout=30.0)
+        except asyncio.TimeoutError:
+            addr = writer.get_extra_info('peername')
+            self.log(f"客户端 {addr[0] if addr else 'Unknown'} 连接超时（未发送任何数据）", 'WARNING')
+            prefix = b''
+        except Exception:
+            prefix = b''
+        
+        if is_http_request(prefix):
+            await self.handle_http(frames, writer)
+        elif prefix:
+            self.m_connections.labels('tcp').inc()
+            await self.handle_stream(frames, writer)
+        else:
+            writer.close()
+    
+    async def handle_stream(self, frames, writer, codec=None):
+        """处理持续连接的聊天客户端（原始 TCP 或 WebSocket，由 codec 决定分帧方式）"""
         username = None
+        resumed = None  # 通过恢复令牌找回的断线前会话
         addr = writer.get_extra_info('peername')
         client_address = f"{addr[0]}:{addr[1]}" if addr else "Unknown"
         client_ip = addr[0] if addr else "Unknown"
+        session = Session(writer, client_address, client_ip)
+        session.codec = codec
         
         try:
-            # 检查是否已有此IP的连接
-            if client_ip in self.ip_to_writer:
-                old_writer = self.ip_to_writer[client_ip]
-                if old_writer in self.clients:
-                    old_username = self.clients[old_writer]
-                    self.log(f"检测到重复连接，关闭旧连接: {old_username} ({client_ip})", 'WARNING')
-                    
-                    # 关闭旧连接
-                    try:
-                        old_writer.close()
-                        await old_writer.wait_closed()
-                    except:
-                        pass
-                    
-                    # 清理旧连接的数据
-                    if old_writer in self.clients:
-                        del self.clients[old_writer]
-                    if old_writer in self.client_info:
-                        del self.client_info[old_writer]
-            
-            # 记录连接信息
-            self.client_info[writer] = {
-                'address': client_address,
-                'connect_time': datetime.now(),
-                'ip': client_ip
-            }
-            self.ip_to_writer[client_ip] = writer
-            
-            self.log(f"新连接来自 {client_address}", 'INFO')
+            protocol = 'WebSocket ' if codec is WebSocketCodec else ''
+            self.log(f"新{protocol}连接来自 {client_address}", 'INFO')
             
             # 接收用户名（设置超时）
             try:
-                data = await asyncio.wait_for(reader.readline(), timeout=30.0)
-                username = data.decode('utf-8').strip()
+                username = await asyncio.wait_for(self.read_message(frames, session), timeout=30.0)
+                username = (username or '').strip()
+                
+                # 新客户端发送 hello 握手，可选择长度前缀分帧；旧客户端直接发送用户名
+                hello = parse_hello(username)
+                if hello:
+                    username = str(hello.get('username', '')).strip()
                 
-                # 过滤无效的用户名（HTTP 请求等）
-                if not username or username.startswith(('GET ', 'POST ', 'PUT ', 'DELETE ', 'HEAD ', 'OPTIONS ', 'PATCH ', 'HTTP/')):
-                    self.log(f"客户端 {client_address} 发送了无效的用户名或 HTTP 请求", 'WARNING')
+                # 过滤无效的用户名
+                if not username:
+                    self.log(f"客户端 {client_address} 发送了无效的用户名", 'WARNING')
                     writer.close()
                     await writer.wait_closed()
                     return
                 
-                # 检查用户名是否已存在
-                existing_names = list(self.clients.values())
-                if username in existing_names:
-                    original_username = username
-                    counter = 1
-                    while username in existing_names:
-                        username = f"{original_username}_{counter}"
-                        counter += 1
-                    self.log(f"用户名 {original_username} 已存在，自动改为 {username}", 'WARNING')
+                # 带恢复令牌重连的客户端找回原会话，沿用原用户名，不做重复 IP 检查
+                if hello and hello.get('resume'):
+                    resumed = await self.take_resumable(str(hello['resume']))
+                if resumed:
+                    username, online_count = resumed.username, len(self.sessions) + 1
+                    self.sessions.track_ip(session)
+                else:
+                    await self.evict_same_ip(session)
+                    # 检查用户名是否已存在（多进程模式下由主进程统一去重）
+                    username, online_count = await self.claim_username(username)
                 
+                if hello:
+                    if hello.get('framing') == 'length' and session.codec is None:
+                        session.codec = negotiate(hello.get('codecs'))
+                    if resumed:
+                        session.resume_token = str(hello['resume'])
+                    elif self.resume_grace > 0 and not self.cluster:
+                        session.resume_token = secrets.token_urlsafe(16)
+                    # 握手回复使用握手前的分帧方式，之后按协商结果切换
+                    reply = {
+                        'type': 'hello',
+                        'framing': 'length' if session.codec else 'line',
+                        'codec': session.codec.name if session.codec else 'json',
+                        'username': username
+                    }
+                    if session.resume_token:
+                        reply['resume_token'] = session.resume_token
+                        reply['resumed'] = resumed is not None
+                    writer.write(self.encode_message(reply, codec))
+                    if session.codec and session.codec is not codec:
+                        self.log(f"{username} 使用长度前缀分帧（{session.codec.name}）", 'INFO')
+            
             except asyncio.TimeoutError:
                 self.log(f"客户端 {client_address} 连接超时（未发送用户名）", 'WARNING')
                 writer.close()
                 await writer.wait_closed()
                 return
+            except ValueError as e:
+                # 包括 FrameTooLarge（用户名过长）和无法解码的用户名
+                self.log(f"客户端 {client_address} 发送了无效的用户名: {e}，关闭连接", 'WARNING')
+                writer.close()
+                await writer.wait_closed()
+                return
             
-            # 添加到客户端列表
-            self.clients[writer] = username
-            self.client_info[writer]['username'] = username
-            
-            self.log(f"✓ {username} ({client_address}) 加入聊天室 | 在线人数: {len(self.clients)}", 'SUCCESS')
-            
-            # 广播加入消息
-            join_msg = {
-                'type': 'system',
-                'time': self.get_time(),
-                'message': f"{username} 加入了聊天室"
-            }
-            self.messages.append(join_msg)  # 保存到历史
-            await self.broadcast(json.dumps(join_msg, ensure_ascii=False) + '\n', exclude=writer)
-            
-            # 发送欢迎消息
-            welcome_msg = {
-                'type': 'system',
-                'time': self.get_time(),
-                'message': f"欢迎来到 NeoChat！当前在线人数: {len(self.clients)}"
-            }
-            writer.write((json.dumps(welcome_msg, ensure_ascii=False) + '\n').encode('utf-8'))
-            await writer.drain()
+            # 添加到客户端列表，并为连接创建独立的发送队列
+            session.username = username
+            session.outbox = ClientOutbox(
+                self, writer,
+                maxsize=self.queue_size,
+                policy=self.slow_policy,
+                slow_timeout=self.slow_timeout,
+                name=username
+            )
+            if resumed:
+                await self.resume_session(session, resumed, hello.get('last_seq'))
+            else:
+                await self.begin_session(session)
+                
+                # 发送欢迎消息
+                welcome_msg = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'message': f"欢迎来到 NeoChat！当前在线人数: {online_count}"
+                }
+                await self.send_to(session, welcome_msg)
             
             # 持续接收消息
             while self.is_running:
-                data = await reader.readline()
-                if not data:
+                try:
+                    message = await self.read_message(frames, session)
+                except FrameTooLarge as e:
+                    # 超长消息已被读取器丢弃，告知客户端后继续处理后续消息
+                    self.rejected_messages += 1
+                    self.log(f"{username} 发送的消息超过上限（已收到 {e.size} 字节），已丢弃", 'WARNING')
+                    await self.send_to(session, {
+                        'type': 'system',
+                        'time': self.get_time(),
+                        'message': f"消息过长，已丢弃（上限 {self.max_message_size} 字节）"
+                    })
+                    continue
+                except ValueError as e:
+                    self.rejected_messages += 1
+                    self.log(f"{username} 发送了格式错误的消息: {e}", 'WARNING')
+                    await self.send_to(session, {
+                        'type': 'system',
+                        'time': self.get_time(),
+                        'message': '消息格式错误，已丢弃'
+                    })
+                    continue
+                if message is None:
                     break
+                received = time.perf_counter()
                 
-                message = data.decode('utf-8').strip()
+                message = message.strip()
                 if message:
-                    # 过滤 HTTP 协议相关的消息（忽略 HTTP 请求头）
-                    # 检查是否是 HTTP 请求行或请求头
-                    if (message.startswith(('GET ', 'POST ', 'PUT ', 'DELETE ', 'HEAD ', 'OPTIONS ', 'PATCH ', 'TRACE ', 'CONNECT ')) or
-                        message.startswith('HTTP/') or
-                        ':' in message and message.split(':', 1)[0].strip() in [
-                            'Host', 'User-Agent', 'Accept', 'Accept-Encoding', 'Accept-Language',
-                            'Connection', 'Content-Type', 'Content-Length', 'Origin', 'Referer',
-                            'Cache-Control', 'Pragma', 'Authorization', 'Cookie', 'Set-Cookie',
-                            'Access-Control-Request-Method', 'Access-Control-Request-Headers',
-                            'X-Forwarded-For', 'X-Forwarded-Proto', 'X-Real-Ip', 'X-Original-Host',
-                            'Sec-Fetch-Dest', 'Sec-Fetch-Mode', 'Sec-Fetch-Site', 'Priority',
-                            'Upgrade', 'Sec-WebSocket-Key', 'Sec-WebSocket-Version'
-                        ]):
-                        # 忽略 HTTP 协议消息，不记录不广播
-                        continue
-                    
-                    self.message_count += 1
-                    
-                    # 检查是否是命令
-                    if message.startswith('/'):
-                        await self.handle_command(writer, username, message)
-                        continue
-                    
-                    self.log(f"{username}: {message[:50]}{'...' if len(message) > 50 else ''}", 'MESSAGE')
-                    
-                    # 广播消息
-                    broadcast_msg = {
-                        'type': 'message',
-                        'time': self.get_time(),
-                        'username': username,
-                        'message': message
-                    }
-                    self.messages.append(broadcast_msg)  # 保存到历史
-                    await self.broadcast(json.dumps(broadcast_msg, ensure_ascii=False) + '\n', exclude=writer)
-                    
+                    await self.process_message(session, message, received)
+        
         except asyncio.CancelledError:
             self.log(f"{username or client_address} 连接被取消", 'INFO')
         except ConnectionResetError:
@@ -293,31 +739,8 @@ class TCPChatServer:
         except Exception as e:
             self.log(f"{username or client_address} 发生错误: {type(e).__name__}: {str(e)}", 'ERROR')
         finally:
-            # 移除客户端
-            if writer in self.clients:
-                username = self.clients[writer]
-                del self.clients[writer]
-                
-                if writer in self.client_info:
-                    info = self.client_info[writer]
-                    duration = (datetime.now() - info['connect_time']).total_seconds()
-                    self.log(f"✗ {username} ({client_address}) 离开聊天室 | 在线时长: {duration:.1f}秒 | 剩余: {len(self.clients)}人", 'INFO')
-                    
-                    # 清理IP映射
-                    if 'ip' in info and info['ip'] in self.ip_to_writer:
-                        if self.ip_to_writer[info['ip']] == writer:
-                            del self.ip_to_writer[info['ip']]
-                    
-                    del self.client_info[writer]
-                
-                # 广播离开消息
-                leave_msg = {
-                    'type': 'system',
-                    'time': self.get_time(),
-                    'message': f"{username} 离开了聊天室"
-                }
-                self.messages.append(leave_msg)  # 保存到历史
-                await self.broadcast(json.dumps(leave_msg, ensure_ascii=False) + '\n')
+            # 移除客户端（无论是否登录都清理全部索引，包括 IP 映射）
+            await self.end_session(session)
             
             # 关闭连接
             try:
@@ -326,8 +749,366 @@ class TCPChatServer:
             except:
                 pass
     
-    async def handle_command(self, writer, username, command):
+    async def evict_same_ip(self, session):
+        """记录会话的 IP；同一 IP 已有在线连接时关闭旧连接（不广播离开）
+        
+        多进程模式下每个工作进程只看到分配给自己的连接，无法全局判断，因此不做检查（与 --allow-same-ip 相同）。
+        """
+        if self.allow_same_ip or self.cluster:
+            return
+        old_session = self.sessions.track_ip(session)
+        if old_session is None or not self.sessions.is_registered(old_session):
+            return
+        self.log(f"检测到重复连接，关闭旧连接: {old_session.username} ({session.ip})", 'WARNING')
+        
+        # 关闭旧连接并清理旧连接的数据（旧会话不再等待恢复）
+        self._forget_resume(old_session)
+        try:
+            old_session.writer.close()
+            await old_session.writer.wait_closed()
+        except:
+            pass
+        await self.end_session(old_session, notify=False)
+    
+    async def claim_username(self, username):
+        """为新会话占用用户名，重名时自动添加后缀，返回 (用户名, 在线人数)"""
+        original_username = username
+        if self.cluster:
+            username, online_count = await self.cluster.claim(username, DEFAULT_ROOM)
+        else:
+            username = self.sessions.unique_username(username)
+            online_count = len(self.sessions) + 1
+        if username != original_username:
+            self.log(f"用户名 {original_username} 已存在，自动改为 {username}", 'WARNING')
+        return username, online_count
+    
+    async def begin_session(self, session):
+        """登记已确定用户名的会话，进入默认房间并通知房间成员"""
+        self.sessions.add(session)
+        self.m_joins.inc()
+        if session.resume_token:
+            self.resume_sessions[session.resume_token] = session
+        self._add_to_room(session, DEFAULT_ROOM)
+        self.send_backfill(session, DEFAULT_ROOM)
+        
+        self.log(f"✓ {session.username} ({session.address}) 加入聊天室 | 在线人数: {len(self.sessions)}", 'SUCCESS')
+        
+        # 向所在房间广播加入消息
+        join_msg = {
+            'type': 'system',
+            'time': self.get_time(),
+            'room': DEFAULT_ROOM,
+            'message': f"{session.username} 加入了聊天室"
+        }
+        self.record_message(join_msg, DEFAULT_ROOM)  # 保存到历史
+        await self.broadcast(join_msg, exclude=session, room=DEFAULT_ROOM)
+    
+    async def end_session(self, session, notify=True):
+        """移除会话并清理所有索引；notify=True 时向所在房间广播离开消息"""
+        # 停止发送队列
+        if session.outbox:
+            session.outbox.stop()
+        if session.token:
+            self.poll_sessions.pop(session.token, None)
+        
+        registered = self.sessions.is_registered(session)
+        room_name = self._remove_from_room(session)
+        self.sessions.remove(session)
+        if not registered:
+            return
+        
+        if notify and session.resume_token and self.is_running:
+            # 断线后保留会话一段时间，客户端带令牌重连时不会产生离开/加入广播
+            session.room = room_name
+            self.sessions.reserve(session)
+            self.resume_timers[session.resume_token] = asyncio.get_running_loop().call_later(
+                self.resume_grace, self._expire_resumable, session.resume_token)
+            self.log(f"⌛ {session.username} ({session.address}) 断开连接，保留会话 {self.resume_grace:g} 秒等待重连", 'INFO')
+            return
+        
+        self._forget_resume(session)
+        await self.finish_session(session, room_name, notify)
+    
+    async def finish_session(self, session, room_name, notify=True):
+        """会话结束：释放用户名，notify=True 时向所在房间广播离开消息"""
+        username = session.username
+        self.m_leaves.inc()
+        if self.cluster:
+            self.cluster.release(username)
+        
+        duration = (datetime.now() - session.connect_time).total_seconds()
+        self.log(f"✗ {username} ({session.address}) 离开聊天室 | 在线时长: {duration:.1f}秒 | 剩余: {len(self.sessions)}人", 'INFO')
+        
+        if notify:
+            # 向所在房间广播离开消息
+            room_name = room_name or DEFAULT_ROOM
+            leave_msg = {
+                'type': 'system',
+                'time': self.get_time(),
+                'room': room_name,
+                'message': f"{username} 离开了聊天室"
+            }
+            self.record_message(leave_msg, room_name)  # 保存到历史
+            await self.broadcast(leave_msg, room=room_name)
+    
+    async def take_resumable(self, token):
+        """取回恢复令牌对应的会话（断线等待恢复中，或旧连接尚未被发现断开），令牌无效或已过期时返回 None"""
+        old_session = self.resume_sessions.pop(token, None)
+        if old_session is None:
+            return None
+        
+        timer = self.resume_timers.pop(token, None)
+        if timer:
+            # 等待恢复中：取消到期后的离开广播
+            timer.cancel()
+            self.sessions.unreserve(old_session)
+        else:
+            # 旧连接还没被发现已断开（例如 NAT 映射失效），静默关闭，由新连接接管
+            room_name = old_session.room
+            old_session.resume_token = None
+            try:
+                old_session.writer.close()
+            except:
+                pass
+            await self.end_session(old_session, notify=False)
+            old_session.room = room_name
+        return old_session
+    
+    async def resume_session(self, session, old_session, last_seq):
+        """恢复断线前的会话：回到原房间，把序号 last_seq 之后错过的消息作为一次写入补发
+        
+        自己发送的聊天消息不会广播回发送者（客户端发送时已经显示），补发时同样跳过。
+        """
+        try:
+            last_seq = int(last_seq or 0)
+        except (TypeError, ValueError):
+            last_seq = 0
+        room_name = old_session.room or DEFAULT_ROOM
+        session.connect_time = old_session.connect_time
+        self.sessions.add(session)
+        self.resume_sessions[session.resume_token] = session
+        self._add_to_room(session, room_name)
+        
+        missed = [message for message in self.history.since(last_seq, room=room_name)
+                  if not (message.get('type') == 'message' and message.get('username') == session.username)]
+        if missed:
+            session.outbox.put_nowait(b''.join(self.encode_message(message, session.codec) for message in missed))
+        self.resumed_count += 1
+        self.log(f"↻ {session.username} ({session.address}) 恢复会话，补发 {len(missed)} 条消息 | 在线人数: {len(self.sessions)}", 'SUCCESS')
+        
+        text = f"已恢复会话，补发断线期间的 {len(missed)} 条消息"
+        if self.history.evicted_count and self.history.first_seq > last_seq + 1:
+            text += "（更早的部分消息已超出历史容量）"
+        await self.send_to(session, {
+            'type': 'system',
+            'time': self.get_time(),
+            'room': room_name,
+            'message': text
+        })
+    
+    def _forget_resume(self, session):
+        """会话不再可以恢复（正常退出或被替换）"""
+        if session.resume_token and self.resume_sessions.get(session.resume_token) is session:
+            del self.resume_sessions[session.resume_token]
+        session.resume_token = None
+    
+    def _expire_resumable(self, token):
+        """等待恢复超时：释放保留的用户名并广播离开"""
+        self.resume_timers.pop(token, None)
+        session = self.resume_sessions.pop(token, None)
+        if session is not None:
+            self.sessions.unreserve(session)
+            asyncio.create_task(self.finish_session(session, session.room))
+    
+    async def process_message(self, session, message, received=None):
+        """处理一条客户端消息：执行命令或向所在房间广播，返回生成的消息
+        
+        received 是读出消息时的 perf_counter()，用于统计投递延迟。
+        """
+        if received is None:
+            received = time.perf_counter()
+        self.message_count += 1
+        self.m_messages_in.inc()
+        
+        # 检查是否是命令
+        if message.startswith('/'):
+            if self.cluster:
+                self.cluster.count()
+            return await self.handle_command(session, message)
+        
+        username = session.username
+        self.log(f"{username}: {message[:50]}{'...' if len(message) > 50 else ''}", 'MESSAGE',
+                 username=username, room=session.room or DEFAULT_ROOM)
+        
+        # 向发送者所在房间广播消息
+        room_name = session.room or DEFAULT_ROOM
+        broadcast_msg = {
+            'type': 'message',
+            'time': self.get_time(),
+            'room': room_name,
+            'username': username,
+            'message': message
+        }
+        self.record_message(broadcast_msg, room_name)  # 保存到历史
+        await self.broadcast(broadcast_msg, exclude=session, room=room_name, received=received)
+        return broadcast_msg
+    
+    async def handle_http(self, frames, writer):
+        """处理 HTTP 请求：WebSocket 升级转入聊天连接，其余请求交给轮询接口
+        
+        轮询请求使用持久连接：响应后继续读取同一连接上的下一个请求（包括流水线发送的请求），
+        空闲 KEEPALIVE_TIMEOUT 秒或处理了 MAX_KEEPALIVE_REQUESTS 个请求后关闭。
+        """
+        task = asyncio.current_task()
+        handled = 0
+        try:
+            while True:
+                self.idle_http[task] = writer
+                try:
+                    request = await asyncio.wait_for(
+                        read_request(frames), timeout=KEEPALIVE_TIMEOUT if handled else 30.0)
+                except HTTPError as e:
+                    writer.write(json_response({'error': str(e)}, e.status))
+                    request = None
+                except Exception:
+                    request = None
+                finally:
+                    self.idle_http.pop(task, None)
+                
+                if request is None:
+                    break
+                if request.is_websocket_upgrade:
+                    if not version_supported(request):
+                        writer.write(upgrade_required_response())
+                        break
+                    self.m_connections.labels('websocket').inc()
+                    writer.write(handshake_response(request.headers['sec-websocket-key']))
+                    await self.handle_stream(frames, writer, codec=WebSocketCodec)
+                    return
+                
+                if not handled:
+                    self.m_connections.labels('http').inc()
+                handled += 1
+                status, data = await self.handle_api(request, writer)
+                keep_alive = request.keep_alive and handled < MAX_KEEPALIVE_REQUESTS and self.is_running
+                if data is None:
+                    writer.write(build_response(status, headers=CORS_HEADERS, keep_alive=keep_alive))
+                elif isinstance(data, str):
+                    writer.write(build_response(status, data.encode('utf-8'), 'text/html; charset=utf-8',
+                                                keep_alive=keep_alive))
+                else:
+                    writer.write(json_response(data, status, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+            await writer.drain()
+        except Exception as e:
+            self.log(f"HTTP 请求处理错误: {type(e).__name__}: {e}", 'ERROR')
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+    
+    async def handle_api(self, request, writer):
+        """HTTP 轮询接口（与 server_https.py 相同的端点和响应格式），返回 (状态码, 响应数据)"""
+        if request.method == 'OPTIONS':
+            return 200, None
+        
+        if request.method == 'GET' and request.path == '/':
+            return 200, HTTP_INDEX_PAGE
+        
+        if request.path not in ('/join', '/message', '/messages', '/leave'):
+            return 404, {'error': '未找到端点'}
+        
+        if self.cluster:
+            # 轮询会话只存在于处理 /join 的工作进程，而后续请求可能被分配到其他进程
+            return 503, {'error': '多进程模式下不支持 HTTP 轮询，请使用 WebSocket 或 TCP 连接'}
+        
+        if request.method == 'GET' and request.path == '/messages':
+            # 获取消息（同时作为心跳）
+            session_id = request.param('session_id')
+            session = self.poll_sessions.get(session_id)
+            if session_id and session is None:
+                return 401, {'error': '会话已失效，请重新登录', 'session_expired': True}
+            
+            if session:
+                session.last_active = time.monotonic()
+            # since 为客户端已收到的最大序号，total 为当前最新序号
+            try:
+                since = int(request.param('since', '0'))
+            except ValueError:
+                since = 0
+            wait = poll_wait(request.param('wait'))
+            messages, last_seq = self.poll_messages(session, since)
+            if wait and not messages:
+                # 长轮询：挂起到有新消息或超时，不占用 CPU
+                await self.wait_for_messages(session, wait)
+                messages, last_seq = self.poll_messages(session, since)
+            return 200, {'success': True, 'messages': messages, 'total': last_seq, 'wait': wait}
+        
+        if request.method != 'POST':
+            return 405, {'error': '不支持的请求方法'}
+        
+        data = request.json()
+        
+        if request.path == '/join':
+            username = request.param('username') or str(data.get('username') or 'Anonymous')
+            username = username.strip()[:64] or 'Anonymous'
+            addr = writer.get_extra_info('peername')
+            client_ip = addr[0] if addr else 'Unknown'
+            
+            session = Session(PollingConnection(), f"{client_ip} (HTTP)", client_ip)
+            session.token = secrets.token_urlsafe(16)
+            session.inbox = []
+            session.last_active = time.monotonic()
+            session.username, online_count = await self.claim_username(username)
+            self.poll_sessions[session.token] = session
+            await self.begin_session(session)
+            return 200, {
+                'success': True,
+                'session_id': session.token,
+                'username': session.username,
+                'online_count': online_count
+            }
+        
+        session = self.poll_sessions.get(str(data.get('session_id', '')))
+        
+        if request.path == '/message':
+            message = str(data.get('message', '')).strip()
+            if not data.get('session_id') or not message:
+                return 400, {'error': '缺少参数'}
+            if session is None:
+                return 200, {'error': '无效的会话ID，可能已超时'}
+            if len(message.encode('utf-8')) > self.max_message_size:
+                self.rejected_messages += 1
+                return 413, {'error': f"消息过长（上限 {self.max_message_size} 字节）"}
+            
+            session.last_active = time.monotonic()
+            result = await self.process_message(session, message)
+            return 200, {'success': True, 'message': result}
+        
+        # /leave
+        if not data.get('session_id'):
+            return 400, {'error': '缺少会话ID'}
+        if session:
+            await self.end_session(session)
+        return 200, {'success': True}
+    
+    async def _expire_poll_sessions(self):
+        """定期移除长时间没有轮询的 HTTP 会话"""
+        while self.is_running:
+            await asyncio.sleep(POLL_SWEEP_INTERVAL)
+            deadline = time.monotonic() - POLL_SESSION_TIMEOUT
+            for session in list(self.poll_sessions.values()):
+                if session.last_active < deadline:
+                    self.log(f"HTTP 会话超时: {session.username}", 'WARNING')
+                    await self.end_session(session)
+    
+    async def handle_command(self, session, command):
         """处理客户端命令"""
+        username = session.username
         parts = command.split()
         cmd = parts[0].lower()
         
@@ -337,15 +1118,90 @@ class TCPChatServer:
             response = {
                 'type': 'system',
                 'time': self.get_time(),
-                'message': '可用命令: /help, /online, /ping, /stats, /savelog'
+                'message': '可用命令: /help, /online, /join <房间>, /leave, /rooms, /ping, /stats, /latency, /savelog, /quit'
             }
         
         elif cmd == '/online':
-            users = ', '.join(self.clients.values())
+            # 当前房间的在线用户
+            room_name = session.room or DEFAULT_ROOM
+            if self.cluster:
+                online_users = await self.cluster.online(room_name)
+            else:
+                online_users = [member.username for member in self.rooms[room_name].members]
+            users = ', '.join(online_users)
             response = {
                 'type': 'system',
                 'time': self.get_time(),
-                'message': f"在线用户 ({len(self.clients)}): {users}"
+                'message': f"房间 {room_name} 在线用户 ({len(online_users)}): {users}"
+            }
+        
+        elif cmd == '/join':
+            room_name = parts[1] if len(parts) > 1 else ''
+            if not valid_room_name(room_name):
+                response = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'message': f"用法: /join <房间名>（不超过 {MAX_ROOM_NAME} 个字符，只能包含字母、数字、下划线和连字符）"
+                }
+            elif room_name not in self.rooms and len(self.rooms) >= self.max_rooms:
+                response = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'message': f"房间数已达上限（{self.max_rooms}），请加入已有的房间"
+                }
+            elif room_name == session.room:
+                response = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'message': f"你已经在房间 {room_name} 中"
+                }
+            else:
+                await self.change_room(session, room_name)
+                if self.cluster:
+                    member_count = len(await self.cluster.online(room_name))
+                else:
+                    member_count = len(self.rooms[room_name].members)
+                response = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'room': room_name,
+                    'message': f"已进入房间 {room_name}，当前房间人数: {member_count}"
+                }
+        
+        elif cmd == '/leave':
+            current = session.room or DEFAULT_ROOM
+            if current == DEFAULT_ROOM:
+                response = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'message': f"你已经在默认房间 {DEFAULT_ROOM} 中"
+                }
+            elif len(parts) > 1 and parts[1] != current:
+                response = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'message': f"你不在房间 {parts[1]} 中"
+                }
+            else:
+                await self.change_room(session, DEFAULT_ROOM)
+                response = {
+                    'type': 'system',
+                    'time': self.get_time(),
+                    'room': DEFAULT_ROOM,
+                    'message': f"已离开房间 {current}，回到 {DEFAULT_ROOM}"
+                }
+        
+        elif cmd == '/rooms':
+            if self.cluster:
+                room_counts = await self.cluster.rooms()
+            else:
+                room_counts = {name: len(room.members) for name, room in self.rooms.items() if room.members}
+            room_counts.setdefault(DEFAULT_ROOM, 0)
+            rooms = ', '.join(f"{name}({count})" for name, count in room_counts.items())
+            response = {
+                'type': 'system',
+                'time': self.get_time(),
+                'message': f"房间列表: {rooms}"
             }
         
         elif cmd == '/ping':
@@ -357,14 +1213,43 @@ class TCPChatServer:
         
         elif cmd == '/stats':
             uptime = (datetime.now() - self.start_time).total_seconds()
+            message_count, online_count = self.message_count, len(self.sessions)
+            if self.cluster:
+                stats = await self.cluster.stats()
+                message_count, online_count = stats['message_count'], stats['online']
+            response = {
+                'type': 'system',
+                'time': self.get_time(),
+                'message': (f"服务器统计: 运行时长 {uptime:.0f}秒, 消息总数 {message_count}, "
+                            f"在线人数 {online_count}, 丢弃消息 {self.dropped_messages}, 拒收消息 {self.rejected_messages}, "
+                            f"{self.batch_summary()}")
+            }
+        
+        elif cmd == '/latency':
+            # 多进程模式下只统计本工作进程
+            response = {
+                'type': 'system',
+                'time': self.get_time(),
+                'message': self.latency_summary()
+            }
+        
+        elif cmd == '/quit':
+            # 主动退出：不保留会话，立即广播离开
+            self._forget_resume(session)
             response = {
                 'type': 'system',
                 'time': self.get_time(),
-                'message': f"服务器统计: 运行时长 {uptime:.0f}秒, 消息总数 {self.message_count}, 在线人数 {len(self.clients)}"
+                'message': '再见！'
             }
+            await self.send_to(session, response)
+            self.log(f"{username} 执行命令: {command}", 'SYSTEM')
+            if session.outbox:
+                await session.outbox.flush()
+            session.writer.close()
+            return
         
         elif cmd == '/savelog':
-            if self._save_logs_to_file():
+            if await asyncio.get_running_loop().run_in_executor(None, self._save_logs_to_file):
                 response = {
                     'type': 'system',
                     'time': self.get_time(),
@@ -385,39 +1270,405 @@ class TCPChatServer:
             }
         
         if response:
-            writer.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
-            await writer.drain()
+            await self.send_to(session, response)
             self.log(f"{username} 执行命令: {command}", 'SYSTEM')
     
-    async def broadcast(self, message, exclude=None):
-        """向所有客户端广播消息"""
-        if not self.clients:
+    def _add_to_room(self, session, room_name):
+        """把会话加入房间（房间不存在时创建）"""
+        room = self._get_room(room_name)
+        room.members.add(session)
+        session.room = room_name
+        return room
+    
+    def _remove_from_room(self, session):
+        """把会话移出当前房间，返回原房间名；房间没有成员后移除（历史在服务器消息历史中，不受影响）"""
+        room_name, session.room = session.room, None
+        room = self.rooms.get(room_name)
+        if room:
+            room.members.discard(session)
+            if not room.members and room_name != DEFAULT_ROOM:
+                del self.rooms[room_name]
+                self.wake_waiter(room)
+        return room_name
+    
+    async def change_room(self, session, room_name):
+        """切换房间：通知原房间成员离开，通知新房间成员加入"""
+        username = session.username
+        old_room = self._remove_from_room(session)
+        if old_room:
+            leave_msg = {
+                'type': 'system',
+                'time': self.get_time(),
+                'room': old_room,
+                'message': f"{username} 离开了房间"
+            }
+            self.record_message(leave_msg, old_room)
+            # 在离开消息之后记录：回到该房间时不把自己的离开消息补发给自己
+            session.room_seqs[old_room] = self.history.last_seq
+            await self.broadcast(leave_msg, room=old_room)
+        
+        self._add_to_room(session, room_name)
+        self.send_backfill(session, room_name)
+        if self.cluster:
+            self.cluster.move(username, room_name)
+        
+        join_msg = {
+            'type': 'system',
+            'time': self.get_time(),
+            'room': room_name,
+            'message': f"{username} 加入了房间"
+        }
+        self.record_message(join_msg, room_name)
+        await self.broadcast(join_msg, exclude=session, room=room_name)
+        self.log(f"{username} 从房间 {old_room} 切换到 {room_name}", 'INFO')
+    
+    def _get_room(self, room_name):
+        """返回房间，不存在时创建"""
+        room = self.rooms.get(room_name)
+        if room is None:
+            room = self.rooms[room_name] = ChatRoom(room_name)
+        return room
+    
+    def backfill_messages(self, room_name, since=0):
+        """要补发的房间消息：序号大于 since 的最近 backfill_count 条（--backfill-minutes 限制时间范围）"""
+        messages = self.history.since(since, limit=self.backfill_count, room=room_name)
+        if self.backfill_minutes > 0:
+            cutoff = (datetime.now() - timedelta(minutes=self.backfill_minutes)).strftime('%Y-%m-%d %H:%M:%S')
+            messages = [message for message in messages if message.get('time', '') >= cutoff]
+        return messages
+    
+    def backfill_buffer(self, room_name, codec, since=0):
+        """房间最近消息的补发缓冲区：每条消息按编码只序列化一次，同一秒内的后续加入直接复用缓冲区
+        
+        缓存建立后到达的新消息只编码增量，与已编码的帧拼接成新的缓冲区，不重新序列化整段历史。
+        since 大于 0（回到之前离开的房间）时只补发之后的消息，不使用缓存。
+        """
+        if not self.backfill_count:
+            return b''
+        if since:
+            return b''.join(self.encode_message(dict(message, backfill=True), codec)
+                            for message in self.backfill_messages(room_name, since))
+        
+        now = int(time.time())
+        key = (room_name, codec)
+        cached = self._backfill_cache.get(key)
+        if cached and cached[0] == now:
+            self.backfill_cache_hits += 1
+            _, upto_seq, frames, buffer = cached
+            delta = self.history.since(upto_seq, room=room_name)
+            if delta:
+                frames = (frames + [self.encode_message(dict(message, backfill=True), codec)
+                                    for message in delta])[-self.backfill_count:]
+                buffer = b''.join(frames)
+                self._backfill_cache[key] = (now, delta[-1]['seq'], frames, buffer)
+            return buffer
+        
+        messages = self.backfill_messages(room_name)
+        frames = [self.encode_message(dict(message, backfill=True), codec) for message in messages]
+        buffer = b''.join(frames)
+        
+        if len(self._backfill_cache) > 256:
+            # 只保留本秒的缓存
+            self._backfill_cache = {k: v for k, v in self._backfill_cache.items() if v[0] == now}
+        self._backfill_cache[key] = (now, self.history.last_seq, frames, buffer)
+        return buffer
+    
+    def send_backfill(self, session, room_name):
+        """把房间最近的消息作为一次写入放入会话的发送队列（HTTP 轮询会话通过 /messages 获取历史）"""
+        if not session.outbox:
             return
+        buffer = self.backfill_buffer(room_name, session.codec, session.room_seqs.get(room_name, 0))
+        if buffer:
+            session.outbox.put_nowait(buffer)
+            self.backfill_sent += 1
+    
+    def record_message(self, message, room_name=None):
+        """保存消息到历史并分配序号（写入 message['seq']）；room_name 为 None 时所有房间可见"""
+        seq = self.history.append(message, room_name)
+        if self.chat_log:
+            self.chat_log.append(message)
+        if room_name is None:
+            for room in self.rooms.values():
+                self.wake_waiter(room)
+        else:
+            room = self.rooms.get(room_name)
+            if room is not None:
+                self.wake_waiter(room)
+        return seq
+    
+    def encode_message(self, message, codec=None):
+        """把消息编码为一帧字节串：默认为 JSON + 换行，指定 codec 时由其分帧（长度前缀帧或 WebSocket 帧）"""
+        if codec is None:
+            return (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+        return codec.frame(message)
+    
+    async def read_message(self, frames, session):
+        """按会话的分帧方式读取一条客户端消息文本；连接关闭时返回 None
         
-        failed_clients = []
+        超长的消息抛出 FrameTooLarge，无法解码的消息抛出 ValueError，连接本身仍然可用。
+        """
+        if session.codec is None:
+            data = await frames.readline()
+            return data.decode('utf-8') if data is not None else None
         
-        for writer in list(self.clients.keys()):
-            if writer != exclude:
-                try:
-                    writer.write(message.encode('utf-8'))
-                    await writer.drain()
-                except Exception as e:
-                    failed_clients.append(writer)
-                    self.log(f"向 {self.clients.get(writer, 'Unknown')} 发送消息失败: {e}", 'WARNING')
+        if session.codec is WebSocketCodec:
+            return await chat_websocket.read_message(frames, session.writer)
+        
+        payload = await frames.read_frame()
+        if payload is None:
+            return None
+        message = session.codec.decode(payload)
+        if isinstance(message, dict):
+            message = message.get('message', '')
+        return message if isinstance(message, str) else str(message)
+    
+    async def send_to(self, session, message):
+        """向单个客户端发送消息（进入该连接的发送队列）"""
+        if session.outbox:
+            await session.outbox.put(self.encode_message(message, session.codec))
+        elif session.inbox is not None:
+            session.inbox.append(message)
+            self.wake_waiter(session)
+    
+    def poll_messages(self, session, since):
+        """HTTP 轮询会话所在房间中序号大于 since 的消息及其私人消息，返回 (消息列表, 最新序号)"""
+        room_name = session.room or DEFAULT_ROOM if session else DEFAULT_ROOM
+        last_seq = self.history.last_seq
+        if since > last_seq:
+            since = 0  # 服务器已重启，从头开始
+        messages = self.history.since(since, room=room_name)
+        if session and session.inbox:
+            # 只发给该用户的消息（命令回复等）
+            messages = messages + session.inbox
+            session.inbox = []
+        return messages, last_seq
+    
+    async def wait_for_messages(self, session, timeout):
+        """长轮询：等待轮询会话所在房间的新消息或该会话的私人消息，最多 timeout 秒
+        
+        同一房间的所有等待者共享一个 Future，新消息到达时只需完成它一次即可全部唤醒。
+        """
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        if task not in self.long_polls:
+            self.long_polls.add(task)
+            task.add_done_callback(self.long_polls.discard)
+        holders = [self._get_room(session.room or DEFAULT_ROOM if session else DEFAULT_ROOM)]
+        if session:
+            holders.append(session)
+        for holder in holders:
+            if holder.waiter is None:
+                holder.waiter = loop.create_future()
+        waiters = [holder.waiter for holder in holders]
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    
+    def wake_waiter(self, holder):
+        """唤醒在房间或轮询会话上等待的长轮询请求"""
+        waiter = holder.waiter
+        if waiter is not None:
+            holder.waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+    
+    async def broadcast(self, message, exclude=None, relay=True, room=None, received=None):
+        """向房间（room 为 None 时为所有客户端）广播消息（只入队，不等待慢客户端写完）
+        
+        消息对每种编码只编码一次，使用相同编码的接收者共享同一个不可变的 bytes 对象。
+        多进程模式下 relay=True 的消息会经主进程转发给其他工作进程。
+        received 不为空时（客户端发来的聊天消息）记录各阶段的投递延迟。
+        """
+        if relay and self.cluster:
+            self.cluster.publish(message, count=1 if message.get('type') == 'message' else 0)
+        
+        if room is None:
+            recipients = self.sessions.by_writer.values()
+        else:
+            chat_room = self.rooms.get(room)
+            recipients = chat_room.members if chat_room else ()
+        
+        if not recipients:
+            return
+        
+        started = time.perf_counter()
+        frames = {}  # {codec: frame}
+        window = self._next_coalesce_window() if self.coalesce_max > 0 else 0.0
+        wake = window <= 0
+        dirty = self._dirty_outboxes
+        blocked = []
+        delivery = None
+        if received is not None and self.track_latency:
+            self._latency_skip += 1
+            if self._latency_skip >= self.latency_sample:
+                self._latency_skip = 0
+                delivery = Delivery(received)
+        
+        for session in list(recipients):
+            if session is not exclude:
+                outbox = session.outbox
+                if outbox:
+                    frame = frames.get(session.codec)
+                    if frame is None:
+                        frame = frames[session.codec] = self.encode_message(message, session.codec)
+                    if not outbox.put_nowait(frame, wake, delivery):
+                        blocked.append((outbox, frame))
+                    elif not wake:
+                        dirty.add(outbox)
+        
+        # 合并模式：本 tick 内的后续消息共用同一次刷新
+        if dirty and self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(window, self._flush_tick)
+        now = time.perf_counter()
+        self.m_broadcast.observe(now - started)
+        if received is not None and self.track_latency:
+            self.lat_enqueue.observe(now - received)
+            if delivery is not None:
+                delivery.enqueued = now
+        
+        # block 策略：等待队列已满的客户端腾出空位
+        for outbox, frame in blocked:
+            await outbox.put(frame, delivery)
+    
+    async def deliver_remote(self, message):
+        """投递其他工作进程转发来的消息"""
+        room_name = message.get('room')
+        self.record_message(message, room_name)  # 保存到历史
+        await self.broadcast(message, relay=False, room=room_name)
+    
+    async def shutdown(self):
+        """通知所有客户端并关闭服务器"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        
+        shutdown_msg = {
+            'type': 'system',
+            'time': self.get_time(),
+            'message': '服务器即将关闭'
+        }
+        await self.broadcast(shutdown_msg, relay=False)
         
-        # 清理失败的连接
-        for writer in failed_clients:
-            if writer in self.clients:
-                del self.clients[writer]
-            if writer in self.client_info:
-                del self.client_info[writer]
+        # 挂起的长轮询请求立即返回
+        for holder in [*self.rooms.values(), *self.poll_sessions.values()]:
+            self.wake_waiter(holder)
+        if self.long_polls:
+            await asyncio.wait(self.long_polls, timeout=1.0)
+        idle_http = list(self.idle_http.items())
+        for task, writer in idle_http:
+            writer.close()
+        if idle_http:
+            await asyncio.wait([task for task, writer in idle_http], timeout=1.0)
+        
+        # 尽量把关闭通知送达后再断开
+        sessions = list(self.sessions)
+        outboxes = [session.outbox for session in sessions if session.outbox]
+        if outboxes:
+            await asyncio.gather(*(outbox.flush() for outbox in outboxes))
+        
+        for session in sessions:
+            try:
+                session.writer.close()
+                await session.writer.wait_closed()
+            except:
+                pass
+        
+        if self.stopped:
+            self.stopped.set()
+    
+    def _next_coalesce_window(self):
+        """根据消息到达间隔自适应调整合并窗口
+        
+        空闲（间隔超过最大窗口）时窗口为 0，单条消息立即发送；
+        一个窗口内有多条消息到达时窗口翻倍，负载下降时减半。
+        """
+        now = time.monotonic()
+        gap = now - self._last_broadcast
+        self._last_broadcast = now
+        
+        window = self.coalesce_window
+        if gap >= self.coalesce_max:
+            window = 0.0
+        elif window <= 0:
+            window = self.coalesce_min
+        elif gap < window:
+            window = min(window * 2, self.coalesce_max)
+        else:
+            window = max(window / 2, self.coalesce_min)
+        
+        self.coalesce_window = window
+        return window
+    
+    def _flush_tick(self):
+        """合并 tick 到期：每个有积压的客户端只唤醒一次写任务"""
+        self._flush_handle = None
+        dirty = self._dirty_outboxes
+        self._dirty_outboxes = set()
+        for outbox in dirty:
+            outbox.ready.set()
+    
+    def record_batch(self, size):
+        """记录一次写入合并的帧数"""
+        self.flush_count += 1
+        self.flushed_frames += size
+        if size > self.max_batch:
+            self.max_batch = size
+        for i, bound in enumerate(BATCH_BUCKETS):
+            if size <= bound:
+                self.batch_histogram[i] += 1
+                return
+        self.batch_histogram[-1] += 1
+    
+    def record_written(self, deliveries, now):
+        """一次写入完成：记录其中每条计时消息的入队→写出延迟"""
+        observe = self.lat_write.observe
+        for delivery in deliveries:
+            observe(now - delivery.enqueued)
+            delivery.pending -= 1  # 同 settle_delivery()，内联以减少每帧一次调用
+            if not delivery.pending:
+                self.lat_fanout.observe(now - delivery.received)
+    
+    def settle_delivery(self, delivery, now):
+        """一个接收者已写出（或被丢弃、已断开）；最后一个接收者完成时记录总扇出延迟"""
+        delivery.pending -= 1
+        if not delivery.pending:
+            self.lat_fanout.observe(now - delivery.received)
+    
+    def latency_summary(self):
+        """各阶段投递延迟分位数的文字描述（毫秒）"""
+        if not self.track_latency:
+            return "投递延迟: 未启用"
+        parts = []
+        for stage, label in LATENCY_STAGES:
+            histogram = self.latency[stage]
+            if not histogram.count:
+                parts.append(f"{label} 暂无")
+                continue
+            quantiles = ' '.join(f"p{q * 100:g}".replace('.', '') + f" {value * 1000:.2f}"
+                                 for q, value in histogram.percentiles().items())
+            parts.append(f"{label} n={histogram.count} {quantiles} max {histogram.max * 1000:.2f}")
+        sample = f"（入队→写出和总扇出每 {self.latency_sample} 条消息统计一条）" if self.latency_sample > 1 else ""
+        return f"投递延迟（ms）{sample}: " + '; '.join(parts)
+    
+    def batch_summary(self):
+        """写入批量统计的文字描述"""
+        if not self.flush_count:
+            return "写入批量: 暂无"
+        
+        average = self.flushed_frames / self.flush_count
+        labels = []
+        lower = 1
+        for bound, count in zip(BATCH_BUCKETS, self.batch_histogram):
+            labels.append(f"{lower}-{bound}:{count}" if bound > lower else f"{bound}:{count}")
+            lower = bound + 1
+        labels.append(f">{BATCH_BUCKETS[-1]}:{self.batch_histogram[-1]}")
+        return (f"写入批量: 平均 {average:.1f} 帧/次, 最大 {self.max_batch}, "
+                f"写入 {self.flush_count} 次, 分布 [{' '.join(labels)}]")
     
     async def send_server_message(self):
         """允许服务器发送消息的输入循环"""
         print()
         self.log("服务器控制台已就绪", 'SYSTEM')
         self.log("输入消息发送给所有客户端", 'SYSTEM')
-        self.log("命令: 'quit'=退出, 'stats'=统计, 'list'=在线用户, 'savelog'=保存日志", 'SYSTEM')
+        self.log("命令: 'quit'=退出, 'stats'=统计, 'latency'=投递延迟, 'list'=在线用户, 'savelog'=保存日志", 'SYSTEM')
         print("─" * 60)
         
         loop = asyncio.get_event_loop()
@@ -432,50 +1683,49 @@ class TCPChatServer:
                 
                 if message.lower() in ('quit', 'exit', 'stop'):
                     self.log("正在关闭服务器...", 'WARNING')
-                    self.is_running = False
-                    
-                    shutdown_msg = {
-                        'type': 'system',
-                        'time': self.get_time(),
-                        'message': '服务器即将关闭'
-                    }
-                    await self.broadcast(json.dumps(shutdown_msg, ensure_ascii=False) + '\n')
-                    
-                    for writer in list(self.clients.keys()):
-                        try:
-                            writer.close()
-                            await writer.wait_closed()
-                        except:
-                            pass
+                    await self.shutdown()
                     break
                 
                 elif message.lower() == 'stats':
                     uptime = (datetime.now() - self.start_time).total_seconds()
                     print()
                     self.log(f"运行时长: {uptime:.0f} 秒", 'SYSTEM')
-                    self.log(f"在线人数: {len(self.clients)}", 'SYSTEM')
+                    self.log(f"在线人数: {len(self.sessions)}", 'SYSTEM')
                     self.log(f"消息总数: {self.message_count}", 'SYSTEM')
+                    self.log(f"丢弃消息: {self.dropped_messages}", 'SYSTEM')
+                    self.log(f"拒收消息: {self.rejected_messages}（超长或格式错误）", 'SYSTEM')
+                    self.log(f"历史消息: {len(self.history)} 条 / {self.history.total_bytes // 1024} KB | "
+                             f"最新序号 {self.history.last_seq} | 已淘汰 {self.history.evicted_count} 条", 'SYSTEM')
+                    if self.chat_log:
+                        self.log(self.chat_log.summary(), 'SYSTEM')
+                    self.log(f"历史补发: {self.backfill_sent} 次，其中 {self.backfill_cache_hits} 次复用缓存", 'SYSTEM')
+                    self.log(f"断线重连: 已恢复 {self.resumed_count} 次，等待恢复 {len(self.resume_timers)} 个会话", 'SYSTEM')
+                    logger = chat_logging.get_logger()
+                    self.log(f"日志输出: 采样省略 {logger.sampled_out} 条消息日志，队列满丢弃 {logger.dropped} 条", 'SYSTEM')
+                    self.log(self.batch_summary(), 'SYSTEM')
+                    self.log(self.latency_summary(), 'SYSTEM')
+                    if self.coalesce_max > 0:
+                        self.log(f"合并窗口: 当前 {self.coalesce_window * 1000:.1f} ms / 上限 {self.coalesce_max * 1000:.0f} ms", 'SYSTEM')
+                    chat_logging.flush()
                     print()
                 
                 elif message.lower() == 'list':
-                    if self.clients:
+                    if self.sessions:
                         print()
-                        self.log(f"在线用户 ({len(self.clients)}):", 'SYSTEM')
-                        for writer, username in self.clients.items():
-                            info = self.client_info.get(writer, {})
-                            address = info.get('address', 'Unknown')
-                            connect_time = info.get('connect_time')
-                            if connect_time:
-                                duration = (datetime.now() - connect_time).total_seconds()
-                                print(f"  • {username} ({address}) - 在线 {duration:.0f}秒")
-                            else:
-                                print(f"  • {username} ({address})")
+                        self.log(f"在线用户 ({len(self.sessions)}):", 'SYSTEM')
+                        chat_logging.flush()  # 列表直接打印，先写出排队的日志保持顺序
+                        for session in self.sessions:
+                            duration = (datetime.now() - session.connect_time).total_seconds()
+                            print(f"  • {session.username} ({session.address}) [{session.room or DEFAULT_ROOM}] - 在线 {duration:.0f}秒")
                         print()
                     else:
                         self.log("当前无在线用户", 'INFO')
                 
+                elif message.lower() == 'latency':
+                    self.log(self.latency_summary(), 'SYSTEM')
+                
                 elif message.lower() == 'savelog':
-                    if self._save_logs_to_file():
+                    if await loop.run_in_executor(None, self._save_logs_to_file):
                         self.log("日志已手动保存", 'SUCCESS')
                     else:
                         self.log("日志保存失败", 'ERROR')
@@ -487,8 +1737,8 @@ class TCPChatServer:
                         'username': 'Server',
                         'message': message
                     }
-                    self.messages.append(broadcast_msg)  # 保存到历史
-                    await self.broadcast(json.dumps(broadcast_msg, ensure_ascii=False) + '\n')
+                    self.record_message(broadcast_msg)  # 保存到所有房间的历史
+                    await self.broadcast(broadcast_msg)
                     self.log(f"已广播: {message}", 'SUCCESS')
                     self.message_count += 1
                     
@@ -506,7 +1756,20 @@ class TCPChatServer:
         print("═" * 60)
         print(f"{Colors.GREEN}✓{Colors.ENDC} 服务器已启动")
         print(f"{Colors.GREEN}✓{Colors.ENDC} 监听地址: {Colors.BOLD}{self.host}:{self.port}{Colors.ENDC}")
-        print(f"{Colors.GREEN}✓{Colors.ENDC} 协议类型: {Colors.BOLD}TCP Socket{Colors.ENDC}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 协议类型: {Colors.BOLD}TCP Socket / WebSocket / HTTP 轮询（同一端口）{Colors.ENDC}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 发送队列: {Colors.BOLD}{self.queue_size} 条 / 慢客户端策略 {self.slow_policy}{Colors.ENDC}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 消息大小上限: {Colors.BOLD}{self.max_message_size} 字节{Colors.ENDC}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 历史容量: {Colors.BOLD}{self.history.max_messages} 条 / {self.history.max_bytes // 1024} KB{Colors.ENDC}")
+        if self.backfill_count:
+            window = f"（{self.backfill_minutes:g} 分钟内）" if self.backfill_minutes > 0 else ''
+            print(f"{Colors.GREEN}✓{Colors.ENDC} 加入时补发: {Colors.BOLD}最近 {self.backfill_count} 条{window}{Colors.ENDC}")
+        if self.resume_grace > 0:
+            print(f"{Colors.GREEN}✓{Colors.ENDC} 断线重连: {Colors.BOLD}会话保留 {self.resume_grace:g} 秒{Colors.ENDC}")
+        if self.metrics_port:
+            print(f"{Colors.GREEN}✓{Colors.ENDC} 运行指标: {Colors.BOLD}http://{self.metrics_host}:{self.metrics_port}/metrics{Colors.ENDC}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 聊天日志: {Colors.BOLD}{self.chat_log.segment_path}（每 {self.log_flush_ms:g} ms 组提交）{Colors.ENDC}")
+        if self.coalesce_max > 0:
+            print(f"{Colors.GREEN}✓{Colors.ENDC} 消息合并: {Colors.BOLD}{self.coalesce_min * 1000:.0f}-{self.coalesce_max * 1000:.0f} ms 自适应窗口{Colors.ENDC}")
         
         if self.host == '0.0.0.0':
             local_ip = self.get_local_ip()
@@ -514,28 +1777,51 @@ class TCPChatServer:
             print(f"{Colors.GREEN}✓{Colors.ENDC} 局域网访问: {Colors.BOLD}{local_ip}:{self.port}{Colors.ENDC}")
         
         print(f"{Colors.GREEN}✓{Colors.ENDC} Python 版本: {platform.python_version()}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 事件循环: {type(asyncio.get_running_loop()).__module__.split('.')[0]}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 二进制分帧编码: {', '.join(available_codecs())}")
         print(f"{Colors.GREEN}✓{Colors.ENDC} 操作系统: {platform.system()} {platform.release()}")
         print("─" * 60)
-        print(f"{Colors.YELLOW}📝{Colors.ENDC} 使用 TCP 客户端连接")
+        print(f"{Colors.YELLOW}📝{Colors.ENDC} 使用 TCP 客户端连接，浏览器可直接连接 ws://地址:{self.port}")
         print(f"{Colors.YELLOW}💡{Colors.ENDC} 支持内网穿透 TCP 隧道")
         print("═" * 60)
     
-    async def start(self):
-        """启动服务器"""
+    async def start(self, interactive=True, reuse_port=False):
+        """启动服务器
+        
+        interactive=False 时不启动控制台，直到 shutdown() 被调用；
+        reuse_port=True 时允许多个进程监听同一端口（SO_REUSEPORT）。
+        """
         try:
-            self.print_banner()
+            self.open_chat_log()
+            if interactive:
+                self.print_banner()
             
+            self.loop = asyncio.get_running_loop()
             server = await asyncio.start_server(
                 self.handle_client,
                 self.host,
-                self.port
+                self.port,
+                reuse_port=reuse_port or None
             )
             
+            metrics_server = None
+            if self.metrics_port:
+                metrics_server = await serve_metrics(self.metrics, self.metrics_host, self.metrics_port)
+                self.log(f"指标端口已就绪: http://{self.metrics_host}:{self.metrics_port}/metrics", 'SUCCESS')
+            
             self.log("TCP 服务器已就绪，等待连接...", 'SUCCESS')
+            expire_task = asyncio.create_task(self._expire_poll_sessions())
             
             async with server:
-                # 启动服务器消息输入
-                await self.send_server_message()
+                if interactive:
+                    # 启动服务器消息输入
+                    await self.send_server_message()
+                else:
+                    self.stopped = asyncio.Event()
+                    await self.stopped.wait()
+            expire_task.cancel()
+            if metrics_server:
+                metrics_server.close()
                 
         except OSError as e:
             if e.errno == 10048:
@@ -544,33 +1830,241 @@ class TCPChatServer:
                 self.log(f"服务器启动失败: {e}", 'ERROR')
         except Exception as e:
             self.log(f"服务器错误: {type(e).__name__}: {e}", 'ERROR')
+        finally:
+            if self.chat_log:
+                self.chat_log.close()
 
 def signal_handler(sig, frame):
     """处理 Ctrl+C 信号"""
     print(f"\n{Colors.YELLOW}[系统] 收到中断信号{Colors.ENDC}")
     sys.exit(0)
 
-async def main():
-    """主函数"""
-    signal.signal(signal.SIGINT, signal_handler)
-    
-    port = 9999
-    if len(sys.argv) > 1:
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print(f"{Colors.RED}错误: 无效的端口号{Colors.ENDC}")
-            sys.exit(1)
-    
-    server = TCPChatServer(port=port)
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='NeoChat TCP 服务器')
+    parser.add_argument('port', nargs='?', default='9999', help='监听端口 (默认 9999)')
+    parser.add_argument('--queue-size', type=int, default=1024, help='每个客户端发送队列的最大消息数 (默认 1024)')
+    parser.add_argument('--slow-policy', choices=SLOW_POLICIES, default='drop_oldest',
+                        help='发送队列满时的策略: drop_oldest=丢弃最旧消息, disconnect=持续满载后断开, block=等待 (默认 drop_oldest)')
+    parser.add_argument('--slow-timeout', type=float, default=10.0, help='disconnect 策略下允许持续满载的秒数 (默认 10)')
+    parser.add_argument('--coalesce-ms', type=float, default=0, help='消息合并窗口上限（毫秒），0 表示关闭 (默认 0)')
+    parser.add_argument('--coalesce-min-ms', type=float, default=2, help='消息合并窗口下限（毫秒）(默认 2)')
+    parser.add_argument('--workers', type=int, default=1, help='工作进程数，大于 1 时启用 SO_REUSEPORT 多进程模式 (默认 1)')
+    parser.add_argument('--loop', choices=event_loop.LOOP_CHOICES, default='asyncio',
+                        help='事件循环: asyncio=标准循环, uvloop=使用 uvloop, auto=已安装 uvloop 时使用 (默认 asyncio)')
+    parser.add_argument('--max-message-size', type=int, default=64 * 1024,
+                        help='单条消息的最大字节数，超过的消息被丢弃并通知客户端 (默认 65536)')
+    parser.add_argument('--history-size', type=int, default=DEFAULT_MAX_MESSAGES,
+                        help=f'内存中保留的历史消息条数，超出的最旧消息转入日志 (默认 {DEFAULT_MAX_MESSAGES})')
+    parser.add_argument('--history-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help=f'内存中历史消息的大致字节上限 (默认 {DEFAULT_MAX_BYTES})')
+    parser.add_argument('--log-flush-ms', type=float, default=DEFAULT_FLUSH_MS,
+                        help=f'聊天日志组提交（fsync）间隔，崩溃时最多丢失这段时间内的消息 (默认 {DEFAULT_FLUSH_MS})')
+    parser.add_argument('--backfill', type=int, default=50,
+                        help='加入房间时补发的最近消息条数，0 表示不补发 (默认 50)')
+    parser.add_argument('--backfill-minutes', type=float, default=0,
+                        help='只补发最近这么多分钟内的消息，0 表示不限时间 (默认 0)')
+    parser.add_argument('--resume-grace', type=float, default=DEFAULT_RESUME_GRACE,
+                        help=f'断线后保留会话等待客户端带令牌重连的秒数，0 表示关闭；多进程模式下不可用 (默认 {DEFAULT_RESUME_GRACE})')
+    parser.add_argument('--max-rooms', type=int, default=DEFAULT_MAX_ROOMS,
+                        help=f'同时存在的房间数上限，达到后 /join 只能进入已有房间 (默认 {DEFAULT_MAX_ROOMS})')
+    parser.add_argument('--allow-same-ip', action='store_true',
+                        help='允许同一 IP 的多个连接（默认新连接顶替旧连接），多个用户经桥接服务器或 NAT 接入时使用；多进程模式下始终允许')
+    parser.add_argument('--log-compress', choices=COMPRESS_CHOICES, default='gzip',
+                        help='已关闭日志段的压缩编码（在独立进程中执行），none 表示不压缩 (默认 gzip)')
+    parser.add_argument('--log-max-age-days', type=float, default=DEFAULT_MAX_AGE_DAYS,
+                        help=f'日志归档最长保留天数，0 表示不限 (默认 {DEFAULT_MAX_AGE_DAYS})')
+    parser.add_argument('--log-max-size-mb', type=float, default=DEFAULT_MAX_SIZE_MB,
+                        help=f'chat_logs 目录总大小上限（MB），超过时删除最旧的归档，0 表示不限 (默认 {DEFAULT_MAX_SIZE_MB})')
+    parser.add_argument('--log-segment-mb', type=int, default=DEFAULT_SEGMENT_BYTES // (1024 * 1024),
+                        help=f'聊天日志单个段文件的大小上限（MB），超过后切换到新段 (默认 {DEFAULT_SEGMENT_BYTES // (1024 * 1024)})')
+    parser.add_argument('--latency-sample', type=int, default=DEFAULT_LATENCY_SAMPLE,
+                        help=f'每 N 条聊天消息跟踪一条的入队→写出和总扇出延迟，1 表示全部跟踪 (默认 {DEFAULT_LATENCY_SAMPLE})')
+    chat_metrics.add_arguments(parser)
+    chat_logging.add_arguments(parser)
+    return parser.parse_args()
+
+def server_options(args):
+    """从命令行参数构造 TCPChatServer 的关键字参数"""
+    return {
+        'queue_size': args.queue_size,
+        'slow_policy': args.slow_policy,
+        'slow_timeout': args.slow_timeout,
+        'coalesce_ms': args.coalesce_ms,
+        'coalesce_min_ms': args.coalesce_min_ms,
+        'max_message_size': args.max_message_size,
+        'history_size': args.history_size,
+        'history_bytes': args.history_bytes,
+        'log_flush_ms': args.log_flush_ms,
+        'log_segment_bytes': args.log_segment_mb * 1024 * 1024,
+        'backfill_count': args.backfill,
+        'backfill_minutes': args.backfill_minutes,
+        'resume_grace': args.resume_grace,
+        'allow_same_ip': args.allow_same_ip,
+        'max_rooms': args.max_rooms,
+        'metrics_port': args.metrics_port,
+        'metrics_host': args.metrics_host,
+        'latency_sample': args.latency_sample
+    }
+
+def log_retention(args):
+    """根据命令行参数创建聊天日志目录的压缩和保留管理（多进程模式下只在主进程运行）"""
+    return LogRetention('chat_logs', args.log_compress, max_age_days=args.log_max_age_days,
+                        max_size_mb=args.log_max_size_mb, log=log_line)
+
+async def run_server(port, options):
+    """单进程模式"""
+    server = TCPChatServer(port=port, **options)
     
     try:
         await server.start()
     except KeyboardInterrupt:
         print(f"\n{Colors.YELLOW}[服务器] 已关闭{Colors.ENDC}")
 
+async def run_worker_server(worker_id, port, options, hub_path):
+    """工作进程：连接主进程的中继枢纽后在共享端口上提供服务"""
+    if options.get('metrics_port'):
+        # 每个工作进程有自己的指标，分别监听 指标端口 + 编号
+        options = dict(options, metrics_port=options['metrics_port'] + worker_id)
+    server = TCPChatServer(port=port, **options)
+    server.worker_id = worker_id
+    server.cluster = ClusterLink(hub_path, server, worker_id)
+    await server.cluster.connect()
+    await server.start(interactive=False, reuse_port=True)
+
+def worker_main(worker_id, port, options, hub_path, loop_name='asyncio', log_settings=None):
+    """工作进程入口"""
+    # Ctrl+C 由主进程处理，工作进程随中继连接断开而退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if log_settings:
+        chat_logging.configure(**log_settings)
+    event_loop.run(run_worker_server(worker_id, port, options, hub_path), loop=loop_name)
+
+async def run_cluster_console(hub, processes):
+    """多进程模式下主进程的控制台"""
+    print()
+    hub.log("服务器控制台已就绪", 'SYSTEM')
+    hub.log("输入消息发送给所有客户端", 'SYSTEM')
+    hub.log("命令: 'quit'=退出, 'stats'=统计, 'list'=在线用户", 'SYSTEM')
+    print("─" * 60)
+    
+    loop = asyncio.get_event_loop()
+    
+    while True:
+        try:
+            message = await loop.run_in_executor(None, input, f"{Colors.GREEN}Server>{Colors.ENDC} ")
+            message = message.strip()
+            
+            if not message:
+                continue
+            
+            if message.lower() in ('quit', 'exit', 'stop'):
+                hub.log("正在关闭服务器...", 'WARNING')
+                break
+            
+            elif message.lower() == 'stats':
+                print()
+                hub.log(f"工作进程: {len(hub.workers)}/{len(processes)} 在线", 'SYSTEM')
+                hub.log(f"在线人数: {len(hub.users)}", 'SYSTEM')
+                hub.log(f"消息总数: {hub.message_count}", 'SYSTEM')
+                chat_logging.flush()
+                print()
+            
+            elif message.lower() == 'list':
+                if hub.users:
+                    print()
+                    hub.log(f"在线用户 ({len(hub.users)}):", 'SYSTEM')
+                    chat_logging.flush()  # 列表直接打印，先写出排队的日志保持顺序
+                    for username, worker_id in hub.users.items():
+                        print(f"  • {username} (工作进程 {worker_id})")
+                    print()
+                else:
+                    hub.log("当前无在线用户", 'INFO')
+            
+            else:
+                hub.broadcast_server_message(message)
+                hub.log(f"已广播: {message}", 'SUCCESS')
+                
+        except EOFError:
+            hub.log("检测到输入结束", 'WARNING')
+            break
+        except Exception as e:
+            hub.log(f"输入循环错误: {e}", 'ERROR')
+            break
+
+async def run_cluster_hub(hub, processes):
+    """主进程：运行中继枢纽和控制台"""
+    try:
+        await run_cluster_console(hub, processes)
+    finally:
+        await hub.stop()
+
+def run_cluster(port, options, workers, loop_name='asyncio'):
+    """多进程模式：各工作进程通过 SO_REUSEPORT 共享端口，主进程负责消息中继"""
+    if not cluster_supported():
+        print(f"{Colors.RED}错误: 当前平台不支持 --workers（需要 SO_REUSEPORT 和 Unix 域套接字）{Colors.ENDC}")
+        sys.exit(1)
+    
+    hub_path = os.path.join(tempfile.mkdtemp(prefix='neochat_'), 'hub.sock')
+    hub = ClusterHub(hub_path, log_line)
+    
+    print("\n" + "═" * 60)
+    print(f"{Colors.BOLD}{Colors.CYAN}      NeoChat TCP 服务器（多进程）{Colors.ENDC}")
+    print("═" * 60)
+    print(f"{Colors.GREEN}✓{Colors.ENDC} 监听端口: {Colors.BOLD}{port}{Colors.ENDC}（SO_REUSEPORT）")
+    print(f"{Colors.GREEN}✓{Colors.ENDC} 工作进程: {Colors.BOLD}{workers}{Colors.ENDC}")
+    print(f"{Colors.GREEN}✓{Colors.ENDC} 进程间中继: {Colors.BOLD}{hub_path}{Colors.ENDC}")
+    print(f"{Colors.GREEN}✓{Colors.ENDC} 事件循环: {Colors.BOLD}{event_loop.resolve_loop(loop_name)[1]}{Colors.ENDC}")
+    print("═" * 60)
+    
+    context = multiprocessing.get_context('spawn')
+    loop = event_loop.new_event_loop(loop_name)
+    processes = []
+    try:
+        # 先启动中继枢纽，再创建工作进程
+        loop.run_until_complete(hub.start())
+        for worker_id in range(workers):
+            process = context.Process(
+                target=worker_main,
+                args=(worker_id, port, options, hub_path, loop_name, chat_logging.get_logger().settings()),
+                daemon=True
+            )
+            process.start()
+            processes.append(process)
+        
+        loop.run_until_complete(run_cluster_hub(hub, processes))
+    finally:
+        for process in processes:
+            process.join(timeout=3)
+            if process.is_alive():
+                process.terminate()
+        loop.close()
+
+def main():
+    """主函数"""
+    signal.signal(signal.SIGINT, signal_handler)
+    
+    args = parse_args()
+    try:
+        port = int(args.port)
+    except ValueError:
+        print(f"{Colors.RED}错误: 无效的端口号{Colors.ENDC}")
+        sys.exit(1)
+    chat_logging.configure_from_args(args)
+    
+    retention = log_retention(args)
+    retention.start()
+    try:
+        if args.workers > 1:
+            run_cluster(port, server_options(args), args.workers, args.loop)
+        else:
+            event_loop.run(run_server(port, server_options(args)), loop=args.loop)
+    finally:
+        retention.stop()
+
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # 打包后工作进程和日志压缩进程池的子进程在这里接管，不进入 main()
     try:
-        asyncio.run(main())
+        main()
     except KeyboardInterrupt:
         print(f"\n{Colors.YELLOW}再见！{Colors.ENDC}")
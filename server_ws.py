@@ -4,15 +4,22 @@ NeoChat WebSocket 服务端 (增强版)
 """
 
 import asyncio
+import argparse
 import websockets
 from datetime import datetime
 import signal
 import sys
 import platform
 import socket
+import time
 from http import HTTPStatus
 import logging
 
+import event_loop
+import chat_logging
+import chat_metrics
+from chat_metrics import MetricsRegistry, serve_metrics
+
 class Colors:
     """终端颜色代码"""
     HEADER = '\033[95m'
@@ -26,7 +33,7 @@ class Colors:
     UNDERLINE = '\033[4m'
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=9999):
+    def __init__(self, host='0.0.0.0', port=9999, metrics_port=0, metrics_host='0.0.0.0'):
         self.host = host
         self.port = port
         self.clients = {}  # {websocket: username}
@@ -35,21 +42,34 @@ class ChatServer:
         self.start_time = datetime.now()
         self.is_running = True
         
-    def log(self, message, level='INFO'):
-        """格式化日志输出"""
-        timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        colors = {
-            'INFO': Colors.CYAN,
-            'SUCCESS': Colors.GREEN,
-            'WARNING': Colors.YELLOW,
-            'ERROR': Colors.RED,
-            'MESSAGE': Colors.BLUE,
-            'SYSTEM': Colors.HEADER
-        }
+        # 运行指标（metrics_port 不为 0 时开放 Prometheus 端口）
+        self.metrics = MetricsRegistry()
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        m = self.metrics
+        self.m_connections = m.counter('connections_total', '接受的 WebSocket 连接数')
+        self.m_joins = m.counter('joins_total', '加入聊天室的次数')
+        self.m_leaves = m.counter('leaves_total', '离开聊天室的次数')
+        self.m_messages_in = m.counter('messages_received_total', '收到的客户端消息数（包括命令）')
+        self.m_messages_out = m.counter('messages_sent_total', '广播发出的消息数（按接收者计）')
+        self.m_bytes_in = m.counter('bytes_received_total', '收到的消息字节数（UTF-8）')
+        self.m_bytes_out = m.counter('bytes_sent_total', '广播发出的消息字节数（UTF-8）')
+        self.m_send_errors = m.counter('send_errors_total', '发送失败的次数')
+        self.m_broadcast = m.histogram('broadcast_seconds', '一次广播发送给全部接收者的耗时（秒）')
+        m.gauge('sessions', '在线用户数', fn=lambda: len(self.clients))
+        m.gauge('write_buffer_bytes', '所有连接的发送缓冲区中等待写出的字节数', fn=self._write_buffer_bytes)
         
-        color = colors.get(level, Colors.ENDC)
-        print(f"{color}[{timestamp}] [{level}]{Colors.ENDC} {message}")
+    def log(self, message, level='INFO', **fields):
+        """日志输出（交给后台线程写出，不阻塞事件循环；fields 只出现在 JSON 格式的日志中）"""
+        chat_logging.log(message, level, **fields)
+    
+    def _write_buffer_bytes(self):
+        total = 0
+        for client in list(self.clients):
+            transport = getattr(client, 'transport', None)
+            if transport is not None:
+                total += transport.get_write_buffer_size()
+        return total
     
     def get_time(self):
         """获取当前时间字符串"""
@@ -79,6 +99,7 @@ class ChatServer:
             }
             
             self.log(f"新连接来自 {client_address}", 'INFO')
+            self.m_connections.inc()
             
             # 接收用户名（设置超时）
             try:
@@ -108,6 +129,7 @@ class ChatServer:
             # 添加到客户端列表
             self.clients[websocket] = username
             self.client_info[websocket]['username'] = username
+            self.m_joins.inc()
             
             self.log(f"✓ {username} ({client_address}) 加入聊天室 | 在线人数: {len(self.clients)}", 'SUCCESS')
             
@@ -124,13 +146,15 @@ class ChatServer:
                 message = message.strip()
                 if message:
                     self.message_count += 1
+                    self.m_messages_in.inc()
+                    self.m_bytes_in.inc(len(message.encode('utf-8')))
                     
                     # 检查是否是命令
                     if message.startswith('/'):
                         await self.handle_command(websocket, username, message)
                         continue
                     
-                    self.log(f"{username}: {message[:50]}{'...' if len(message) > 50 else ''}", 'MESSAGE')
+                    self.log(f"{username}: {message[:50]}{'...' if len(message) > 50 else ''}", 'MESSAGE', username=username)
                     
                     # 广播消息
                     broadcast_msg = f"[{self.get_time()}] {username}: {message}"
@@ -147,6 +171,7 @@ class ChatServer:
             if websocket in self.clients:
                 username = self.clients[websocket]
                 del self.clients[websocket]
+                self.m_leaves.inc()
                 
                 if websocket in self.client_info:
                     info = self.client_info[websocket]
@@ -205,15 +230,21 @@ class ChatServer:
                     tasks.append(client.send(message))
                 except Exception as e:
                     failed_clients.append(client)
+                    self.m_send_errors.inc()
                     self.log(f"向 {self.clients.get(client, 'Unknown')} 发送消息失败: {e}", 'WARNING')
         
         # 并发发送
         if tasks:
+            started = time.perf_counter()
             results = await asyncio.gather(*tasks, return_exceptions=True)
+            self.m_broadcast.observe(time.perf_counter() - started)
+            self.m_messages_out.inc(len(tasks))
+            self.m_bytes_out.inc(len(message.encode('utf-8')) * len(tasks))
             
             # 检查发送结果
             for i, result in enumerate(results):
                 if isinstance(result, Exception):
+                    self.m_send_errors.inc()
                     self.log(f"广播消息时出错: {result}", 'WARNING')
         
         # 清理失败的连接
@@ -266,12 +297,14 @@ class ChatServer:
                     self.log(f"运行时长: {uptime:.0f} 秒", 'SYSTEM')
                     self.log(f"在线人数: {len(self.clients)}", 'SYSTEM')
                     self.log(f"消息总数: {self.message_count}", 'SYSTEM')
+                    chat_logging.flush()
                     print()
                 
                 elif message.lower() == 'list':
                     if self.clients:
                         print()
                         self.log(f"在线用户 ({len(self.clients)}):", 'SYSTEM')
+                        chat_logging.flush()  # 列表直接打印，先写出排队的日志保持顺序
                         for ws, username in self.clients.items():
                             info = self.client_info.get(ws, {})
                             address = info.get('address', 'Unknown')
@@ -315,6 +348,7 @@ class ChatServer:
             print(f"{Colors.GREEN}✓{Colors.ENDC} 访问地址: {Colors.BOLD}ws://{self.host}:{self.port}{Colors.ENDC}")
         
         print(f"{Colors.GREEN}✓{Colors.ENDC} Python 版本: {platform.python_version()}")
+        print(f"{Colors.GREEN}✓{Colors.ENDC} 事件循环: {type(asyncio.get_running_loop()).__module__.split('.')[0]}")
         print(f"{Colors.GREEN}✓{Colors.ENDC} 操作系统: {platform.system()} {platform.release()}")
         print("─" * 60)
         print(f"{Colors.YELLOW}📝{Colors.ENDC} 在浏览器中打开 {Colors.BOLD}client.html{Colors.ENDC} 开始聊天")
@@ -342,6 +376,9 @@ class ChatServer:
             ):
                 self.log("WebSocket 服务器已就绪，等待连接...", 'SUCCESS')
                 self.log("已启用健康检查容错（忽略空连接）", 'INFO')
+                if self.metrics_port:
+                    await serve_metrics(self.metrics, self.metrics_host, self.metrics_port)
+                    self.log(f"指标端口已就绪: http://{self.metrics_host}:{self.metrics_port}/metrics", 'SUCCESS')
                 
                 # 启动服务器消息输入
                 await self.send_server_message()
@@ -362,20 +399,21 @@ def signal_handler(sig, frame):
     print(f"\n{Colors.YELLOW}[系统] 收到中断信号{Colors.ENDC}")
     sys.exit(0)
 
-async def main():
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='NeoChat WebSocket 服务器')
+    parser.add_argument('port', nargs='?', default='9999', help='监听端口 (默认 9999)')
+    parser.add_argument('--loop', choices=event_loop.LOOP_CHOICES, default='asyncio',
+                        help='事件循环: asyncio=标准循环, uvloop=使用 uvloop, auto=已安装 uvloop 时使用 (默认 asyncio)')
+    chat_metrics.add_arguments(parser)
+    chat_logging.add_arguments(parser)
+    return parser.parse_args()
+
+async def main(port, metrics_port=0, metrics_host='0.0.0.0'):
     """主函数"""
     signal.signal(signal.SIGINT, signal_handler)
     
-    # 可以通过命令行参数指定端口
-    port = 9999
-    if len(sys.argv) > 1:
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print(f"{Colors.RED}错误: 无效的端口号{Colors.ENDC}")
-            sys.exit(1)
-    
-    server = ChatServer(port=port)
+    server = ChatServer(port=port, metrics_port=metrics_port, metrics_host=metrics_host)
     
     try:
         await server.start()
@@ -383,7 +421,16 @@ async def main():
         print(f"\n{Colors.YELLOW}[服务器] 已关闭{Colors.ENDC}")
 
 if __name__ == '__main__':
+    # 可以通过命令行参数指定端口和事件循环
+    args = parse_args()
+    try:
+        port = int(args.port)
+    except ValueError:
+        print(f"{Colors.RED}错误: 无效的端口号{Colors.ENDC}")
+        sys.exit(1)
+    chat_logging.configure_from_args(args)
+    
     try:
-        asyncio.run(main())
+        event_loop.run(main(port, args.metrics_port, args.metrics_host), loop=args.loop)
     except KeyboardInterrupt:
         print(f"\n{Colors.YELLOW}再见！{Colors.ENDC}")
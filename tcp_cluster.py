@@ -0,0 +1,278 @@
+"""
+NeoChat TCP 多进程模式
+主进程运行中继枢纽（Unix 域套接字），各工作进程通过 SO_REUSEPORT 共享同一监听端口。
+工作进程之间的消息经枢纽转发，在线用户表和消息计数由枢纽统一维护，
+因此 /online、/stats 和用户名去重在所有工作进程之间保持全局一致。
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import socket
+from datetime import datetime
+
+
+def cluster_supported():
+    """当前平台是否支持多进程模式（需要 SO_REUSEPORT 和 Unix 域套接字）"""
+    return hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')
+
+
+def _encode(obj):
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+class ClusterHub:
+    """主进程中的中继枢纽：转发消息并维护全局在线用户表"""
+
+    def __init__(self, path, log):
+        self.path = path
+        self.log = log
+        self.workers = {}  # {writer: worker_id}
+        self.users = {}  # {username: worker_id} 全局在线用户
+        self.user_rooms = {}  # {username: room_name} 用户当前所在房间
+        self.room_users = {}  # {room_name: {username}} 房间成员索引
+        self.name_counters = {}  # {基础用户名: 下一个尝试的后缀}
+        self.message_count = 0
+        self.server = None
+        self.tasks = set()  # 各工作进程连接的处理任务
+
+    async def start(self):
+        """启动枢纽监听"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_worker, self.path, limit=16 * 1024 * 1024)
+
+    async def stop(self, timeout=5.0):
+        """通知所有工作进程关闭，等待它们断开后停止枢纽"""
+        self.send_all({'op': 'shutdown'})
+        for writer in list(self.workers):
+            try:
+                await writer.drain()
+            except Exception:
+                pass
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)
+        if self.server:
+            self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def send_all(self, obj, exclude=None):
+        """向所有（或除 exclude 外的）工作进程发送一条指令"""
+        data = _encode(obj)
+        for writer in list(self.workers):
+            if writer is not exclude:
+                writer.write(data)
+
+    def claim_username(self, username, worker_id, room):
+        """占用用户名，重名时自动添加后缀"""
+        if username in self.users:
+            original_username = username
+            counter = self.name_counters.get(original_username, 1)
+            while username in self.users:
+                username = f"{original_username}_{counter}"
+                counter += 1
+            self.name_counters[original_username] = counter
+        self.users[username] = worker_id
+        self.set_room(username, room)
+        return username
+    
+    def set_room(self, username, room):
+        """更新用户所在房间（room 为 None 时移出所有房间）"""
+        old_room = self.user_rooms.pop(username, None)
+        members = self.room_users.get(old_room)
+        if members is not None:
+            members.discard(username)
+            if not members:
+                del self.room_users[old_room]
+        if room is not None:
+            self.user_rooms[username] = room
+            self.room_users.setdefault(room, set()).add(username)
+    
+    def release_username(self, username):
+        """释放用户名及其房间记录"""
+        del self.users[username]
+        self.set_room(username, None)
+
+    async def handle_worker(self, reader, writer):
+        """处理单个工作进程的连接"""
+        worker_id = None
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                request = json.loads(line)
+                op = request.get('op')
+
+                if op == 'hello':
+                    worker_id = request['worker']
+                    self.workers[writer] = worker_id
+                    self.log(f"工作进程 {worker_id} 已接入", 'INFO')
+
+                elif op == 'publish':
+                    self.message_count += request.get('count', 0)
+                    self.send_all({'op': 'deliver', 'message': request['message']}, exclude=writer)
+
+                elif op == 'count':
+                    self.message_count += request.get('count', 1)
+
+                elif op == 'claim':
+                    username = self.claim_username(request['username'], worker_id, request.get('room'))
+                    writer.write(_encode({'op': 'reply', 'id': request['id'], 'username': username,
+                                          'online': len(self.users)}))
+
+                elif op == 'release':
+                    username = request['username']
+                    if self.users.get(username) == worker_id:
+                        self.release_username(username)
+
+                elif op == 'move':
+                    if self.users.get(request['username']) == worker_id:
+                        self.set_room(request['username'], request['room'])
+
+                elif op == 'online':
+                    room = request.get('room')
+                    if room is None:
+                        users = list(self.users)
+                    else:
+                        users = list(self.room_users.get(room, ()))
+                    writer.write(_encode({'op': 'reply', 'id': request['id'], 'users': users}))
+
+                elif op == 'rooms':
+                    rooms = {room: len(members) for room, members in self.room_users.items()}
+                    writer.write(_encode({'op': 'reply', 'id': request['id'], 'rooms': rooms}))
+
+                elif op == 'stats':
+                    writer.write(_encode({'op': 'reply', 'id': request['id'], 'online': len(self.users),
+                                          'message_count': self.message_count, 'workers': len(self.workers)}))
+
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            self.log(f"工作进程 {worker_id} 通信错误: {type(e).__name__}: {e}", 'ERROR')
+        finally:
+            self.workers.pop(writer, None)
+            # 工作进程退出时释放它占用的用户名
+            for username, owner in list(self.users.items()):
+                if owner == worker_id:
+                    self.release_username(username)
+            if worker_id is not None:
+                self.log(f"工作进程 {worker_id} 已断开", 'WARNING')
+            writer.close()
+            self.tasks.discard(task)
+
+    def broadcast_server_message(self, message):
+        """从主进程控制台向所有工作进程广播服务器消息"""
+        broadcast_msg = {
+            'type': 'message',
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'username': 'Server',
+            'message': message
+        }
+        self.message_count += 1
+        self.send_all({'op': 'deliver', 'message': broadcast_msg})
+
+
+class ClusterLink:
+    """工作进程到枢纽的连接"""
+
+    def __init__(self, path, server, worker_id):
+        self.path = path
+        self.server = server
+        self.worker_id = worker_id
+        self.reader = None
+        self.writer = None
+        self.pending = {}  # {request_id: Future}
+        self.ids = itertools.count(1)
+        self.read_task = None
+
+    async def connect(self):
+        """连接枢纽并启动接收任务"""
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=16 * 1024 * 1024)
+        self.send({'op': 'hello', 'worker': self.worker_id})
+        self.read_task = asyncio.create_task(self._read_loop())
+
+    def send(self, obj):
+        """向枢纽发送一条指令（不等待）"""
+        self.writer.write(_encode(obj))
+
+    async def request(self, op, **fields):
+        """向枢纽发送请求并等待回复"""
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.send({'op': op, 'id': request_id, **fields})
+        await self.writer.drain()
+        return await future
+
+    def publish(self, message, count=0):
+        """把本进程广播的消息转发给其他工作进程"""
+        self.send({'op': 'publish', 'message': message, 'count': count})
+
+    def count(self, n=1):
+        """累加全局消息计数（不产生广播的消息，例如命令）"""
+        self.send({'op': 'count', 'count': n})
+
+    async def claim(self, username, room):
+        """在全局范围内占用用户名并进入房间，返回 (去重后的用户名, 全局在线人数)"""
+        reply = await self.request('claim', username=username, room=room)
+        return reply['username'], reply['online']
+
+    def release(self, username):
+        """释放用户名"""
+        self.send({'op': 'release', 'username': username})
+
+    def move(self, username, room):
+        """记录用户切换到的房间"""
+        self.send({'op': 'move', 'username': username, 'room': room})
+
+    async def online(self, room=None):
+        """全局在线用户列表；指定 room 时只返回该房间的用户"""
+        reply = await self.request('online', room=room)
+        return reply['users']
+
+    async def rooms(self):
+        """全局房间人数 {room_name: count}"""
+        reply = await self.request('rooms')
+        return reply['rooms']
+
+    async def stats(self):
+        """全局统计信息"""
+        return await self.request('stats')
+
+    async def _read_loop(self):
+        """接收枢纽转发的消息和请求回复"""
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+
+                reply = json.loads(line)
+                op = reply.get('op')
+
+                if op == 'reply':
+                    future = self.pending.pop(reply['id'], None)
+                    if future and not future.done():
+                        future.set_result(reply)
+                elif op == 'deliver':
+                    await self.server.deliver_remote(reply['message'])
+                elif op == 'shutdown':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            self.server.log(f"集群通信错误: {type(e).__name__}: {e}", 'ERROR')
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('与主进程的连接已断开'))
+            self.pending.clear()
+            # 失去枢纽后无法保证全局一致，关闭本工作进程
+            await self.server.shutdown()
@@ -0,0 +1,84 @@
+"""
+server_https.py 两种 HTTP 引擎的持久连接测试（以子进程启动服务器）
+运行: python -m pytest tests
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, 'server_https.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class EngineTestMixin:
+    engine = None
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.port = free_port()
+        # 服务器在标准输入结束时退出，测试结束时关闭管道即可停止
+        self.process = subprocess.Popen(
+            [sys.executable, SERVER, str(self.port), '--engine', self.engine],
+            cwd=self.workdir.name, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.tearDown()
+                    self.fail('服务器未能启动')
+                time.sleep(0.1)
+
+    def tearDown(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.workdir.cleanup()
+
+    def test_head_then_get_on_one_connection(self):
+        """HEAD 的 405 响应不带响应体，同一连接上的下一个响应不错位"""
+        # 直接读原始字节：http.client 关闭 HEAD 响应时会丢弃已缓冲的多余数据，掩盖错位
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(b'HEAD / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                         b'GET /messages?since=0 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+            data = b''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+
+        head, rest = data.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.1 405 '))
+        self.assertIn(b'Allow: GET, POST, OPTIONS', head)
+        self.assertIn(b'Content-Length: ', head)
+        self.assertTrue(rest.startswith(b'HTTP/1.1 200 '), rest[:80])
+        self.assertIn(b'"messages"', rest)
+
+
+class AsyncioEngineTest(EngineTestMixin, unittest.TestCase):
+    engine = 'asyncio'
+
+
+class ThreadedEngineTest(EngineTestMixin, unittest.TestCase):
+    engine = 'threaded'
+
+
+if __name__ == '__main__':
+    unittest.main()